@@ -0,0 +1,256 @@
+"""Throughput benchmark of the pytest-redis plugin.
+
+Generates a synthetic tree of trivial tests, enqueues every test and runs
+a pytest worker against the queue, optionally through a proxy that adds
+network latency. Reports tests per second, the time per test spent
+popping, collecting and running, and the peak RSS of the worker, and
+compares them with a stored baseline.
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import redis
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+
+import pytest_redis_enqueue  # noqa: E402
+from latency_proxy import LatencyProxy  # noqa: E402
+
+
+DEFAULT_BASELINE = os.path.join(BENCHMARKS_DIR, 'baseline.json')
+
+# (tests, modules, round trip time in milliseconds)
+DEFAULT_SCENARIOS = [(10000, 100, 0),
+                     (10000, 100, 1),
+                     (10000, 100, 5),
+                     (10000, 100, 20),
+                     (10000, 1, 0),
+                     (10000, 1000, 0),
+                     (50000, 500, 0),
+                     (200000, 2000, 0)]
+
+# A worker with the plugin defaults claims and collects a single test at a
+# time, which takes hours and gigabytes of memory for the larger scenarios.
+DEFAULT_WORKER_ARGS = ['--redis-collection-cache-size=1000',
+                       '--redis-batch-size=100']
+
+
+def parse_scenario(value):
+    """Parse a TESTS:MODULES:RTT_MS scenario."""
+    try:
+        tests, modules, rtt = value.split(':')
+        return int(tests), int(modules), float(rtt)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "scenarios are given as TESTS:MODULES:RTT_MS")
+
+
+def get_scenario_name(tests, modules, rtt, plugin_args):
+    """Return the name a scenario is stored under in the baseline."""
+    name = "{}x{}@{:g}ms".format(tests, modules, rtt)
+    if plugin_args:
+        name += " " + " ".join(plugin_args)
+    return name
+
+
+def generate_tree(root, tests, modules):
+    """Write `tests` trivial tests over `modules` modules.
+
+    Returns the node id of every test in collection order.
+    """
+    node_ids = []
+    per_module, remainder = divmod(tests, modules)
+    for module_num in range(modules):
+        filename = "test_bench_{}.py".format(module_num)
+        count = per_module + (1 if module_num < remainder else 0)
+        with open(os.path.join(root, filename), 'w') as module_file:
+            for test_num in range(count):
+                module_file.write("def test_{}():\n    pass\n\n\n".format(
+                    test_num))
+                node_ids.append("{}::test_{}".format(filename, test_num))
+    return node_ids
+
+
+def get_free_port():
+    """Return a TCP port that is free on localhost."""
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_redis_server(executable):
+    """Start a throwaway redis server and return it with its port."""
+    port = get_free_port()
+    server = subprocess.Popen([executable, '--port', str(port),
+                               '--save', '', '--appendonly', 'no'],
+                              stdout=open(os.devnull, 'w'))
+    connection = redis.StrictRedis(port=port)
+    deadline = time.time() + 10
+    while True:
+        try:
+            connection.ping()
+            return server, port
+        except redis.ConnectionError:
+            if time.time() > deadline:
+                server.kill()
+                raise
+            time.sleep(0.05)
+
+
+def run_scenario(host, port, tests, modules, rtt, plugin_args):
+    """Run a worker over a generated tree and return its measurements."""
+    root = tempfile.mkdtemp(prefix='pytest-redis-bench-')
+    list_key = 'pytest-redis-bench:{}'.format(os.getpid())
+    connection = redis.StrictRedis(host=host, port=port)
+    proxy = None
+    try:
+        node_ids = generate_tree(root, tests, modules)
+        connection.delete(list_key)
+        pytest_redis_enqueue.enqueue(connection, list_key, node_ids, 1000)
+
+        worker_host, worker_port = host, port
+        if rtt:
+            proxy = LatencyProxy(host, port, rtt / 1000.0).start()
+            worker_host, worker_port = proxy.host, proxy.port
+
+        output = os.path.join(root, 'timing.json')
+        env = dict(os.environ)
+        env['PYTEST_REDIS_BENCH_OUTPUT'] = output
+        env['PYTHONPATH'] = os.pathsep.join(
+            [BENCHMARKS_DIR, os.path.dirname(BENCHMARKS_DIR)] +
+            [path for path in [env.get('PYTHONPATH')] if path])
+        command = [sys.executable, '-m', 'pytest', '-q',
+                   '-p', 'no:cacheprovider',
+                   '-p', 'pytest_redis', '-p', 'bench_timing',
+                   '--redis-host=' + str(worker_host),
+                   '--redis-port=' + str(worker_port),
+                   '--redis-list-key=' + list_key] + list(plugin_args)
+        start = time.time()
+        with open(os.devnull, 'w') as devnull:
+            subprocess.call(command, cwd=root, env=env, stdout=devnull)
+        duration = time.time() - start
+
+        with open(output) as output_file:
+            timing = json.load(output_file)
+    finally:
+        if proxy is not None:
+            proxy.stop()
+        connection.delete(list_key)
+        shutil.rmtree(root)
+
+    ran = max(timing['tests'], 1)
+    return {
+        'tests': timing['tests'],
+        'seconds': round(duration, 3),
+        'tests_per_second': round(timing['tests'] / duration, 1),
+        'pop_us': round(timing['pop'] / ran * 1e6, 1),
+        'collect_us': round(timing['collect'] / ran * 1e6, 1),
+        'run_us': round(timing['run'] / ran * 1e6, 1),
+        'max_rss_kb': timing['max_rss_kb'],
+    }
+
+
+def compare(name, result, baseline, tolerance):
+    """Return a description of a regression against the baseline, if any."""
+    expected = baseline.get(name)
+    if expected is None:
+        return None
+    minimum = expected['tests_per_second'] * (1 - tolerance)
+    if result['tests_per_second'] < minimum:
+        return "{}: {} tests/s is below the baseline of {} tests/s".format(
+            name, result['tests_per_second'], expected['tests_per_second'])
+    return None
+
+
+def main(argv=None):
+    """Run the benchmark scenarios and compare them to the baseline."""
+    parser = argparse.ArgumentParser(
+        description=('Measure the throughput of a pytest-redis worker. '
+                     'Arguments that are not listed here are passed to '
+                     'the worker, which defaults to ' +
+                     ' '.join(DEFAULT_WORKER_ARGS) + '.'))
+    parser.add_argument('--redis-host', default='localhost',
+                        help='The host of the redis instance.')
+    parser.add_argument('--redis-port', default='6379',
+                        help='The port of the redis instance.')
+    parser.add_argument('--redis-server', default=None,
+                        help=('Start a throwaway redis server with this '
+                              'executable instead of using redis-host.'))
+    parser.add_argument('--scenario', action='append', default=None,
+                        type=parse_scenario,
+                        help=('A TESTS:MODULES:RTT_MS scenario to run, may '
+                              'be repeated. Defaults to a range from 10k '
+                              'to 200k tests, over 1 to 2000 modules and '
+                              'at up to 20ms of round trip time.'))
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE,
+                        help='The JSON file of baseline results.')
+    parser.add_argument('--save-baseline', action='store_true',
+                        default=False,
+                        help='Store the results as the new baseline.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help=('The fraction of the baseline throughput a '
+                              'scenario may lose before it is reported as '
+                              'a regression.'))
+    args, plugin_args = parser.parse_known_args(argv)
+    if not plugin_args:
+        plugin_args = DEFAULT_WORKER_ARGS
+
+    server = None
+    host, port = args.redis_host, args.redis_port
+    if args.redis_server is not None:
+        server, port = start_redis_server(args.redis_server)
+        host = '127.0.0.1'
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    results = {}
+    regressions = []
+    missing = []
+    try:
+        for tests, modules, rtt in args.scenario or DEFAULT_SCENARIOS:
+            name = get_scenario_name(tests, modules, rtt, plugin_args)
+            result = run_scenario(host, port, tests, modules, rtt,
+                                  plugin_args)
+            results[name] = result
+            print("{}: {tests_per_second} tests/s, pop {pop_us}us, "
+                  "collect {collect_us}us, run {run_us}us per test, "
+                  "max RSS {max_rss_kb}kB".format(name, **result))
+            if name not in baseline:
+                missing.append(name)
+            regression = compare(name, result, baseline, args.tolerance)
+            if regression is not None:
+                regressions.append(regression)
+    finally:
+        if server is not None:
+            server.terminate()
+
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(baseline, baseline_file, indent=2, sort_keys=True,
+                      separators=(',', ': '))
+            baseline_file.write('\n')
+        # The missing scenarios are part of the baseline now
+        missing = []
+    for regression in regressions:
+        print("REGRESSION " + regression)
+    for name in missing:
+        print("NO BASELINE {}: record one with --save-baseline".format(name))
+    return 1 if regressions or missing else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,47 @@
+"""A pytest plugin that times the phases of the pytest-redis loop.
+
+The totals are written as JSON to the path in the
+PYTEST_REDIS_BENCH_OUTPUT environment variable once the session finishes.
+"""
+import json
+import os
+import resource
+import time
+
+import _pytest.runner
+
+# Imported under another name, pytest treats pytest_* names as hooks
+import pytest_redis as redis_plugin
+
+
+_totals = {'pop': 0.0, 'collect': 0.0, 'run': 0.0}
+
+
+def _timed(phase, function):
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _totals[phase] += time.time() - start
+    return wrapper
+
+
+redis_plugin.claim_tests_from_redis = _timed(
+    'pop', redis_plugin.claim_tests_from_redis)
+redis_plugin.collect_test_path = _timed(
+    'collect', redis_plugin.collect_test_path)
+_pytest.runner.pytest_runtest_protocol = _timed(
+    'run', _pytest.runner.pytest_runtest_protocol)
+
+
+def pytest_sessionfinish(session):
+    output = os.environ.get('PYTEST_REDIS_BENCH_OUTPUT')
+    if output is None:
+        return
+    result = dict(_totals)
+    result['tests'] = len(getattr(session, 'items', []))
+    result['max_rss_kb'] = resource.getrusage(
+        resource.RUSAGE_SELF).ru_maxrss
+    with open(output, 'w') as output_file:
+        json.dump(result, output_file)
@@ -0,0 +1,69 @@
+"""A TCP proxy that delays traffic to simulate a network round trip."""
+import socket
+import threading
+import time
+
+
+class LatencyProxy(object):
+    """Forward connections to a redis server, adding `rtt` seconds.
+
+    Every chunk of data is delayed by half the round trip time in each
+    direction, so that a request and its reply take `rtt` seconds longer.
+    """
+
+    def __init__(self, target_host, target_port, rtt, host='127.0.0.1'):
+        self.target = (target_host, int(target_port))
+        self.delay = rtt / 2.0
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind((host, 0))
+        self._server.listen(128)
+        self.host, self.port = self._server.getsockname()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._accept,
+                                        name='latency-proxy')
+        self._thread.daemon = True
+
+    def start(self):
+        """Start accepting connections."""
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop accepting connections."""
+        self._stopped.set()
+        self._server.close()
+
+    def _accept(self):
+        while not self._stopped.is_set():
+            try:
+                client, _ = self._server.accept()
+            except (socket.error, OSError):
+                return
+            upstream = socket.create_connection(self.target)
+            for sock in (client, upstream):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            for source, destination in ((client, upstream),
+                                        (upstream, client)):
+                thread = threading.Thread(target=self._pump,
+                                          args=(source, destination))
+                thread.daemon = True
+                thread.start()
+
+    def _pump(self, source, destination):
+        try:
+            while True:
+                data = source.recv(65536)
+                if not data:
+                    break
+                if self.delay:
+                    time.sleep(self.delay)
+                destination.sendall(data)
+        except (socket.error, OSError):
+            pass
+        finally:
+            for sock in (source, destination):
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except (socket.error, OSError):
+                    pass
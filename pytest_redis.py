@@ -1,5 +1,28 @@
 """pytest-redis queue plugin implementation."""
+import bisect
+import glob
+import hashlib
+import json
 import os
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+import uuid
+import zlib
+from collections import Counter, OrderedDict
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from importlib import reload as reload_module
+except ImportError:
+    reload_module = reload  # noqa: F821
 
 import redis
 import pytest
@@ -7,23 +30,98 @@ import itertools
 
 from _pytest.terminal import TerminalReporter
 import _pytest.runner
+from _pytest.runner import collect_one_node
 from _pytest.main import NoMatch
 from _pytest.main import EXIT_NOTESTSCOLLECTED, EXIT_OK
+from _pytest.main import (EXIT_TESTSFAILED,
+                          EXIT_INTERRUPTED,
+                          EXIT_INTERNALERROR,
+                          EXIT_USAGEERROR)
 
 
 def pytest_addoption(parser):
     """Add command line options to py.test command."""
     parser.addoption('--redis-host', metavar='redis_host',
                      type=str, help='The host of the redis instance.',
-                     required=True)
+                     required=False)
     parser.addoption('--redis-port', metavar='redis_port',
                      type=str, help='The port of the redis instance.',
-                     required=True)
+                     required=False)
+    parser.addoption('--redis-url', metavar='redis_url',
+                     type=str,
+                     default=None,
+                     help=('The URL of the redis instance, used instead of '
+                           'redis-host and redis-port. redis://, rediss:// '
+                           'for TLS and unix:// for a unix socket are '
+                           'supported, with the database selected by the '
+                           'path or a db query argument.'),
+                     required=False)
+    parser.addoption('--redis-socket-timeout',
+                     metavar='redis_socket_timeout',
+                     type=float,
+                     default=None,
+                     help=('The number of seconds a redis command may wait '
+                           'on the socket before it fails. Blocking pops '
+                           'wait for up to one second longer than '
+                           'redis-idle-timeout slices, so this should be '
+                           'longer than that.'),
+                     required=False)
     parser.addoption('--redis-list-key', metavar='redis_list_key',
                      type=str,
                      help=('The key of the redis list containing '
                            'the test paths to execute.'),
                      required=True)
+    parser.addoption('--redis-priority-list-key',
+                     metavar='redis_priority_list_key',
+                     type=str,
+                     action='append',
+                     default=None,
+                     help=('The key of a redis list that is consumed '
+                           'before redis-list-key, such as a list of '
+                           'previously failed tests. May be given more '
+                           'than once, highest priority first.'),
+                     required=False)
+    parser.addoption('--redis-shards',
+                     metavar='redis_shards',
+                     type=int,
+                     default=0,
+                     help=('Consume a queue spread over this many shard '
+                           'lists, {<redis-list-key>:<index>}, by '
+                           'pytest-redis-enqueue --shards.'),
+                     required=False)
+    parser.addoption('--redis-home-shard',
+                     metavar='redis_home_shard',
+                     type=int,
+                     default=None,
+                     help=('The index of the shard this worker consumes '
+                           'first. Defaults to a hash of the worker id.'),
+                     required=False)
+    parser.addoption('--redis-affinity',
+                     action='store_true',
+                     default=False,
+                     help=('Prefer the test paths that share expensive '
+                           'fixtures with the ones this worker already ran, '
+                           'as grouped by pytest-redis-enqueue --affinity, '
+                           'and take over the largest group once they and '
+                           'the redis list are empty.'),
+                     required=False)
+    parser.addoption('--redis-manifest-key',
+                     metavar='redis_manifest_key',
+                     type=str,
+                     default=None,
+                     help=('The manifest stored by pytest-redis-enqueue '
+                           '--encode. Claimed integers and ranges are '
+                           'decoded against its entries.'),
+                     required=False)
+    parser.addoption('--redis-chunks',
+                     action='store_true',
+                     default=False,
+                     help=('Treat every claimed test path, such as the '
+                           'modules pushed by pytest-redis-enqueue '
+                           '--granularity=module, as a chunk whose unrun '
+                           'items other workers can steal once the queue '
+                           'is empty.'),
+                     required=False)
     parser.addoption('--redis-backup-list-key',
                      metavar='redis_backup_list_key',
                      type=str,
@@ -35,6 +133,660 @@ def pytest_addoption(parser):
                            'If the main redis-list-key is not empty then ran '
                            'tests are pushed to this list.'),
                      required=False)
+    parser.addoption('--redis-batch-size',
+                     metavar='redis_batch_size',
+                     type=int,
+                     default=1,
+                     help=('The number of test paths to claim from the '
+                           'redis list in a single round trip. Each batch '
+                           'is collected and passed to '
+                           'pytest_collection_modifyitems as a whole.'),
+                     required=False)
+    parser.addoption('--redis-prefetch',
+                     metavar='redis_prefetch',
+                     type=int,
+                     default=0,
+                     help=('The number of batches to claim ahead of time '
+                           'from a background thread while tests run. '
+                           'Batches that are claimed but never run are '
+                           'returned to the redis list. Disabled by '
+                           'default.'),
+                     required=False)
+    parser.addoption('--redis-idle-timeout',
+                     metavar='redis_idle_timeout',
+                     type=float,
+                     default=None,
+                     help=('Wait for new test paths with a blocking pop '
+                           'instead of exiting as soon as the redis list '
+                           'is empty. The worker exits once the list has '
+                           'been empty for this many seconds.'),
+                     required=False)
+    parser.addoption('--redis-done-key',
+                     metavar='redis_done_key',
+                     type=str,
+                     default=None,
+                     help=('A key the producer sets once it has pushed '
+                           'every test path. Waiting workers exit as soon '
+                           'as this key exists and the redis list is '
+                           'empty.'),
+                     required=False)
+    parser.addoption('--redis-collection-cache-size',
+                     metavar='redis_collection_cache_size',
+                     type=int,
+                     default=0,
+                     help=('The number of test files whose collected '
+                           'nodes are kept so that later test paths from '
+                           'the same file are resolved without collecting '
+                           'it again. The least recently used files are '
+                           'evicted first. Disabled by default.'),
+                     required=False)
+    parser.addoption('--redis-bounded-memory',
+                     action='store_true',
+                     default=False,
+                     help=('Only count the items that ran and their '
+                           'passing reports instead of keeping them, so '
+                           'that a long lived worker uses a bounded amount '
+                           'of memory. Combine with '
+                           '--redis-collection-cache-size to bound the '
+                           'collected nodes that are kept.'),
+                     required=False)
+    parser.addoption('--redis-lease-timeout',
+                     metavar='redis_lease_timeout',
+                     type=float,
+                     default=None,
+                     help=('Move claimed test paths to a per worker '
+                           'in-flight list guarded by a lease that is '
+                           'renewed every third of this many seconds. '
+                           'The in-flight tests of workers whose lease '
+                           'expired are pushed back to the redis list.'),
+                     required=False)
+    parser.addoption('--redis-worker-id',
+                     metavar='redis_worker_id',
+                     type=str,
+                     default=None,
+                     help=('The id of this worker in the lease keys. '
+                           'Defaults to <hostname>:<pid>.'),
+                     required=False)
+    parser.addoption('--redis-durations-key',
+                     metavar='redis_durations_key',
+                     type=str,
+                     default=None,
+                     help=('The key of a redis hash where the duration of '
+                           'every test path that runs is recorded, in '
+                           'seconds.'),
+                     required=False)
+    parser.addoption('--redis-dedupe-key',
+                     metavar='redis_dedupe_key',
+                     type=str,
+                     default=None,
+                     help=('The prefix of the dedupe index of a run, such '
+                           'as <redis-list-key>:<run-id>. Test paths that '
+                           'finished in the run are dropped when claimed '
+                           'again.'),
+                     required=False)
+    parser.addoption('--redis-queue-type',
+                     metavar='redis_queue_type',
+                     type=str,
+                     default='list',
+                     choices=['list', 'zset', 'stream'],
+                     help=('The type of the redis-list-key. A zset is '
+                           'consumed highest score first and requires '
+                           'redis-durations-key, which scores the test '
+                           'paths that are pushed back to it. A stream is '
+                           'consumed through a consumer group, which '
+                           'replaces the backup list and leases.'),
+                     required=False)
+    parser.addoption('--redis-consumer-group',
+                     metavar='redis_consumer_group',
+                     type=str,
+                     default='pytest-redis',
+                     help=('The consumer group that reads a stream queue. '
+                           'The group is created if it does not exist.'),
+                     required=False)
+    parser.addoption('--redis-stream-claim-idle',
+                     metavar='redis_stream_claim_idle',
+                     type=float,
+                     default=300.0,
+                     help=('The number of seconds a test path read from a '
+                           'stream queue may stay unacknowledged before '
+                           'another consumer claims it. It should exceed '
+                           'the duration of the slowest batch.'),
+                     required=False)
+    parser.addoption('--redis-report-stream',
+                     metavar='redis_report_stream',
+                     type=str,
+                     default=None,
+                     help=('The key of a redis stream where a compact '
+                           'result of every test is added. The results '
+                           'can be merged into a single report with '
+                           'pytest-redis-aggregate.'),
+                     required=False)
+    parser.addoption('--redis-report-batch-size',
+                     metavar='redis_report_batch_size',
+                     type=int,
+                     default=100,
+                     help=('The number of test results that are buffered '
+                           'before they are added to the report stream in '
+                           'a single round trip.'),
+                     required=False)
+    parser.addoption('--redis-report-longrepr-length',
+                     metavar='redis_report_longrepr_length',
+                     type=int,
+                     default=2000,
+                     help=('The number of characters of a failure '
+                           'representation that are kept in the report '
+                           'stream.'),
+                     required=False)
+    parser.addoption('--redis-abort-key',
+                     metavar='redis_abort_key',
+                     type=str,
+                     default=None,
+                     help=('A key shared by every worker of a run. It is '
+                           'set once the workers failed --maxfail tests '
+                           'between them, and every worker stops before '
+                           'its next batch once it is set. Setting it by '
+                           'hand stops the run too.'),
+                     required=False)
+    parser.addoption('--redis-result-cache',
+                     metavar='redis_result_cache',
+                     type=str,
+                     default=None,
+                     help=('A key prefix under which passing tests are '
+                           'recorded with a hash of their module, '
+                           'conftests and dependency files. Tests whose '
+                           'hash was recorded are reported as passed '
+                           'without running them.'),
+                     required=False)
+    parser.addoption('--redis-result-cache-ttl',
+                     metavar='redis_result_cache_ttl',
+                     type=int,
+                     default=7 * 24 * 60 * 60,
+                     help=('The number of seconds a passing test is kept '
+                           'in the result cache.'),
+                     required=False)
+    parser.addoption('--redis-result-cache-dependency',
+                     metavar='redis_result_cache_dependency',
+                     type=str,
+                     action='append',
+                     default=None,
+                     help=('A glob of files every test depends on, such as '
+                           'the code under test. May be given more than '
+                           'once.'),
+                     required=False)
+    parser.addoption('--redis-stats',
+                     action='store_true',
+                     default=False,
+                     help=('Keep counters of the tests this worker claimed, '
+                           'passed and failed and of its busy time in '
+                           'redis, so that pytest-redis-monitor can show '
+                           'the progress of every worker.'),
+                     required=False)
+    parser.addoption('--redis-timing',
+                     action='store_true',
+                     default=False,
+                     help=('Time every phase of the collect and run loop '
+                           'and print a summary once the session '
+                           'finishes.'),
+                     required=False)
+    parser.addoption('--redis-timing-json',
+                     metavar='redis_timing_json',
+                     type=str,
+                     default=None,
+                     help=('Time every phase of the collect and run loop '
+                           'and write the histograms to this JSON file.'),
+                     required=False)
+    parser.addoption('--redis-timing-prometheus',
+                     metavar='redis_timing_prometheus',
+                     type=str,
+                     default=None,
+                     help=('Time every phase of the collect and run loop '
+                           'and write the histograms to this Prometheus '
+                           'textfile.'),
+                     required=False)
+    parser.addoption('--redis-daemon-key',
+                     metavar='redis_daemon_key',
+                     type=str,
+                     default=None,
+                     help=('Keep running as a daemon that runs every job '
+                           'added to this redis stream, reporting the exit '
+                           'status of each job to <redis-daemon-key>:'
+                           'result:<job>, instead of exiting once the '
+                           'queue is empty.'),
+                     required=False)
+    parser.addoption('--redis-workers',
+                     metavar='redis_workers',
+                     type=int,
+                     default=0,
+                     help=('The number of queue consumers to fork once the '
+                           'configuration and conftests are loaded. The '
+                           'consumers share the imports of this process, '
+                           'which respawns consumers that are killed and '
+                           'merges their exit statuses.'),
+                     required=False)
+
+
+# Atomically pops up to ARGV[1] entries from the tail of KEYS[1]. When a
+# backup list is given as KEYS[2] every popped entry is pushed onto it,
+# exactly as a sequence of RPOPLPUSH calls would.
+CLAIM_TESTS_SCRIPT = """
+local claimed = {}
+for i = 1, tonumber(ARGV[1]) do
+    local value
+    if KEYS[2] then
+        value = redis.call('rpoplpush', KEYS[1], KEYS[2])
+    else
+        value = redis.call('rpop', KEYS[1])
+    end
+    if not value then
+        break
+    end
+    claimed[i] = value
+end
+return claimed
+"""
+
+# Atomically pops up to ARGV[1] entries from the lists in KEYS, taking
+# from the first list until it is empty before taking from the next one.
+# When ARGV[2] is '1' the second half of KEYS holds the backup list of
+# every list in the first half and every popped entry is pushed onto the
+# backup list of its list. Returns the index of the list each entry was
+# popped from followed by the entry.
+CLAIM_TESTS_FROM_LANES_SCRIPT = """
+local lanes = #KEYS
+if ARGV[2] == '1' then
+    lanes = lanes / 2
+end
+local count = tonumber(ARGV[1])
+local claimed = {}
+for lane = 1, lanes do
+    while #claimed < 2 * count do
+        local value
+        if ARGV[2] == '1' then
+            value = redis.call('rpoplpush', KEYS[lane], KEYS[lanes + lane])
+        else
+            value = redis.call('rpop', KEYS[lane])
+        end
+        if not value then
+            break
+        end
+        claimed[#claimed + 1] = lane
+        claimed[#claimed + 1] = value
+    end
+    if #claimed >= 2 * count then
+        break
+    end
+end
+return claimed
+"""
+
+# Adds ARGV[1] failures to the fleet failure counter KEYS[1] and sets the
+# abort key KEYS[2] to the reason ARGV[3] once the counter reaches the
+# threshold ARGV[2], unless the threshold is 0. Returns the counter.
+RECORD_FAILURES_SCRIPT = """
+local failures = redis.call('incrby', KEYS[1], ARGV[1])
+local threshold = tonumber(ARGV[2])
+if threshold > 0 and failures >= threshold then
+    redis.call('setnx', KEYS[2], ARGV[3])
+end
+return failures
+"""
+
+# Atomically pops up to ARGV[1] entries, taking from the affinity lists
+# in ARGV[2..] first, then from the redis list KEYS[2] and then from the
+# longest affinity list in the set KEYS[1], until each is empty. Empty
+# affinity lists are removed from the set. When a backup list is given as
+# KEYS[3] every popped entry is pushed onto it. Returns the list each
+# entry was popped from followed by the entry.
+CLAIM_TESTS_WITH_AFFINITY_SCRIPT = """
+local count = tonumber(ARGV[1])
+local claimed = {}
+local function take(source)
+    while #claimed < 2 * count do
+        local value
+        if KEYS[3] then
+            value = redis.call('rpoplpush', source, KEYS[3])
+        else
+            value = redis.call('rpop', source)
+        end
+        if not value then
+            if source ~= KEYS[2] then
+                redis.call('srem', KEYS[1], source)
+            end
+            return
+        end
+        claimed[#claimed + 1] = source
+        claimed[#claimed + 1] = value
+    end
+end
+for i = 2, #ARGV do
+    take(ARGV[i])
+end
+take(KEYS[2])
+while #claimed < 2 * count do
+    local longest, longest_length = nil, 0
+    for _, source in ipairs(redis.call('smembers', KEYS[1])) do
+        local length = redis.call('llen', source)
+        if length == 0 then
+            redis.call('srem', KEYS[1], source)
+        elseif length > longest_length then
+            longest, longest_length = source, length
+        end
+    end
+    if not longest then
+        break
+    end
+    take(longest)
+end
+return claimed
+"""
+
+# Steals the second half, rounded up, of the longest chunk list in the
+# set KEYS[1] other than the worker's own chunk list ARGV[1], and pushes
+# the stolen entries to the claim list KEYS[2], if given. Empty chunk
+# lists are removed from the set. Returns the stolen entries in order.
+STEAL_CHUNK_SCRIPT = """
+local longest, longest_length = nil, 0
+for _, chunk in ipairs(redis.call('smembers', KEYS[1])) do
+    if chunk ~= ARGV[1] then
+        local length = redis.call('llen', chunk)
+        if length == 0 then
+            redis.call('srem', KEYS[1], chunk)
+        elseif length > longest_length then
+            longest, longest_length = chunk, length
+        end
+    end
+end
+if not longest then
+    return {}
+end
+local count = math.ceil(longest_length / 2)
+local stolen = redis.call('lrange', longest, -count, -1)
+redis.call('ltrim', longest, 0, -count - 1)
+if #KEYS > 1 then
+    for _, value in ipairs(stolen) do
+        redis.call('lpush', KEYS[2], value)
+    end
+end
+return stolen
+"""
+
+# Pops up to ARGV[1] entries from the head of the chunk list KEYS[1].
+TAKE_CHUNK_SCRIPT = """
+local taken = redis.call('lrange', KEYS[1], 0, ARGV[1] - 1)
+redis.call('ltrim', KEYS[1], #taken, -1)
+return taken
+"""
+
+# Removes the chunk list KEYS[1] from the chunk set KEYS[2] and returns
+# the entries that were left in it.
+RELEASE_CHUNK_SCRIPT = """
+local remaining = redis.call('lrange', KEYS[1], 0, -1)
+redis.call('del', KEYS[1])
+redis.call('srem', KEYS[2], KEYS[1])
+return remaining
+"""
+
+# The number of entries a worker pops from its own chunk list at once.
+CHUNK_TAKE_SIZE = 8
+
+# The longest a blocking pop waits before the done key is checked again.
+# Redis versions before 6.0 only accept whole seconds.
+BLOCKING_POP_INTERVAL = 1
+
+# The field of a stream queue entry that holds the test path.
+STREAM_PATH_FIELD = 'path'
+
+# Pushes the entries in ARGV back onto the tail of KEYS[1] so that they
+# are the next ones to be popped, in their original order, and removes
+# them from the backup list KEYS[2] if one is given.
+RETURN_TESTS_SCRIPT = """
+for i = #ARGV, 1, -1 do
+    redis.call('rpush', KEYS[1], ARGV[i])
+    if KEYS[2] then
+        redis.call('lrem', KEYS[2], 1, ARGV[i])
+    end
+end
+return #ARGV
+"""
+
+# For every finished test path ARGV[i] and its number of copies
+# ARGV[i + 1], removes that many copies from the in-flight list KEYS[1]
+# and pushes them to the backup list KEYS[2], if one is given, like
+# RPOPLPUSH would have. Returns the number of removed entries.
+ACKNOWLEDGE_TESTS_SCRIPT = """
+local removed = 0
+for i = 1, #ARGV, 2 do
+    local count = redis.call('lrem', KEYS[1], tonumber(ARGV[i + 1]), ARGV[i])
+    if KEYS[2] then
+        for j = 1, count do
+            redis.call('lpush', KEYS[2], ARGV[i])
+        end
+    end
+    removed = removed + count
+end
+return removed
+"""
+
+# Unless ARGV[2] is set, only acts when the lease KEYS[1] has expired.
+# Moves the in-flight list KEYS[2] to the tail of the redis list KEYS[3],
+# oldest claim last so that it is popped first, and removes the worker
+# ARGV[1] from the worker set KEYS[4]. Returns -1 if the lease is alive.
+# When a score hash is given as KEYS[5] the queue KEYS[3] is a sorted set
+# and every test path is added to it with its score from that hash.
+REAP_WORKER_SCRIPT = """
+if ARGV[2] ~= '1' and redis.call('exists', KEYS[1]) == 1 then
+    return -1
+end
+local moved = 0
+while true do
+    local value = redis.call('lpop', KEYS[2])
+    if not value then
+        break
+    end
+    if KEYS[5] then
+        local score = tonumber(redis.call('hget', KEYS[5], value)) or 0
+        redis.call('zadd', KEYS[3], score, value)
+    else
+        redis.call('rpush', KEYS[3], value)
+    end
+    moved = moved + 1
+end
+redis.call('del', KEYS[1])
+redis.call('srem', KEYS[4], ARGV[1])
+return moved
+"""
+
+# Moves every entry of the backup list KEYS[1] to the head of the redis
+# list KEYS[2] in a single atomic step, exactly as a RPOPLPUSH loop would.
+# Restored entries are removed from the hash KEYS[3] of claimed test paths
+# if one is given.
+RESTORE_BACKUP_LIST_SCRIPT = """
+local moved = 0
+while true do
+    local value = redis.call('rpoplpush', KEYS[1], KEYS[2])
+    if not value then
+        break
+    end
+    if KEYS[3] then
+        redis.call('hdel', KEYS[3], value)
+    end
+    moved = moved + 1
+end
+return moved
+"""
+
+# Removes up to ARGV[1] of the highest scored entries of the sorted set
+# KEYS[1] and pushes each of them onto the list KEYS[2], if one is given,
+# like RPOPLPUSH would.
+CLAIM_HIGHEST_SCORED_TESTS_SCRIPT = """
+local claimed = redis.call('zrevrange', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+for i, value in ipairs(claimed) do
+    redis.call('zrem', KEYS[1], value)
+    if KEYS[2] then
+        redis.call('lpush', KEYS[2], value)
+    end
+end
+return claimed
+"""
+
+# Adds the entries in ARGV back to the sorted set KEYS[1], scored from the
+# hash KEYS[2], and removes them from the list KEYS[3] if one is given.
+RETURN_TESTS_TO_SORTED_SET_SCRIPT = """
+for i, value in ipairs(ARGV) do
+    local score = tonumber(redis.call('hget', KEYS[2], value)) or 0
+    redis.call('zadd', KEYS[1], score, value)
+    if KEYS[3] then
+        redis.call('lrem', KEYS[3], 1, value)
+    end
+end
+return #ARGV
+"""
+
+# Moves every entry of the backup list KEYS[1] to the sorted set KEYS[2]
+# in a single atomic step, scored from the hash KEYS[3]. Restored entries
+# are removed from the hash KEYS[4] of claimed test paths if one is given.
+RESTORE_BACKUP_LIST_TO_SORTED_SET_SCRIPT = """
+local moved = 0
+while true do
+    local value = redis.call('rpop', KEYS[1])
+    if not value then
+        break
+    end
+    local score = tonumber(redis.call('hget', KEYS[3], value)) or 0
+    redis.call('zadd', KEYS[2], score, value)
+    if KEYS[4] then
+        redis.call('hdel', KEYS[4], value)
+    end
+    moved = moved + 1
+end
+return moved
+"""
+
+# The longest test results are buffered before they are added to the
+# report stream, in seconds.
+REPORT_FLUSH_INTERVAL = 1.0
+
+# The phases of the collect and run loop that are timed, see PhaseTimer.
+TIMED_PHASES = ['pop', 'idle', 'blocked', 'collect', 'genitems',
+                'modifyitems', 'run']
+
+# The upper bounds of the phase timing histogram buckets, in seconds.
+PHASE_TIMING_BUCKETS = [0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5,
+                        1.0, 5.0, 10.0]
+
+# The longest worker counters are buffered before they are added to the
+# redis stats hash, in seconds.
+STATS_FLUSH_INTERVAL = 1.0
+
+# How long the stats keys of a worker outlive its last update, in seconds.
+STATS_KEY_TTL = 24 * 60 * 60
+
+# The terminal report categories that are only counted with
+# --redis-bounded-memory, passing tests and passing setups and teardowns.
+COUNTED_REPORT_CATEGORIES = ('passed', '')
+
+# How long the dedupe index of a run is kept, in seconds.
+DEDUPE_KEY_TTL = 24 * 60 * 60
+
+# Pushes every ARGV entry that is not in the set KEYS[2] to the list
+# KEYS[1], so that the first entry is the first one popped, and adds it to
+# the set. ARGV[1] is the expiry of the set. Returns the number of pushed
+# entries.
+ENQUEUE_DEDUPED_SCRIPT = """
+local pushed = 0
+for i = 2, #ARGV do
+    if redis.call('sadd', KEYS[2], ARGV[i]) == 1 then
+        redis.call('lpush', KEYS[1], ARGV[i])
+        pushed = pushed + 1
+    end
+end
+redis.call('expire', KEYS[2], ARGV[1])
+return pushed
+"""
+
+# Returns the ARGV entries from ARGV[4] on that are neither in the set
+# KEYS[1] of finished test paths, nor earlier in ARGV, nor held by another
+# live worker in the hash KEYS[2] of claimed test paths, and marks them as
+# held by the worker ARGV[1]. A holder is live until its lease, ARGV[2]
+# followed by its id, expires, or always if ARGV[2] is empty. ARGV[3] is
+# the expiry of the hash.
+CLAIM_UNFINISHED_SCRIPT = """
+local kept, seen = {}, {}
+for i = 4, #ARGV do
+    local path = ARGV[i]
+    if not seen[path] and redis.call('sismember', KEYS[1], path) == 0 then
+        local holder = redis.call('hget', KEYS[2], path)
+        if not holder or holder == ARGV[1] or (ARGV[2] ~= '' and
+                redis.call('exists', ARGV[2] .. holder) == 0) then
+            redis.call('hset', KEYS[2], path, ARGV[1])
+            table.insert(kept, path)
+        end
+    end
+    seen[path] = true
+end
+redis.call('expire', KEYS[2], ARGV[3])
+return kept
+"""
+
+# Removes the ARGV entries from ARGV[2] on that are held by the worker
+# ARGV[1] from the hash KEYS[1] of claimed test paths.
+RELEASE_CLAIMED_SCRIPT = """
+for i = 2, #ARGV do
+    if redis.call('hget', KEYS[1], ARGV[i]) == ARGV[1] then
+        redis.call('hdel', KEYS[1], ARGV[i])
+    end
+end
+return #ARGV - 1
+"""
+
+# The number of bytes of a file hashed at once by the result cache.
+FILE_HASH_CHUNK_SIZE = 64 * 1024
+
+# How long the result hash of a daemon job is kept, in seconds.
+DAEMON_RESULT_TTL = 24 * 60 * 60
+
+# How many times a killed consumer is respawned in the same worker slot.
+MAX_WORKER_RESPAWNS = 3
+
+# The order in which consumer exit statuses take precedence when merged.
+WORKER_EXIT_STATUS_PRECEDENCE = [EXIT_INTERRUPTED,
+                                 EXIT_INTERNALERROR,
+                                 EXIT_USAGEERROR,
+                                 EXIT_TESTSFAILED,
+                                 EXIT_OK,
+                                 EXIT_NOTESTSCOLLECTED]
+
+# How often a sorted set queue is polled while waiting for test paths.
+SORTED_SET_POLL_INTERVAL = 0.1
+
+# Deletes the lock KEYS[1] only if it still holds the token ARGV[1].
+RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# How long the backup list restore lock is held at most, in milliseconds,
+# and how often waiting workers check whether it was released, in seconds.
+RESTORE_LOCK_TIMEOUT = 60000
+RESTORE_LOCK_POLL_INTERVAL = 0.05
+
+# How long a worker stays a live member of the run of a backup list
+# without renewing its membership, in seconds.
+RUN_MEMBER_TIMEOUT = 5 * 60
+
+_registered_scripts = {}
+
+
+def run_script(redis_connection, script_source, keys, args=()):
+    """Run a lua script on the redis connection, loading it only once."""
+    script = _registered_scripts.get(script_source)
+    if script is None:
+        script = redis_connection.register_script(script_source)
+        _registered_scripts[script_source] = script
+    return script(keys=keys, args=args, client=redis_connection)
+
 
 def retrieve_test_from_redis(redis_connection, list_key, backup_list_key):
     """Remove and return a test path from the redis queue."""
@@ -44,6 +796,345 @@ def retrieve_test_from_redis(redis_connection, list_key, backup_list_key):
         return redis_connection.rpop(list_key)
 
 
+def retrieve_tests_from_redis(redis_connection, list_key, backup_list_key,
+                              count):
+    """Remove and return up to `count` test paths from the redis queue.
+
+    The entries are claimed in a single atomic round trip and are pushed
+    to the backup list, if one is given, in the same order RPOPLPUSH would
+    push them.
+    """
+    if count == 1:
+        val = retrieve_test_from_redis(redis_connection,
+                                       list_key,
+                                       backup_list_key)
+        return [] if val is None else [val]
+    keys = [list_key]
+    if backup_list_key is not None:
+        keys.append(backup_list_key)
+    return run_script(redis_connection, CLAIM_TESTS_SCRIPT, keys, [count])
+
+
+
+def wait_for_test_from_redis(redis_connection, list_key, backup_list_key,
+                             idle_timeout, done_key=None, stopped=None):
+    """Block until a test path can be removed from the redis queue.
+
+    Returns None once the list has been empty for `idle_timeout` seconds,
+    once the `done_key` is set and the list is empty or once the
+    `stopped` event is set, which is checked between blocking pops.
+    """
+    deadline = time.time() + idle_timeout
+    while True:
+        if stopped is not None and stopped.is_set():
+            return None
+        if done_key is not None and redis_connection.exists(done_key):
+            # The producer may have pushed more paths right before it
+            # set the done key.
+            return retrieve_test_from_redis(redis_connection,
+                                            list_key,
+                                            backup_list_key)
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return None
+        timeout = max(1, int(min(BLOCKING_POP_INTERVAL, remaining)))
+        if backup_list_key is not None:
+            val = redis_connection.brpoplpush(list_key, backup_list_key,
+                                              timeout)
+        else:
+            popped = redis_connection.brpop(list_key, timeout)
+            val = popped[1] if popped is not None else None
+        if val is not None:
+            return val
+
+
+def claim_tests_from_redis(test_queue, batch_size, idle_timeout=None,
+                           done_key=None, stopped=None):
+    """Claim a batch of test paths, waiting for one if the queue is empty.
+
+    Without an `idle_timeout` this returns an empty batch as soon as the
+    queue is empty.
+    """
+    batch = test_queue.claim(batch_size)
+    if batch or idle_timeout is None:
+        return batch
+    val = test_queue.wait(idle_timeout, done_key, stopped)
+    if val is None:
+        return []
+    if batch_size == 1:
+        return [val]
+    return [val] + test_queue.claim(batch_size - 1)
+
+
+def return_tests_to_redis(redis_connection, list_key, backup_list_key,
+                          tests):
+    """Give claimed but unrun test paths back to the redis queue."""
+    if not tests:
+        return 0
+    keys = [list_key]
+    if backup_list_key is not None:
+        keys.append(backup_list_key)
+    return run_script(redis_connection, RETURN_TESTS_SCRIPT, keys, tests)
+
+
+def record_durations(redis_connection, durations_key, durations):
+    """Record the durations of test paths in a redis hash."""
+    if durations:
+        redis_connection.hmset(durations_key, durations)
+
+
+def restore_backup_list(redis_connection, backup_list_key, list_key,
+                        worker_id, score_key=None, claimed_key=None):
+    """Push every test path in the backup list back to the redis queue.
+
+    The backup list is only restored by the first worker of a run, while
+    no other live worker is a member of the run in the backup list's run
+    set, and the worker then joins the run. Restores are guarded by a lock
+    key, and workers that find it taken wait for it to be released or to
+    expire before they check again. Returns the number of restored test
+    paths, or None if the backup list belongs to a live run. When a
+    `score_key` hash is given the queue is a sorted set and every test path
+    is added to it with its score from that hash. Restored test paths are
+    released from the `claimed_key` hash of a dedupe index if one is given.
+    """
+    claimed_keys = [claimed_key] if claimed_key is not None else []
+    lock_key = backup_list_key + ":restore-lock"
+    run_key = get_run_member_set_key(backup_list_key)
+    while True:
+        token = uuid.uuid4().hex
+        if redis_connection.set(lock_key, token, nx=True,
+                                px=RESTORE_LOCK_TIMEOUT):
+            break
+        while redis_connection.exists(lock_key):
+            time.sleep(RESTORE_LOCK_POLL_INTERVAL)
+    try:
+        now = time.time()
+        pipe = redis_connection.pipeline(transaction=False)
+        pipe.zremrangebyscore(run_key, '-inf', now - RUN_MEMBER_TIMEOUT)
+        pipe.zcard(run_key)
+        live_members = pipe.execute()[1]
+        restored = None
+        if not live_members:
+            if score_key is not None:
+                restored = run_script(
+                    redis_connection,
+                    RESTORE_BACKUP_LIST_TO_SORTED_SET_SCRIPT,
+                    [backup_list_key, list_key, score_key] + claimed_keys)
+            else:
+                restored = run_script(redis_connection,
+                                      RESTORE_BACKUP_LIST_SCRIPT,
+                                      [backup_list_key, list_key] +
+                                      claimed_keys)
+        # Joined once restored, so that a worker that dies before it
+        # restored leaves the restore to the next one
+        redis_connection.zadd(run_key, now, worker_id)
+        return restored
+    finally:
+        run_script(redis_connection, RELEASE_LOCK_SCRIPT,
+                   [lock_key], [token])
+
+
+class RunMembership(object):
+    """Keep a worker a live member of the runs of its backup lists.
+
+    The membership is renewed between batches, at most every third of
+    `RUN_MEMBER_TIMEOUT`, and dropped once the worker stops, so that the
+    next run restores the backup lists while workers that join a live run
+    leave the claims of its other workers alone.
+    """
+
+    def __init__(self, redis_connection, backup_list_keys, worker_id):
+        self._redis_connection = redis_connection
+        self._run_keys = [get_run_member_set_key(backup_list_key)
+                          for backup_list_key in backup_list_keys]
+        self._worker_id = worker_id
+        self._renewed = time.time()
+
+    def renew(self):
+        """Renew the membership if a third of its timeout has passed."""
+        now = time.time()
+        if now - self._renewed < RUN_MEMBER_TIMEOUT / 3.0:
+            return
+        pipe = self._redis_connection.pipeline(transaction=False)
+        for run_key in self._run_keys:
+            pipe.zadd(run_key, now, self._worker_id)
+        pipe.execute()
+        self._renewed = now
+
+    def leave(self):
+        """Stop being a member of the runs."""
+        pipe = self._redis_connection.pipeline(transaction=False)
+        for run_key in self._run_keys:
+            pipe.zrem(run_key, self._worker_id)
+        pipe.execute()
+
+
+def get_run_member_set_key(backup_list_key):
+    """Return the key of the sorted set of the live workers of a run."""
+    return backup_list_key + ":run"
+
+
+def get_worker_set_key(list_key):
+    """Return the key of the set of workers holding leases on a list."""
+    return list_key + ":workers"
+
+
+def get_lease_key(list_key, worker_id):
+    """Return the key of a worker's lease on a list."""
+    return "{}:lease:{}".format(list_key, worker_id)
+
+
+def get_inflight_list_key(list_key, worker_id):
+    """Return the key of the list of tests a worker is running."""
+    return "{}:inflight:{}".format(list_key, worker_id)
+
+
+def get_dedupe_queued_key(dedupe_key):
+    """Return the key of the set of test paths enqueued in a run."""
+    return dedupe_key + ":queued"
+
+
+def get_dedupe_finished_key(dedupe_key):
+    """Return the key of the set of test paths that finished in a run."""
+    return dedupe_key + ":finished"
+
+
+def get_dedupe_claimed_key(dedupe_key):
+    """Return the key of the hash of the holders of claimed test paths."""
+    return dedupe_key + ":claimed"
+
+
+def get_daemon_result_key(daemon_key, job):
+    """Return the key of the hash of the results of a daemon job."""
+    return "{}:result:{}".format(daemon_key, job)
+
+
+def get_shard_key(list_key, index):
+    """Return the key of a shard list, hash tagged with its index."""
+    return "{{{}:{}}}".format(list_key, index)
+
+
+def get_chunk_set_key(list_key):
+    """Return the key of the set of chunk lists of a list."""
+    return list_key + ":chunks"
+
+
+def get_chunk_list_key(list_key, worker_id):
+    """Return the key of the list of a worker's unrun chunk items."""
+    return "{}:chunk:{}".format(list_key, worker_id)
+
+
+def get_affinity_set_key(list_key):
+    """Return the key of the set of affinity lists of a list."""
+    return list_key + ":affinities"
+
+
+def get_affinity_list_key(list_key, affinity):
+    """Return the key of the list of test paths sharing an affinity."""
+    digest = hashlib.sha1(affinity.encode('utf-8')).hexdigest()[:16]
+    return "{}:affinity:{}".format(list_key, digest)
+
+
+def get_failure_count_key(abort_key):
+    """Return the key of the fleet failure counter of an abort key."""
+    return abort_key + ":failures"
+
+
+def get_stats_worker_set_key(list_key):
+    """Return the key of the set of workers keeping counters on a list."""
+    return list_key + ":stats"
+
+
+def get_stats_key(list_key, worker_id):
+    """Return the key of the hash of a worker's counters."""
+    return "{}:stats:{}".format(list_key, worker_id)
+
+
+def release_worker(redis_connection, list_key, worker_id, force=False,
+                   score_key=None):
+    """Push a worker's in-flight tests back to the redis queue.
+
+    Unless `force` is given this only happens when the worker's lease has
+    expired. Returns the number of tests pushed back, or None if the lease
+    is still alive. When a `score_key` hash is given the queue is a sorted
+    set and the tests are added to it with their score from that hash.
+    """
+    keys = [get_lease_key(list_key, worker_id),
+            get_inflight_list_key(list_key, worker_id),
+            list_key,
+            get_worker_set_key(list_key)]
+    if score_key is not None:
+        keys.append(score_key)
+    moved = run_script(redis_connection,
+                       REAP_WORKER_SCRIPT,
+                       keys,
+                       [worker_id, 1 if force else 0])
+    return None if moved < 0 else moved
+
+
+def reap_expired_leases(redis_connection, list_key, score_key=None):
+    """Push the in-flight tests of workers with expired leases back.
+
+    Returns a dict of the reaped worker ids and the number of tests that
+    were pushed back to the redis queue for each of them.
+    """
+    worker_ids = list(redis_connection.smembers(
+        get_worker_set_key(list_key)))
+    if not worker_ids:
+        return {}
+    pipe = redis_connection.pipeline(transaction=False)
+    for worker_id in worker_ids:
+        pipe.exists(get_lease_key(list_key, worker_id))
+    alive = pipe.execute()
+    reaped = {}
+    for worker_id, is_alive in zip(worker_ids, alive):
+        if is_alive:
+            continue
+        moved = release_worker(redis_connection, list_key, worker_id,
+                               score_key=score_key)
+        if moved is not None:
+            reaped[worker_id] = moved
+    return reaped
+
+
+def pytest_configure(config):
+    """Register the optional reporters of the plugin."""
+    report_stream = config.getoption("redis_report_stream")
+    if report_stream is not None:
+        batch_size = config.getoption("redis_report_batch_size")
+        if batch_size < 1:
+            raise pytest.UsageError("--redis-report-batch-size must be at "
+                                    "least 1")
+        reporter = StreamReporter(config,
+                                  report_stream,
+                                  batch_size,
+                                  config.getoption(
+                                      "redis_report_longrepr_length"))
+        config.pluginmanager.register(reporter, 'redis-report-stream')
+    abort_key = config.getoption("redis_abort_key")
+    if abort_key is not None:
+        config.pluginmanager.register(FleetAbort(config, abort_key),
+                                      'redis-fleet-abort')
+    result_cache = config.getoption("redis_result_cache")
+    if result_cache is not None:
+        ttl = config.getoption("redis_result_cache_ttl")
+        if ttl < 1:
+            raise pytest.UsageError("--redis-result-cache-ttl must be at "
+                                    "least 1")
+        config.pluginmanager.register(
+            ResultCache(config, result_cache, ttl,
+                        config.getoption("redis_result_cache_dependency")
+                        or []),
+            'redis-result-cache')
+    if config.getoption("redis_stats"):
+        config.pluginmanager.register(
+            FleetStats(config, config.getoption("redis_list_key")),
+            'redis-fleet-stats')
+    if config.getoption("redis_timing") or \
+            config.getoption("redis_timing_json") is not None or \
+            config.getoption("redis_timing_prometheus") is not None:
+        config.pluginmanager.register(PhaseTimer(), 'redis-phase-timer')
+
 
 def pytest_collection(session, genitems=True):
     """We hook into the collection call and do the collection ourselves."""
@@ -56,35 +1147,274 @@ def pytest_collection(session, genitems=True):
     return items
 
 
+def create_redis_connection(url=None, host=None, port=None,
+                            socket_timeout=None):
+    """Return a redis connection with its own connection pool.
+
+    TCP connections enable keepalive. Replies are parsed with hiredis when
+    it is installed.
+    """
+    kwargs = {'socket_timeout': socket_timeout}
+    if url is None or not url.startswith('unix://'):
+        kwargs['socket_keepalive'] = True
+    if url is not None:
+        pool = redis.ConnectionPool.from_url(url, **kwargs)
+    else:
+        pool = redis.ConnectionPool(host=host, port=port, **kwargs)
+    return redis.StrictRedis(connection_pool=pool)
+
+
 def get_redis_connection(config):
-    """Get a redis connection base on config args."""
+    """Get a redis connection base on config args.
+
+    The connection and its pool are created once and shared by the test
+    generator, the reporters and the background threads.
+    """
+    r_client = getattr(config, '_redis_connection', None)
+    if r_client is not None:
+        return r_client
+    redis_url = config.getoption('redis_url')
     redis_host = config.getoption('redis_host')
     redis_port = config.getoption('redis_port')
-    r_client = redis.StrictRedis(host=redis_host,
-                                 port=redis_port)
+    if redis_url is None and (redis_host is None or redis_port is None):
+        raise pytest.UsageError("--redis-host and --redis-port or "
+                                "--redis-url are required")
+    r_client = create_redis_connection(
+        url=redis_url,
+        host=redis_host,
+        port=redis_port,
+        socket_timeout=config.getoption('redis_socket_timeout'))
+    config._redis_connection = r_client
     return r_client
 
 
-def populate_test_generator(session, redis_connection):
+def get_lanes(config):
+    """Return the (list key, backup list key) of every queue lane.
+
+    The priority lists come first, highest priority first, followed by
+    the redis list, or its shard lists when the queue is sharded. The
+    backup list of a priority list or shard list is the backup list key
+    suffixed with that list's key, so that a shard's backup list shares
+    its hash tag.
+    """
+    list_key = config.getoption("redis_list_key")
+    backup_list_key = config.getoption("redis_backup_list_key")
+    shards = config.getoption("redis_shards")
+    if shards:
+        lanes = []
+        for index in range(shards):
+            shard_key = get_shard_key(list_key, index)
+            shard_backup_key = None
+            if backup_list_key is not None:
+                shard_backup_key = "{}:{}".format(backup_list_key,
+                                                  shard_key)
+            lanes.append((shard_key, shard_backup_key))
+        return lanes
+    lanes = []
+    for lane_key in config.getoption("redis_priority_list_key") or []:
+        lane_backup_key = None
+        if backup_list_key is not None:
+            lane_backup_key = "{}:{}".format(backup_list_key, lane_key)
+        lanes.append((lane_key, lane_backup_key))
+    lanes.append((list_key, backup_list_key))
+    return lanes
+
+
+def get_home_shard(config):
+    """Return the index of the shard a worker consumes first."""
+    shards = config.getoption("redis_shards")
+    home_shard = config.getoption("redis_home_shard")
+    if home_shard is None:
+        worker_id = get_worker_id(config).encode('utf-8')
+        home_shard = zlib.crc32(worker_id) & 0xffffffff
+    return home_shard % shards
+
+
+def restore_backup_lists(redis_connection, lanes, worker_id, score_key=None,
+                         claimed_key=None):
+    """Restore the backup list of every lane to its list and join its run."""
+    for lane_key, backup_list_key in lanes:
+        if backup_list_key is None:
+            continue
+        if redis_connection.llen(backup_list_key) != 0:
+            # Push tests to the main redis list
+            restore_backup_list(redis_connection, backup_list_key, lane_key,
+                                worker_id, score_key=score_key,
+                                claimed_key=claimed_key)
+        else:
+            redis_connection.zadd(
+                get_run_member_set_key(backup_list_key), time.time(),
+                worker_id)
+
+
+def is_stream_queue(config):
+    """Return whether the queue is a redis stream."""
+    return config.getoption("redis_queue_type") == 'stream'
+
+
+def get_score_key(config):
+    """Return the hash scoring the queue, if it is a sorted set."""
+    if config.getoption("redis_queue_type") != 'zset':
+        return None
+    durations_key = config.getoption("redis_durations_key")
+    if durations_key is None:
+        raise pytest.UsageError("--redis-queue-type=zset requires "
+                                "--redis-durations-key")
+    return durations_key
+
+
+def get_worker_id(config):
+    """Return the id of this worker, <hostname>:<pid> by default."""
+    worker_id = config.getoption("redis_worker_id")
+    if worker_id is None:
+        worker_id = "{}:{}".format(socket.gethostname(), os.getpid())
+    return worker_id
+
+
+def get_lease_keeper(config, redis_connection):
+    """Return an unstarted LeaseKeeper if leases are enabled."""
+    lease_timeout = config.getoption("redis_lease_timeout")
+    if lease_timeout is None:
+        return None
+    if lease_timeout <= 0:
+        raise pytest.UsageError("--redis-lease-timeout must be positive")
+    if is_stream_queue(config):
+        raise pytest.UsageError("--redis-lease-timeout can't be used with "
+                                "--redis-queue-type=stream")
+    return LeaseKeeper(redis_connection,
+                       config.getoption("redis_list_key"),
+                       config.getoption("redis_backup_list_key"),
+                       get_worker_id(config),
+                       lease_timeout,
+                       score_key=get_score_key(config))
+
+
+def populate_test_generator(session, redis_connection, lease_keeper=None,
+                            test_queue=None):
     """Create a test path generator that consumes from the main redis list.
 
+    The generator claims from `test_queue`, which defaults to the queue
+    returned by `get_test_queue`.
+    """
+    batch_size = session.config.getoption("redis_batch_size")
+    if batch_size < 1:
+        raise pytest.UsageError("--redis-batch-size must be at least 1")
+    prefetch = session.config.getoption("redis_prefetch")
+    if prefetch < 0:
+        raise pytest.UsageError("--redis-prefetch must not be negative")
+    idle_timeout = session.config.getoption("redis_idle_timeout")
+    done_key = session.config.getoption("redis_done_key")
+    if idle_timeout is not None and idle_timeout < 0:
+        raise pytest.UsageError("--redis-idle-timeout must not be negative")
+    if done_key is not None and idle_timeout is None:
+        raise pytest.UsageError("--redis-done-key requires "
+                                "--redis-idle-timeout")
+    if test_queue is None:
+        test_queue = get_test_queue(session, redis_connection, lease_keeper)
+
+    # Closing a prefetching generator sets this event so that its thread
+    # doesn't stay blocked in a wait until the idle timeout runs out.
+    stopped = threading.Event() if prefetch else None
+    generator = redis_test_generator(session.config,
+                                     test_queue,
+                                     batch_size=batch_size,
+                                     idle_timeout=idle_timeout,
+                                     done_key=done_key,
+                                     stopped=stopped)
+    if prefetch:
+        generator = PrefetchingTestGenerator(generator, test_queue, prefetch,
+                                             stopped)
+    return generator
+
+
+def get_test_queue(session, redis_connection, lease_keeper=None):
+    """Return the queue that test paths are claimed from.
+
     This first checks the backup list for any entries and pushes them to the main
-    redis list before returning a generator to that list.
+    redis list before returning a queue of that list. With a lease keeper
+    claimed tests are moved to the worker's in-flight list instead of the
+    backup list.
     """
     redis_list_key = session.config.getoption("redis_list_key")
     backup_list_key = session.config.getoption("redis_backup_list_key")
+    dedupe_key = session.config.getoption("redis_dedupe_key")
 
-    if backup_list_key is not None and redis_connection.llen(backup_list_key) != 0:
-        # Push tests to the main redis list
-        while redis_connection.rpoplpush(backup_list_key, redis_list_key) is not None:
-            continue
+    if is_stream_queue(session.config):
+        # The pending entries of the consumer group replace the backup list
+        if dedupe_key is not None:
+            raise pytest.UsageError("--redis-dedupe-key can't be used with "
+                                    "--redis-queue-type=stream")
+        if session.config.getoption("redis_priority_list_key"):
+            raise pytest.UsageError("--redis-priority-list-key can't be "
+                                    "used with --redis-queue-type=stream")
+        if session.config.getoption("redis_affinity"):
+            raise pytest.UsageError("--redis-affinity can't be used with "
+                                    "--redis-queue-type=stream")
+        claim_idle = session.config.getoption("redis_stream_claim_idle")
+        if claim_idle <= 0:
+            raise pytest.UsageError("--redis-stream-claim-idle must be "
+                                    "positive")
+        test_queue = StreamQueue(redis_connection, redis_list_key,
+                                 session.config.getoption(
+                                     "redis_consumer_group"),
+                                 get_worker_id(session.config),
+                                 claim_idle)
+        test_queue.create_group()
+        return test_queue
 
-    return redis_test_generator(session.config,
-                                redis_connection,
-                                redis_list_key,
-                                backup_list_key=backup_list_key)
+    score_key = get_score_key(session.config)
+    shards = session.config.getoption("redis_shards")
+    if shards < 0:
+        raise pytest.UsageError("--redis-shards must not be negative")
+    if shards and (score_key is not None or lease_keeper is not None or
+                   session.config.getoption("redis_priority_list_key") or
+                   session.config.getoption("redis_affinity")):
+        raise pytest.UsageError("--redis-shards can only be used with a "
+                                "list queue without priority lists, "
+                                "affinity or leases")
+    lanes = get_lanes(session.config)
+    if len(lanes) > 1 and score_key is not None:
+        raise pytest.UsageError("--redis-priority-list-key can't be used "
+                                "with --redis-queue-type=zset")
+    affinity = session.config.getoption("redis_affinity")
+    if affinity and (len(lanes) > 1 or score_key is not None):
+        raise pytest.UsageError("--redis-affinity can only be used with a "
+                                "single list queue")
 
+    claimed_key = None
+    if dedupe_key is not None:
+        # The claimers of restored test paths are gone
+        claimed_key = get_dedupe_claimed_key(dedupe_key)
+    restore_backup_lists(redis_connection, lanes,
+                         get_worker_id(session.config), score_key,
+                         claimed_key)
 
+    claim_list_key = backup_list_key
+    if lease_keeper is not None:
+        claim_list_key = lease_keeper.inflight_key
+
+    if shards:
+        test_queue = ShardedQueue(redis_connection,
+                                  [lane_key for lane_key, _ in lanes],
+                                  [backup_key for _, backup_key in lanes],
+                                  get_home_shard(session.config))
+    elif affinity:
+        test_queue = AffinityQueue(redis_connection, redis_list_key,
+                                   claim_list_key)
+    elif len(lanes) > 1:
+        claim_list_keys = [backup_key for _, backup_key in lanes]
+        if lease_keeper is not None:
+            claim_list_keys = [claim_list_key] * len(lanes)
+        test_queue = LaneQueue(redis_connection,
+                               [lane_key for lane_key, _ in lanes],
+                               claim_list_keys)
+    elif score_key is not None:
+        test_queue = SortedSetQueue(redis_connection, redis_list_key,
+                                    score_key, claim_list_key)
+    else:
+        test_queue = ListQueue(redis_connection, redis_list_key,
+                               claim_list_key)
+    return test_queue
 
 
 def perform_collect_and_run(session):
@@ -93,11 +1423,50 @@ def perform_collect_and_run(session):
     # while running tests as soon as they are found.
     term = TerminalReporter(session.config)
 
+    num_workers = session.config.getoption("redis_workers")
+    if num_workers < 0:
+        raise pytest.UsageError("--redis-workers must not be negative")
+    if num_workers:
+        pool = WorkerPool(session, num_workers)
+        session.items = []
+        session.redis_workers_exitstatus = pool.run()
+        return session.items
+    if session.config.getoption("redis_daemon_key") is not None:
+        daemon = Daemon(session)
+        session.items = []
+        session.redis_workers_exitstatus = daemon.run()
+        return session.items
+
     redis_connection = get_redis_connection(session.config)
 
-    redis_list = populate_test_generator(session,
-                                         redis_connection)
+    collection_cache = None
+    cache_size = session.config.getoption("redis_collection_cache_size")
+    if cache_size < 0:
+        raise pytest.UsageError("--redis-collection-cache-size must not be "
+                                "negative")
+    if cache_size:
+        collection_cache = CollectionCache(session, cache_size)
 
+    lease_keeper = get_lease_keeper(session.config, redis_connection)
+    run_membership = None
+    if session.config.getoption("redis_backup_list_key") is not None and \
+            not is_stream_queue(session.config):
+        run_membership = RunMembership(
+            redis_connection,
+            [backup_key for _, backup_key in get_lanes(session.config)],
+            get_worker_id(session.config))
+    durations_key = session.config.getoption("redis_durations_key")
+    phase_timer = session.config.pluginmanager.getplugin('redis-phase-timer')
+    fleet_stats = session.config.pluginmanager.getplugin('redis-fleet-stats')
+    fleet_abort = session.config.pluginmanager.getplugin('redis-fleet-abort')
+    chunk_queue = None
+    dedupe_queue = None
+    manifest = None
+    if session.config.getoption("redis_manifest_key") is not None:
+        manifest = Manifest(redis_connection,
+                            session.config.getoption("redis_manifest_key"))
+    result_cache = session.config.pluginmanager.getplugin(
+        'redis-result-cache')
 
     default_verbosity = session.config.option.verbose
     hook = session.config.hook
@@ -105,58 +1474,2089 @@ def perform_collect_and_run(session):
     session._initialparts = []
     session._notfound = []
     session.items = []
-    for arg in redis_list:
-        term.write(os.linesep)
-        parts = session._parsearg(arg)
-        session._initialparts.append(parts)
-        session._initialpaths.add(parts[0])
-        arg = "::".join(map(str, parts))
-        session.trace("processing argument", arg)
-        session.trace.root.indent += 1
-        try:
-            for x in session._collect(arg):
-                items = session.genitems(x)
-                new_items = []
-                for item in items:
-                    new_items.append(item)
-
-                # HACK ATTACK: This little hack lets us remove the
-                # 'collected' and 'collecting' messages while still
-                # keeping the default verbosity for the rest of the
-                # run...
-                session.config.option.verbose = -1
-                hook.pytest_collection_modifyitems(session=session,
-                                                   config=session.config,
-                                                   items=new_items)
-                session.config.option.verbose = default_verbosity
-                for item in new_items:
-                    session.items.append(item)
-                    _pytest.runner.pytest_runtest_protocol(item, None)
-        except NoMatch:
-            # we are inside a make_report hook so
-            # we cannot directly pass through the exception
-            raise pytest.UsageError("Could not find" + arg)
-        session.trace.root.indent -= 1
+    bounded_memory = session.config.getoption("redis_bounded_memory")
+    if bounded_memory:
+        session.items = CountingList()
+        reporter = session.config.pluginmanager.getplugin('terminalreporter')
+        if reporter is not None:
+            reporter.stats = CountingStats(reporter.stats)
+    redis_list = None
+    try:
+        if fleet_abort is not None:
+            fleet_abort.check(session)
+        if lease_keeper is not None:
+            lease_keeper.start()
+        test_queue = get_test_queue(session, redis_connection, lease_keeper)
+        if session.config.getoption("redis_dedupe_key") is not None:
+            dedupe_queue = DedupeQueue(test_queue,
+                                       session.config.getoption(
+                                           "redis_dedupe_key"),
+                                       get_worker_id(session.config),
+                                       lease_keeper)
+            test_queue = dedupe_queue
+        if session.config.getoption("redis_chunks"):
+            chunk_queue = ChunkQueue(test_queue,
+                                     session.config.getoption(
+                                         "redis_list_key"),
+                                     get_worker_id(session.config))
+            test_queue = chunk_queue
+        if phase_timer is not None:
+            test_queue = TimedQueue(test_queue, phase_timer)
+        redis_list = populate_test_generator(session,
+                                             redis_connection,
+                                             lease_keeper,
+                                             test_queue)
+        batches = redis_list
+        if phase_timer is not None and \
+                isinstance(redis_list, PrefetchingTestGenerator):
+            # Time spent waiting on the prefetch buffer
+            batches = phase_timer.time_iter('blocked', redis_list)
+        for batch in batches:
+            batch_start = time.time()
+            if fleet_stats is not None:
+                fleet_stats.claim(len(batch))
+            term.write(os.linesep)
+            progress = BatchProgress(batch)
+            new_items = []
+            for arg in batch:
+                items = []
+                for path in (manifest.decode(arg) if manifest is not None
+                             else [arg]):
+                    items.extend(collect_test_path(session, path,
+                                                   collection_cache,
+                                                   phase_timer))
+                progress.add_items(arg, items)
+                new_items.extend(items)
+
+            # HACK ATTACK: This little hack lets us remove the
+            # 'collected' and 'collecting' messages while still
+            # keeping the default verbosity for the rest of the
+            # run...
+            session.config.option.verbose = -1
+            start = time.time()
+            hook.pytest_collection_modifyitems(session=session,
+                                               config=session.config,
+                                               items=new_items)
+            if phase_timer is not None:
+                phase_timer.add('modifyitems', time.time() - start)
+            session.config.option.verbose = default_verbosity
+            finished = progress.expect(new_items)
+            test_queue.acknowledge(finished)
+            if lease_keeper is not None:
+                lease_keeper.acknowledge(finished)
+            cached = set()
+            if result_cache is not None:
+                cached = result_cache.lookup(new_items)
+            if chunk_queue is not None:
+                chunk_queue.publish(new_items)
+            ran = []
+            for index, item in enumerate(new_items):
+                if chunk_queue is not None and not chunk_queue.take(item):
+                    # Another worker stole the rest of the chunk
+                    finished = progress.skip(item)
+                    test_queue.acknowledge(finished)
+                    if lease_keeper is not None:
+                        lease_keeper.acknowledge(finished)
+                    continue
+                if collection_cache is not None:
+                    collection_cache.reset_item(item)
+                session.items.append(item)
+                if id(item) in cached:
+                    result_cache.report_cached(item)
+                else:
+                    if index + 1 < len(new_items):
+                        nextitem = new_items[index + 1]
+                    else:
+                        # Keeps the module and session fixtures of the last
+                        # item set up until the next item or the session
+                        # finishes, which tear down what they don't share.
+                        nextitem = item.parent
+                    start = time.time()
+                    _pytest.runner.pytest_runtest_protocol(item, nextitem)
+                    ran.append(item)
+                    duration = time.time() - start
+                    progress.add_duration(item, duration)
+                    if phase_timer is not None:
+                        phase_timer.add('run', duration)
+                finished = progress.finish(item)
+                test_queue.acknowledge(finished)
+                if lease_keeper is not None:
+                    lease_keeper.acknowledge(finished)
+                if session.shouldstop:
+                    # -x or --maxfail was reached on this worker
+                    unstarted = progress.unstarted()
+                    if chunk_queue is None:
+                        test_queue.give_back(unstarted)
+                    else:
+                        # Their items are given back from the chunk list
+                        finished = list(Counter(unstarted).items())
+                        test_queue.acknowledge(finished)
+                        if lease_keeper is not None:
+                            lease_keeper.acknowledge(finished)
+                        if dedupe_queue is not None:
+                            dedupe_queue.forget(unstarted)
+                    raise session.Interrupted(session.shouldstop)
+            if durations_key is not None:
+                durations = progress.durations()
+                if manifest is not None:
+                    durations = manifest.decode_durations(durations)
+                record_durations(redis_connection, durations_key, durations)
+            if result_cache is not None:
+                result_cache.record(ran)
+            if dedupe_queue is not None:
+                dedupe_queue.flush()
+            if lease_keeper is not None:
+                lease_keeper.flush()
+            if run_membership is not None:
+                run_membership.renew()
+            if fleet_stats is not None:
+                fleet_stats.add_busy(time.time() - batch_start)
+            if fleet_abort is not None:
+                fleet_abort.check(session)
+            if bounded_memory:
+                # Only needed while the batch's test paths are collected
+                session._initialparts = []
+                session._initialpaths = set()
+    finally:
+        if dedupe_queue is not None:
+            # The paths that finished before the batch was interrupted
+            dedupe_queue.flush()
+        # Stops a prefetching generator and hands back what it claimed
+        if redis_list is not None:
+            redis_list.close()
+        if chunk_queue is not None:
+            chunk_queue.release()
+        if lease_keeper is not None:
+            lease_keeper.release()
+        if run_membership is not None:
+            run_membership.leave()
     return session.items
 
 
-def redis_test_generator(config, redis_connection, redis_list_key,
-                         backup_list_key=None):
-    """A generator that pops and returns test paths from the redis list key."""
+class CountingList(list):
+    """A list that only counts the values appended to it.
+
+    Stands in for `session.items` and the terminal reporter's lists of
+    passing reports with --redis-bounded-memory, whose users only take
+    their length.
+    """
+
+    def __init__(self):
+        list.__init__(self)
+        self._count = 0
+
+    def append(self, value):
+        self._count += 1
+
+    def extend(self, values):
+        self._count += len(values)
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        return iter(())
+
+    def __bool__(self):
+        return self._count > 0
+
+    __nonzero__ = __bool__
+
+
+class CountingStats(dict):
+    """The terminal reporter's stats, counting COUNTED_REPORT_CATEGORIES."""
+
+    def __init__(self, stats):
+        dict.__init__(self, stats)
+        for key in COUNTED_REPORT_CATEGORIES:
+            if key in self:
+                counted = CountingList()
+                counted.extend(self[key])
+                self[key] = counted
+
+    def setdefault(self, key, default=None):
+        if key in COUNTED_REPORT_CATEGORIES and key not in self:
+            default = CountingList()
+        return dict.setdefault(self, key, default)
+
+
+class BatchProgress(object):
+    """Track which test paths of a claimed batch have finished running.
+
+    A test path is finished once every item collected from it has run, or
+    as soon as pytest_collection_modifyitems leaves none of its items.
+    Finished paths are returned as (path, copies) tuples, where copies is
+    the number of times the path was claimed in the batch.
+    """
+
+    def __init__(self, batch):
+        self._copies = Counter(batch)
+        self._paths = {}
+        self._pending = Counter()
+        self._expected = Counter()
+        self._durations = Counter()
+        self._partial = set()
+
+    def add_items(self, path, items):
+        """Record the items that were collected from a test path."""
+        for item in items:
+            self._paths[id(item)] = path
+
+    def expect(self, items):
+        """Set the items that will run and return the finished paths."""
+        self._pending = Counter(self._paths.get(id(item)) for item in items)
+        self._expected = Counter(self._pending)
+        return [(path, copies) for path, copies in self._copies.items()
+                if not self._pending[path]]
+
+    def add_duration(self, item, duration):
+        """Add the time an item took to run to its test path."""
+        path = self._paths.get(id(item))
+        if path is not None:
+            self._durations[path] += duration
+
+    def durations(self):
+        """Return the average run time of each test path that fully ran."""
+        return dict((path, duration / self._copies[path])
+                    for path, duration in self._durations.items()
+                    if path not in self._partial)
+
+    def unstarted(self):
+        """Return the claimed test paths none of whose items have run.
+
+        A path is returned once for every time it was claimed.
+        """
+        unstarted = []
+        for path, copies in self._copies.items():
+            if self._pending[path] and \
+                    self._pending[path] == self._expected[path]:
+                unstarted.extend([path] * copies)
+        return unstarted
+
+    def skip(self, item):
+        """Mark an item as run elsewhere and return the paths it finished.
+
+        The durations of the item's test path are no longer recorded.
+        """
+        self._partial.add(self._paths.get(id(item)))
+        return self.finish(item)
+
+    def finish(self, item):
+        """Mark an item as run and return the paths it finished."""
+        path = self._paths.get(id(item))
+        if path is None:
+            return []
+        self._pending[path] -= 1
+        if self._pending[path]:
+            return []
+        return [(path, self._copies[path])]
+
+
+def collect_test_path(session, arg, collection_cache=None, phase_timer=None):
+    """Collect and return the items found for a single test path.
+
+    With a phase timer the time spent collecting nodes and generating
+    their items is recorded. Paths resolved by the collection cache are
+    timed as collect as a whole.
+    """
+    parts = session._parsearg(arg)
+    session._initialparts.append(parts)
+    session._initialpaths.add(parts[0])
+    arg = "::".join(map(str, parts))
+    session.trace("processing argument", arg)
+    session.trace.root.indent += 1
+    items = []
+    try:
+        if collection_cache is not None and parts[0].check(file=1):
+            start = time.time()
+            items = collection_cache.collect(parts[0], parts[1:])
+            if phase_timer is not None:
+                phase_timer.add('collect', time.time() - start)
+        elif phase_timer is not None:
+            nodes = phase_timer.time_iter('collect', session._collect(arg))
+            for x in nodes:
+                start = time.time()
+                items.extend(session.genitems(x))
+                phase_timer.add('genitems', time.time() - start)
+        else:
+            for x in session._collect(arg):
+                items.extend(session.genitems(x))
+    except NoMatch:
+        # we are inside a make_report hook so
+        # we cannot directly pass through the exception
+        raise pytest.UsageError("Could not find" + arg)
+    session.trace.root.indent -= 1
+    return items
+
+
+class CollectionCache(object):
+    """A least recently used cache of collected test files.
+
+    Keeps the file node collected for each path along with the children
+    of every collector below it, so that node ids from a file that was
+    already collected are resolved against the cached tree.
+    """
+
+    def __init__(self, session, max_files):
+        self._session = session
+        self._max_files = max_files
+        # path -> (file nodes, {id(collector): children})
+        self._files = OrderedDict()
+
+    def collect(self, path, names):
+        """Return the items for the node names below the file at `path`."""
+        entry = self._files.pop(path, None)
+        if entry is None:
+            entry = (list(self._session._collectfile(path)), {})
+        self._files[path] = entry
+        while len(self._files) > self._max_files:
+            self._files.popitem(last=False)
+
+        file_nodes, children = entry
+        nodes = self._matchnodes(file_nodes, names, children)
+        if not nodes:
+            raise NoMatch(file_nodes, names[:1])
+        items = []
+        for node in nodes:
+            items.extend(self._genitems(node, children))
+        return items
+
+    def reset_item(self, item):
+        """Clear the state left on a cached item by a previous run."""
+        if hasattr(item, "_initrequest"):
+            item._initrequest()
+        item._report_sections = []
+
+    def _children(self, collector, children):
+        """Return the collected children of a collector."""
+        result = children.get(id(collector))
+        if result is None:
+            rep = collect_one_node(collector)
+            collector.ihook.pytest_collectreport(report=rep)
+            if not rep.passed:
+                # Failed collections are retried and reported again
+                return []
+            result = children[id(collector)] = rep.result
+        return result
+
+    def _matchnodes(self, matching, names, children):
+        # This mirrors Session._matchnodes on top of the cached children
+        if not matching or not names:
+            return matching
+        name = names[0]
+        nextnames = names[1:]
+        resultnodes = []
+        for node in matching:
+            if isinstance(node, pytest.Item):
+                continue
+            has_matched = False
+            subnodes = self._children(node, children)
+            for x in subnodes:
+                if x.name == name or x.name.split("[")[0] == name:
+                    resultnodes.extend(self._matchnodes([x], nextnames,
+                                                        children))
+                    has_matched = True
+            # accept IDs that don't have "()" for class instances
+            if not has_matched and len(subnodes) == 1 and \
+                    subnodes[0].name == "()":
+                resultnodes.extend(self._matchnodes(subnodes,
+                                                    [name] + nextnames,
+                                                    children))
+        return resultnodes
+
+    def _genitems(self, node, children):
+        if isinstance(node, pytest.Item):
+            node.ihook.pytest_itemcollected(item=node)
+            yield node
+        else:
+            for subnode in self._children(node, children):
+                for x in self._genitems(subnode, children):
+                    yield x
+
+
+def redis_test_generator(config, test_queue, batch_size=1,
+                         idle_timeout=None, done_key=None, stopped=None):
+    """A generator that pops and returns batches of test paths.
+
+    Each batch is a list of at most `batch_size` test paths claimed from
+    the test queue in a single round trip. When an `idle_timeout` is
+    given the generator waits for new paths instead of stopping as soon
+    as the queue is empty. Setting the `stopped` event ends the wait.
+    """
     term = TerminalReporter(config)
 
-    val = retrieve_test_from_redis(redis_connection,
-                                   redis_list_key,
-                                   backup_list_key)
+    batch = claim_tests_from_redis(test_queue,
+                                   batch_size,
+                                   idle_timeout,
+                                   done_key,
+                                   stopped)
 
-    if val is None:
-        term.write("No items in redis list '%s'\n" % redis_list_key)
+    if not batch:
+        term.write("No items in redis list '%s'\n" % test_queue.list_key)
 
-    while val is not None:
-        yield val
-        val = retrieve_test_from_redis(redis_connection,
-                                       redis_list_key,
-                                       backup_list_key)
+    while batch:
+        yield batch
+        batch = claim_tests_from_redis(test_queue,
+                                       batch_size,
+                                       idle_timeout,
+                                       done_key,
+                                       stopped)
+
+
+class ListQueue(object):
+    """A queue of test paths held in a redis list.
+
+    Claimed test paths are pushed to `claim_list_key`, the backup list or
+    the worker's in-flight list, if one is given.
+    """
+
+    def __init__(self, redis_connection, list_key, claim_list_key=None):
+        self.redis_connection = redis_connection
+        self.list_key = list_key
+        self.claim_list_key = claim_list_key
+
+    def claim(self, count):
+        """Remove and return up to `count` test paths."""
+        return retrieve_tests_from_redis(self.redis_connection,
+                                         self.list_key,
+                                         self.claim_list_key,
+                                         count)
+
+    def wait(self, idle_timeout, done_key=None, stopped=None):
+        """Block until a test path can be claimed, see `claim`."""
+        return wait_for_test_from_redis(self.redis_connection,
+                                        self.list_key,
+                                        self.claim_list_key,
+                                        idle_timeout,
+                                        done_key,
+                                        stopped)
+
+    def give_back(self, tests):
+        """Give claimed but unrun test paths back to the queue."""
+        return return_tests_to_redis(self.redis_connection,
+                                     self.list_key,
+                                     self.claim_list_key,
+                                     tests)
+
+    def acknowledge(self, finished):
+        """Acknowledge finished (path, copies), see `BatchProgress`.
+
+        List claims stay in the backup list and are acknowledged by the
+        lease keeper when leases are enabled.
+        """
+
+
+class SortedSetQueue(ListQueue):
+    """A queue of test paths held in a redis sorted set.
+
+    The highest scored test paths are claimed first, so scoring each test
+    path with its recorded duration schedules the longest tests first.
+    Test paths that are given back are scored from the `score_key` hash.
+    """
+
+    def __init__(self, redis_connection, list_key, score_key,
+                 claim_list_key=None):
+        ListQueue.__init__(self, redis_connection, list_key, claim_list_key)
+        self.score_key = score_key
+
+    def claim(self, count):
+        keys = [self.list_key]
+        if self.claim_list_key is not None:
+            keys.append(self.claim_list_key)
+        return run_script(self.redis_connection,
+                          CLAIM_HIGHEST_SCORED_TESTS_SCRIPT,
+                          keys,
+                          [count])
+
+    def wait(self, idle_timeout, done_key=None, stopped=None):
+        # Sorted sets have no blocking pop that also moves the entry to a
+        # list, so the sorted set is polled instead.
+        deadline = time.time() + idle_timeout
+        while True:
+            if stopped is not None and stopped.is_set():
+                return None
+            if done_key is not None and \
+                    self.redis_connection.exists(done_key):
+                claimed = self.claim(1)
+                return claimed[0] if claimed else None
+            claimed = self.claim(1)
+            if claimed:
+                return claimed[0]
+            if time.time() >= deadline:
+                return None
+            time.sleep(SORTED_SET_POLL_INTERVAL)
+
+    def give_back(self, tests):
+        if not tests:
+            return 0
+        keys = [self.list_key, self.score_key]
+        if self.claim_list_key is not None:
+            keys.append(self.claim_list_key)
+        return run_script(self.redis_connection,
+                          RETURN_TESTS_TO_SORTED_SET_SCRIPT,
+                          keys,
+                          tests)
+
+
+class LaneQueue(ListQueue):
+    """A queue of test paths held in redis lists consumed by priority.
+
+    A batch is filled from the first non-empty list before the next one
+    in a single round trip, however many lists are empty. Every list has
+    its own claim list, the list's backup list or the worker's in-flight
+    list, and test paths that are given back return to their list.
+    """
+
+    def __init__(self, redis_connection, lane_keys, claim_list_keys):
+        ListQueue.__init__(self, redis_connection, lane_keys[-1])
+        self.lane_keys = lane_keys
+        self.claim_list_keys = claim_list_keys
+        self._claimed_lanes = {}
+
+    def _has_claim_lists(self):
+        return self.claim_list_keys[0] is not None
+
+    def claim(self, count):
+        keys = list(self.lane_keys)
+        if self._has_claim_lists():
+            keys.extend(self.claim_list_keys)
+        claimed = run_script(self.redis_connection,
+                             CLAIM_TESTS_FROM_LANES_SCRIPT,
+                             keys,
+                             [count, 1 if self._has_claim_lists() else 0])
+        tests = []
+        for lane, path in zip(claimed[::2], claimed[1::2]):
+            self._claimed_lanes.setdefault(path, []).append(int(lane) - 1)
+            tests.append(path)
+        return tests
+
+    def wait(self, idle_timeout, done_key=None, stopped=None):
+        deadline = time.time() + idle_timeout
+        while True:
+            if stopped is not None and stopped.is_set():
+                return None
+            if done_key is not None and \
+                    self.redis_connection.exists(done_key):
+                claimed = self.claim(1)
+                return claimed[0] if claimed else None
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            if self._has_claim_lists():
+                # A blocking pop can't push the entry to the backup list
+                # of whichever list it came from, so the lists are polled.
+                claimed = self.claim(1)
+                if claimed:
+                    return claimed[0]
+                time.sleep(min(SORTED_SET_POLL_INTERVAL, remaining))
+                continue
+            timeout = max(1, int(min(BLOCKING_POP_INTERVAL, remaining)))
+            popped = self.redis_connection.brpop(self.lane_keys, timeout)
+            if popped is not None:
+                lane_key, path = popped
+                if not isinstance(lane_key, str):
+                    lane_key = lane_key.decode('utf-8')
+                self._claimed_lanes.setdefault(path, []).append(
+                    self.lane_keys.index(lane_key))
+                return path
+
+    def _take_lane(self, path):
+        lanes = self._claimed_lanes.get(path)
+        if not lanes:
+            return len(self.lane_keys) - 1
+        lane = lanes.pop(0)
+        if not lanes:
+            del self._claimed_lanes[path]
+        return lane
+
+    def give_back(self, tests):
+        if not tests:
+            return 0
+        lane_tests = OrderedDict()
+        for path in tests:
+            lane_tests.setdefault(self._take_lane(path), []).append(path)
+        for lane, paths in lane_tests.items():
+            return_tests_to_redis(self.redis_connection,
+                                  self.lane_keys[lane],
+                                  self.claim_list_keys[lane],
+                                  paths)
+        return len(tests)
+
+    def acknowledge(self, finished):
+        for path, copies in finished:
+            for _ in range(copies):
+                self._take_lane(path)
+
+
+class ShardedQueue(LaneQueue):
+    """A queue of test paths spread over hash tagged shard lists.
+
+    A worker claims from its home shard first and steals from the other
+    shards, in order, once its home shard is empty. Every claim touches a
+    single shard and its backup list, which share a hash tag, so that the
+    shards can live on different redis cluster nodes. Test paths that are
+    given back return to their shard.
+    """
+
+    def __init__(self, redis_connection, shard_keys, claim_list_keys,
+                 home_shard):
+        LaneQueue.__init__(self, redis_connection, shard_keys,
+                           claim_list_keys)
+        self.home_shard = home_shard
+
+    def claim(self, count):
+        for offset in range(len(self.lane_keys)):
+            shard = (self.home_shard + offset) % len(self.lane_keys)
+            tests = retrieve_tests_from_redis(self.redis_connection,
+                                              self.lane_keys[shard],
+                                              self.claim_list_keys[shard],
+                                              count)
+            if tests:
+                for path in tests:
+                    self._claimed_lanes.setdefault(path, []).append(shard)
+                return tests
+        return []
+
+    def wait(self, idle_timeout, done_key=None, stopped=None):
+        # A blocking pop would wait on the home shard only, so the shards
+        # are polled.
+        deadline = time.time() + idle_timeout
+        while True:
+            if stopped is not None and stopped.is_set():
+                return None
+            claimed = self.claim(1)
+            if claimed:
+                return claimed[0]
+            if done_key is not None and \
+                    self.redis_connection.exists(done_key):
+                return None
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            time.sleep(min(SORTED_SET_POLL_INTERVAL, remaining))
+
+
+class AffinityQueue(ListQueue):
+    """A queue of test paths grouped in lists by the fixtures they share.
+
+    Test paths that share expensive fixtures are pushed to a common
+    affinity list by the producer. A worker claims from the affinity lists
+    it already claimed from first, whose fixtures it has set up, then from
+    the redis list and then takes over the longest affinity list, all in a
+    single round trip. Test paths that are given back return to their list.
+    """
+
+    def __init__(self, redis_connection, list_key, claim_list_key=None):
+        ListQueue.__init__(self, redis_connection, list_key, claim_list_key)
+        self.affinity_set_key = get_affinity_set_key(list_key)
+        self._preferred = []
+        self._claimed_sources = {}
+
+    def claim(self, count):
+        keys = [self.affinity_set_key, self.list_key]
+        if self.claim_list_key is not None:
+            keys.append(self.claim_list_key)
+        claimed = run_script(self.redis_connection,
+                             CLAIM_TESTS_WITH_AFFINITY_SCRIPT,
+                             keys,
+                             [count] + self._preferred)
+        tests = []
+        for source, path in zip(claimed[::2], claimed[1::2]):
+            if not isinstance(source, str):
+                source = source.decode('utf-8')
+            if source != self.list_key and source not in self._preferred:
+                self._preferred.append(source)
+            self._claimed_sources.setdefault(path, []).append(source)
+            tests.append(path)
+        return tests
+
+    def wait(self, idle_timeout, done_key=None, stopped=None):
+        # A blocking pop can't wait on lists that are added to the set
+        # later, so the lists are polled.
+        deadline = time.time() + idle_timeout
+        while True:
+            if stopped is not None and stopped.is_set():
+                return None
+            if done_key is not None and \
+                    self.redis_connection.exists(done_key):
+                claimed = self.claim(1)
+                return claimed[0] if claimed else None
+            claimed = self.claim(1)
+            if claimed:
+                return claimed[0]
+            if time.time() >= deadline:
+                return None
+            time.sleep(SORTED_SET_POLL_INTERVAL)
+
+    def _take_source(self, path):
+        sources = self._claimed_sources.get(path)
+        if not sources:
+            return self.list_key
+        source = sources.pop(0)
+        if not sources:
+            del self._claimed_sources[path]
+        return source
+
+    def give_back(self, tests):
+        if not tests:
+            return 0
+        source_tests = OrderedDict()
+        for path in tests:
+            source_tests.setdefault(self._take_source(path), []).append(path)
+        for source, paths in source_tests.items():
+            return_tests_to_redis(self.redis_connection, source,
+                                  self.claim_list_key, paths)
+            if source != self.list_key:
+                self.redis_connection.sadd(self.affinity_set_key, source)
+        return len(tests)
+
+    def acknowledge(self, finished):
+        for path, copies in finished:
+            for _ in range(copies):
+                self._take_source(path)
+
+
+class Manifest(object):
+    """Decode the integers and ranges pushed by pytest-redis-enqueue --encode.
+
+    The manifest is loaded once, the first time an encoded value is
+    claimed. A value of `i` stands for the entry at index `i` of the
+    manifest and `i-j` for the entries from `i` to `j` inclusive. Any other
+    value, such as a test path given back by a chunk thief, is a test path
+    of its own.
+    """
+
+    def __init__(self, redis_connection, manifest_key):
+        self._redis_connection = redis_connection
+        self.manifest_key = manifest_key
+        self._entries = None
+
+    def get_entries(self):
+        """Return the entries of the manifest, loading it if needed."""
+        if self._entries is None:
+            manifest = self._redis_connection.get(self.manifest_key)
+            if manifest is None:
+                raise pytest.UsageError("the manifest '{}' does not "
+                                        "exist".format(self.manifest_key))
+            self._entries = json.loads(
+                zlib.decompress(manifest).decode('utf-8'))['entries']
+        return self._entries
+
+    def get_indexes(self, value):
+        """Return the (first, last) indexes of a value, or None."""
+        if not isinstance(value, str):
+            value = value.decode('utf-8')
+        first, _, last = value.partition('-')
+        if not first.isdigit() or not (last or first).isdigit():
+            return None
+        return int(first), int(last or first)
+
+    def decode(self, value):
+        """Return the test paths a claimed value stands for."""
+        indexes = self.get_indexes(value)
+        if indexes is None:
+            return [value]
+        return self.get_entries()[indexes[0]:indexes[1] + 1]
+
+    def decode_durations(self, durations):
+        """Key the durations of values that stand for one path by the path.
+
+        The durations of ranges are left out since they can't be split
+        between their paths.
+        """
+        decoded = {}
+        for value, duration in durations.items():
+            paths = self.decode(value)
+            if len(paths) == 1:
+                decoded[paths[0]] = duration
+        return decoded
+
+
+class DedupeQueue(object):
+    """Wrap a test queue so that every test path runs once per run.
+
+    Claimed test paths are marked as held by the worker in the run's
+    claimed hash by the same script that checks them against the run's
+    finished set, in one round trip per claim. Test paths that finished,
+    that another live worker holds, or that were claimed more than once in
+    the same batch, are acknowledged and dropped without running. Finished
+    test paths are added to the finished set once per batch by `flush`.
+    """
+
+    def __init__(self, test_queue, dedupe_key, worker_id, lease_keeper=None):
+        self._test_queue = test_queue
+        self._redis_connection = test_queue.redis_connection
+        self._worker_id = worker_id
+        self._lease_keeper = lease_keeper
+        # Holders without a lease are live until their claims are restored
+        self._lease_prefix = ''
+        if lease_keeper is not None:
+            self._lease_prefix = get_lease_key(test_queue.list_key, '')
+        self._finished = []
+        self.finished_key = get_dedupe_finished_key(dedupe_key)
+        self.claimed_key = get_dedupe_claimed_key(dedupe_key)
+
+    def __getattr__(self, name):
+        return getattr(self._test_queue, name)
+
+    def _drop_finished(self, tests):
+        """Return the tests this worker can run and drop the others."""
+        kept = run_script(self._redis_connection, CLAIM_UNFINISHED_SCRIPT,
+                          [self.finished_key, self.claimed_key],
+                          [self._worker_id, self._lease_prefix,
+                           DEDUPE_KEY_TTL] + list(tests))
+        dropped = Counter(tests)
+        dropped.subtract(Counter(kept))
+        dropped = [(path, copies) for path, copies in dropped.items()
+                   if copies]
+        if dropped:
+            self._test_queue.acknowledge(dropped)
+            if self._lease_keeper is not None:
+                self._lease_keeper.acknowledge(dropped)
+        return kept
+
+    def claim(self, count):
+        """Claim up to `count` test paths that haven't finished."""
+        tests = self._test_queue.claim(count)
+        while tests:
+            kept = self._drop_finished(tests)
+            if kept:
+                return kept
+            tests = self._test_queue.claim(count)
+        return tests
+
+    def wait(self, idle_timeout, done_key=None, stopped=None):
+        """Block until a test path that hasn't finished can be claimed."""
+        while True:
+            test = self._test_queue.wait(idle_timeout, done_key, stopped)
+            if test is None or self._drop_finished([test]):
+                return test
+
+    def give_back(self, tests):
+        """Release the worker's hold on unrun tests and give them back."""
+        if tests:
+            # Released first so that no live holder drops them
+            run_script(self._redis_connection, RELEASE_CLAIMED_SCRIPT,
+                       [self.claimed_key], [self._worker_id] + list(tests))
+        self._test_queue.give_back(tests)
+
+    def acknowledge(self, finished):
+        """Acknowledge finished (path, copies) until the next flush."""
+        self._test_queue.acknowledge(finished)
+        self._finished.extend(path for path, _ in finished)
+
+    def forget(self, paths):
+        """Don't add acknowledged paths that never ran to the index."""
+        paths = set(paths)
+        self._finished = [path for path in self._finished
+                          if path not in paths]
+
+    def flush(self):
+        """Add the paths acknowledged since the last flush to the index."""
+        if not self._finished:
+            return
+        pipe = self._redis_connection.pipeline(transaction=False)
+        pipe.sadd(self.finished_key, *self._finished)
+        pipe.expire(self.finished_key, DEDUPE_KEY_TTL)
+        pipe.hdel(self.claimed_key, *self._finished)
+        pipe.execute()
+        self._finished = []
+
+
+class ChunkQueue(object):
+    """Wrap a test queue so that claimed chunks can be stolen.
+
+    The items collected from a claimed batch are published to the
+    worker's chunk list and the worker pops them from the head of that
+    list, `CHUNK_TAKE_SIZE` at a time, before running them. Once the
+    wrapped queue is empty, workers steal the second half of the longest
+    chunk list of another worker from its tail into their claim list, and
+    publish the stolen items in turn. Chunk lists left behind by crashed
+    workers are stolen the same way.
+    """
+
+    def __init__(self, test_queue, list_key, worker_id):
+        self._test_queue = test_queue
+        self._redis_connection = test_queue.redis_connection
+        self.chunk_set_key = get_chunk_set_key(list_key)
+        self.chunk_list_key = get_chunk_list_key(list_key, worker_id)
+        claim_list_keys = getattr(test_queue, 'claim_list_keys', None)
+        if claim_list_keys:
+            # Test paths that aren't from a known lane are given back to
+            # the last one
+            self.claim_list_key = claim_list_keys[-1]
+        else:
+            self.claim_list_key = getattr(test_queue, 'claim_list_key', None)
+        self._taken = []
+        self._drained = True
+
+    def __getattr__(self, name):
+        return getattr(self._test_queue, name)
+
+    def claim(self, count):
+        """Claim from the wrapped queue, stealing once it is empty."""
+        tests = self._test_queue.claim(count)
+        if tests:
+            return tests
+        keys = [self.chunk_set_key]
+        if self.claim_list_key is not None:
+            keys.append(self.claim_list_key)
+        return run_script(self._redis_connection, STEAL_CHUNK_SCRIPT,
+                          keys, [self.chunk_list_key])
+
+    def publish(self, items):
+        """Publish the items that are about to run so they can be stolen."""
+        if not items:
+            return
+        pipe = self._redis_connection.pipeline(transaction=False)
+        pipe.rpush(self.chunk_list_key, *[item.nodeid for item in items])
+        pipe.sadd(self.chunk_set_key, self.chunk_list_key)
+        pipe.execute()
+        self._drained = False
+
+    def take(self, item):
+        """Return whether the item is still this worker's to run."""
+        if not self._taken and not self._drained:
+            self._taken = run_script(self._redis_connection,
+                                     TAKE_CHUNK_SCRIPT,
+                                     [self.chunk_list_key],
+                                     [CHUNK_TAKE_SIZE])
+            # Thieves take from the tail, so the rest was stolen
+            self._drained = len(self._taken) < CHUNK_TAKE_SIZE
+        if not self._taken:
+            return False
+        self._taken.pop(0)
+        return True
+
+    def release(self):
+        """Give the unrun items of the chunk back to the queue."""
+        remaining = run_script(self._redis_connection, RELEASE_CHUNK_SCRIPT,
+                               [self.chunk_list_key, self.chunk_set_key])
+        unrun = self._taken + list(remaining)
+        self._taken = []
+        if unrun:
+            self._test_queue.give_back(unrun)
+
+
+class StreamQueue(object):
+    """A queue of test paths held in a redis stream.
+
+    Test paths are read through a consumer group, which tracks the entries
+    every consumer has read but not yet acknowledged. Entries are
+    acknowledged and deleted once their tests ran, and entries that stayed
+    unacknowledged for `claim_idle` seconds, such as those of a crashed
+    consumer, are claimed with XAUTOCLAIM before new entries are read.
+    """
+
+    def __init__(self, redis_connection, stream_key, group, consumer,
+                 claim_idle):
+        self.redis_connection = redis_connection
+        self.list_key = stream_key
+        self.group = group
+        self.consumer = consumer
+        self._claim_idle = int(claim_idle * 1000)
+        self._claim_cursor = '0-0'
+        # Entries this consumer read before it restarted are read first,
+        # from after the last of them read so far, until none are left
+        self._own_pending_cursor = '0'
+        self._pending = {}
+
+    def create_group(self):
+        """Create the consumer group and the stream if they don't exist."""
+        try:
+            self.redis_connection.execute_command(
+                'XGROUP', 'CREATE', self.list_key, self.group, '0',
+                'MKSTREAM')
+        except redis.ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    def _add_pending(self, entries):
+        """Remember the ids of read entries and return their test paths."""
+        tests = []
+        for entry in entries:
+            if entry is None:
+                # Redis 6.2 claims entries that were deleted as nil
+                continue
+            entry_id, fields = entry
+            if not fields:
+                # The entry was deleted while it was pending
+                self.redis_connection.execute_command(
+                    'XACK', self.list_key, self.group, entry_id)
+                continue
+            values = dict(zip(fields[::2], fields[1::2]))
+            path = values.get(STREAM_PATH_FIELD,
+                              values.get(STREAM_PATH_FIELD.encode('utf-8')))
+            self._pending.setdefault(path, []).append(entry_id)
+            tests.append(path)
+        return tests
+
+    def _read_entries(self, count, entry_id='>', block=None):
+        args = ['XREADGROUP', 'GROUP', self.group, self.consumer,
+                'COUNT', count]
+        if block is not None:
+            args.extend(['BLOCK', block])
+        args.extend(['STREAMS', self.list_key, entry_id])
+        reply = self.redis_connection.execute_command(*args)
+        if not reply:
+            return []
+        return reply[0][1]
+
+    def _read(self, count, entry_id='>', block=None):
+        return self._add_pending(self._read_entries(count, entry_id, block))
+
+    def _read_own_pending(self, count):
+        entries = self._read_entries(count, self._own_pending_cursor)
+        if len(entries) < count:
+            self._own_pending_cursor = None
+        else:
+            self._own_pending_cursor = entries[-1][0]
+        return self._add_pending(entries)
+
+    def _autoclaim(self, count):
+        reply = self.redis_connection.execute_command(
+            'XAUTOCLAIM', self.list_key, self.group, self.consumer,
+            self._claim_idle, self._claim_cursor, 'COUNT', count)
+        self._claim_cursor = reply[0]
+        return self._add_pending(reply[1])
+
+    def claim(self, count):
+        """Read up to `count` test paths, stalled ones first."""
+        tests = []
+        if self._own_pending_cursor is not None:
+            tests = self._read_own_pending(count)
+        if len(tests) < count:
+            tests.extend(self._autoclaim(count - len(tests)))
+        if len(tests) < count:
+            tests.extend(self._read(count - len(tests)))
+        return tests
+
+    def wait(self, idle_timeout, done_key=None, stopped=None):
+        """Block until a test path can be read, see `claim`."""
+        deadline = time.time() + idle_timeout
+        while True:
+            if stopped is not None and stopped.is_set():
+                return None
+            if done_key is not None and \
+                    self.redis_connection.exists(done_key):
+                claimed = self.claim(1)
+                return claimed[0] if claimed else None
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            claimed = self._autoclaim(1)
+            if not claimed:
+                timeout = min(BLOCKING_POP_INTERVAL, remaining)
+                claimed = self._read(1, block=max(1, int(timeout * 1000)))
+            if claimed:
+                return claimed[0]
+
+    def _take_ids(self, path, copies):
+        ids = self._pending.get(path, [])
+        taken, self._pending[path] = ids[:copies], ids[copies:]
+        if not self._pending[path]:
+            del self._pending[path]
+        return taken
+
+    def give_back(self, tests):
+        """Add unrun test paths to the stream again and acknowledge them."""
+        if not tests:
+            return 0
+        pipe = self.redis_connection.pipeline()
+        for path in tests:
+            pipe.execute_command('XADD', self.list_key, '*',
+                                 STREAM_PATH_FIELD, path)
+            for entry_id in self._take_ids(path, 1):
+                pipe.execute_command('XACK', self.list_key, self.group,
+                                     entry_id)
+                pipe.execute_command('XDEL', self.list_key, entry_id)
+        pipe.execute()
+        return len(tests)
+
+    def acknowledge(self, finished):
+        """Acknowledge and delete the entries of finished (path, copies)."""
+        entry_ids = []
+        for path, copies in finished:
+            entry_ids.extend(self._take_ids(path, copies))
+        if not entry_ids:
+            return
+        pipe = self.redis_connection.pipeline(transaction=False)
+        pipe.execute_command('XACK', self.list_key, self.group, *entry_ids)
+        pipe.execute_command('XDEL', self.list_key, *entry_ids)
+        pipe.execute()
+
+
+class TimedQueue(object):
+    """Wrap a test queue, timing its claims as pop and waits as idle."""
+
+    def __init__(self, test_queue, phase_timer):
+        self._test_queue = test_queue
+        self._phase_timer = phase_timer
+
+    def __getattr__(self, name):
+        return getattr(self._test_queue, name)
+
+    def claim(self, count):
+        start = time.time()
+        try:
+            return self._test_queue.claim(count)
+        finally:
+            self._phase_timer.add('pop', time.time() - start)
+
+    def wait(self, idle_timeout, done_key=None, stopped=None):
+        start = time.time()
+        try:
+            return self._test_queue.wait(idle_timeout, done_key, stopped)
+        finally:
+            self._phase_timer.add('idle', time.time() - start)
+
+
+class PrefetchingTestGenerator(object):
+    """Claim batches of test paths from a background thread.
+
+    Wraps a batch generator such as `redis_test_generator` and keeps up
+    to `max_batches` claimed batches in a local buffer so that the
+    collect and run loop doesn't wait on redis while work remains. The
+    `stopped` event, if given, should also be passed to the wrapped
+    generator so that closing interrupts a blocking wait.
+    """
+
+    _done = object()
+
+    def __init__(self, generator, test_queue, max_batches, stopped=None):
+        self._generator = generator
+        self._test_queue = test_queue
+        self._buffer = queue.Queue(maxsize=max_batches)
+        self._stopped = stopped or threading.Event()
+        self._unrun = []
+        self._error = None
+        self._thread = threading.Thread(target=self._fill,
+                                        name='pytest-redis-prefetch')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, value):
+        """Put a value in the buffer unless the generator is closed."""
+        while not self._stopped.is_set():
+            try:
+                self._buffer.put(value, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _fill(self):
+        """Fill the local buffer from the wrapped generator."""
+        try:
+            for batch in self._generator:
+                if not self._put(batch):
+                    self._unrun.extend(batch)
+                    return
+        except Exception as e:
+            self._error = e
+        finally:
+            self._put(self._done)
+
+    def __iter__(self):
+        while True:
+            batch = self._buffer.get()
+            if batch is self._done:
+                if self._error is not None:
+                    raise self._error
+                return
+            yield batch
+
+    def close(self):
+        """Stop prefetching and return claimed but unrun tests to redis."""
+        self._stopped.set()
+        self._thread.join()
+        unrun = []
+        while True:
+            try:
+                batch = self._buffer.get_nowait()
+            except queue.Empty:
+                break
+            if batch is not self._done:
+                unrun.extend(batch)
+        # The batch held by the thread was claimed after the buffered ones
+        unrun.extend(self._unrun)
+        self._unrun = []
+        self._test_queue.give_back(unrun)
+
+
+class LeaseKeeper(threading.Thread):
+    """Keep a worker's lease on its in-flight tests alive.
+
+    Claimed test paths are moved to a per worker in-flight list and are
+    only removed from it once they have run, a batch at a time by `flush`.
+    The lease is renewed every third of `lease_timeout` and the leases of
+    other workers are checked every `lease_timeout`, pushing the in-flight
+    tests of crashed workers back to the redis list.
+    """
+
+    def __init__(self, redis_connection, list_key, backup_list_key,
+                 worker_id, lease_timeout, score_key=None):
+        threading.Thread.__init__(self, name='pytest-redis-lease')
+        self.daemon = True
+        self.worker_id = worker_id
+        self.inflight_key = get_inflight_list_key(list_key, worker_id)
+        self._redis_connection = redis_connection
+        self._list_key = list_key
+        self._backup_list_key = backup_list_key
+        self._lease_key = get_lease_key(list_key, worker_id)
+        self._lease_timeout = lease_timeout
+        self._score_key = score_key
+        self._stopped = threading.Event()
+        # Acknowledged from the prefetch thread as well
+        self._finished_lock = threading.Lock()
+        self._finished = []
+
+    def start(self):
+        """Take the lease, reap expired leases and start renewing."""
+        self.renew()
+        reap_expired_leases(self._redis_connection, self._list_key,
+                            self._score_key)
+        threading.Thread.start(self)
+
+    def renew(self):
+        """Take or renew the lease of this worker."""
+        pipe = self._redis_connection.pipeline()
+        pipe.sadd(get_worker_set_key(self._list_key), self.worker_id)
+        pipe.set(self._lease_key, self.worker_id,
+                 px=int(self._lease_timeout * 1000))
+        pipe.execute()
+
+    def run(self):
+        interval = self._lease_timeout / 3.0
+        last_reap = time.time()
+        while not self._stopped.wait(interval):
+            self.renew()
+            if time.time() - last_reap >= self._lease_timeout:
+                reap_expired_leases(self._redis_connection, self._list_key,
+                                    self._score_key)
+                last_reap = time.time()
+
+    def acknowledge(self, finished):
+        """Acknowledge finished (path, copies) until the next flush."""
+        with self._finished_lock:
+            self._finished.extend(finished)
+
+    def flush(self):
+        """Remove the tests acknowledged since the last flush at once."""
+        with self._finished_lock:
+            finished, self._finished = self._finished, []
+        if not finished:
+            return
+        keys = [self.inflight_key]
+        if self._backup_list_key is not None:
+            keys.append(self._backup_list_key)
+        args = []
+        for path, copies in finished:
+            args.extend([path, copies])
+        run_script(self._redis_connection, ACKNOWLEDGE_TESTS_SCRIPT,
+                   keys, args)
+
+    def release(self):
+        """Stop renewing and push unfinished tests back to the list."""
+        self._stopped.set()
+        if self.is_alive():
+            self.join()
+        self.flush()
+        release_worker(self._redis_connection, self._list_key,
+                       self.worker_id, force=True, score_key=self._score_key)
+
+
+class StreamReporter(object):
+    """Add a compact result of every test to a redis stream.
+
+    Results are buffered and added in a single pipelined round trip once
+    `batch_size` of them are buffered, once the oldest buffered result is
+    `REPORT_FLUSH_INTERVAL` seconds old and when the session finishes.
+    """
+
+    def __init__(self, config, stream_key, batch_size, longrepr_length):
+        self._config = config
+        self._stream_key = stream_key
+        self._batch_size = batch_size
+        self._longrepr_length = longrepr_length
+        self._buffer = []
+        self._buffered_since = None
+
+    def pytest_runtest_logreport(self, report):
+        # A test has a single result: its call, or the setup or teardown
+        # that didn't pass.
+        if report.when != 'call' and report.passed:
+            return
+        self._buffer.append(self.get_result(report))
+        if self._buffered_since is None:
+            self._buffered_since = time.time()
+        if len(self._buffer) >= self._batch_size or \
+                time.time() - self._buffered_since >= REPORT_FLUSH_INTERVAL:
+            self.flush()
+
+    def pytest_sessionfinish(self, session):
+        self.flush()
+
+    def get_result(self, report):
+        """Return the stream fields of a test report."""
+        longrepr = ''
+        if report.skipped and isinstance(report.longrepr, tuple):
+            longrepr = report.longrepr[-1]
+        elif report.longrepr is not None:
+            longrepr = str(report.longrepr)
+        return ['nodeid', report.nodeid,
+                'outcome', report.outcome,
+                'when', report.when,
+                'duration', repr(report.duration),
+                'longrepr', longrepr[:self._longrepr_length]]
+
+    def flush(self):
+        """Add the buffered results to the stream."""
+        if not self._buffer:
+            return
+        # The worker id is looked up here so that forked consumers use
+        # their own.
+        worker_id = get_worker_id(self._config)
+        pipe = get_redis_connection(self._config).pipeline(
+            transaction=False)
+        for fields in self._buffer:
+            pipe.execute_command('XADD', self._stream_key, '*',
+                                 'worker', worker_id, *fields)
+        pipe.execute()
+        self._buffer = []
+        self._buffered_since = None
+
+
+class ResultCache(object):
+    """Skip tests that passed before with the same inputs.
+
+    A test's fingerprint is a hash of its node id, its module, the
+    conftests that apply to it and the dependency files. Passing tests
+    are recorded under `<key_prefix>:<fingerprint>` for `ttl` seconds and
+    tests whose fingerprint is recorded are reported as passed without
+    running them. Every file is hashed once per session.
+    """
+
+    def __init__(self, config, key_prefix, ttl, dependency_patterns):
+        self._config = config
+        self._key_prefix = key_prefix
+        self._ttl = ttl
+        self._dependency_patterns = dependency_patterns
+        self._dependencies_digest = None
+        self._file_digests = {}
+        self._conftest_digests = {}
+        self._failed = set()
+
+    def reset(self):
+        """Forget the file digests and failures of the last run."""
+        self._dependencies_digest = None
+        self._file_digests = {}
+        self._conftest_digests = {}
+        self._failed = set()
+
+    def _file_digest(self, path):
+        """Return the memoized hash of a file's contents."""
+        path = str(path)
+        digest = self._file_digests.get(path)
+        if digest is None:
+            file_hash = hashlib.sha1()
+            with open(path, 'rb') as hashed_file:
+                chunk = hashed_file.read(FILE_HASH_CHUNK_SIZE)
+                while chunk:
+                    file_hash.update(chunk)
+                    chunk = hashed_file.read(FILE_HASH_CHUNK_SIZE)
+            digest = file_hash.hexdigest()
+            self._file_digests[path] = digest
+        return digest
+
+    def _get_dependencies_digest(self):
+        if self._dependencies_digest is None:
+            paths = set()
+            for pattern in self._dependency_patterns:
+                paths.update(glob.glob(pattern))
+            digests = ["{}={}".format(path, self._file_digest(path))
+                       for path in sorted(paths) if os.path.isfile(path)]
+            self._dependencies_digest = hashlib.sha1(
+                "\n".join(digests).encode('utf-8')).hexdigest()
+        return self._dependencies_digest
+
+    def _get_conftest_digest(self, directory):
+        digest = self._conftest_digests.get(directory)
+        if digest is None:
+            conftests = self._config.pluginmanager._getconftestmodules(
+                directory)
+            digests = []
+            for conftest in conftests:
+                path = conftest.__file__
+                if path.endswith(('.pyc', '.pyo')):
+                    path = path[:-1]
+                digests.append(self._file_digest(path))
+            digest = hashlib.sha1(
+                "\n".join(digests).encode('utf-8')).hexdigest()
+            self._conftest_digests[directory] = digest
+        return digest
+
+    def get_key(self, item):
+        """Return the result cache key of an item."""
+        fingerprint = hashlib.sha1()
+        for part in (item.nodeid,
+                     self._file_digest(item.fspath),
+                     self._get_conftest_digest(item.fspath.dirpath()),
+                     self._get_dependencies_digest()):
+            fingerprint.update(part.encode('utf-8'))
+            fingerprint.update(b'\0')
+        return "{}:{}".format(self._key_prefix, fingerprint.hexdigest())
+
+    def lookup(self, items):
+        """Return the ids of the items that passed with the same inputs."""
+        if not items:
+            return set()
+        values = get_redis_connection(self._config).mget(
+            [self.get_key(item) for item in items])
+        return set(id(item) for item, value in zip(items, values)
+                   if value is not None)
+
+    def report_cached(self, item):
+        """Report a cached item as passed without running it."""
+        hook = item.ihook
+        hook.pytest_runtest_logstart(nodeid=item.nodeid,
+                                     location=item.location)
+        keywords = dict((keyword, 1) for keyword in item.keywords)
+        for when in ('setup', 'call', 'teardown'):
+            report = _pytest.runner.TestReport(item.nodeid, item.location,
+                                               keywords, 'passed', None,
+                                               when)
+            report.redis_cached = True
+            hook.pytest_runtest_logreport(report=report)
+
+    def pytest_runtest_logreport(self, report):
+        if not report.passed or hasattr(report, 'wasxfail'):
+            self._failed.add(report.nodeid)
+
+    def pytest_report_teststatus(self, report):
+        if getattr(report, 'redis_cached', False) and report.when == 'call':
+            return 'passed', 'c', 'CACHED'
+
+    def record(self, items):
+        """Record the items that passed in the result cache."""
+        pipe = get_redis_connection(self._config).pipeline(
+            transaction=False)
+        for item in items:
+            if item.nodeid in self._failed:
+                self._failed.discard(item.nodeid)
+                continue
+            pipe.set(self.get_key(item), 1, ex=self._ttl)
+        pipe.execute()
+
+
+class FleetAbort(object):
+    """Stop every worker of a run once they failed too many tests.
+
+    Failures are added to a counter shared by the workers, and the abort
+    key is set once the counter reaches --maxfail. Workers check the abort
+    key between batches, leaving the tests they haven't claimed in the
+    queue.
+    """
+
+    def __init__(self, config, abort_key):
+        self._config = config
+        self._abort_key = abort_key
+
+    def pytest_runtest_logreport(self, report):
+        # The failures session.testsfailed counts
+        if not report.failed or hasattr(report, 'wasxfail'):
+            return
+        reason = "{} failed tests, the last one on {}".format(
+            self._config.getvalue("maxfail"),
+            get_worker_id(self._config))
+        run_script(get_redis_connection(self._config),
+                   RECORD_FAILURES_SCRIPT,
+                   [get_failure_count_key(self._abort_key),
+                    self._abort_key],
+                   [1, self._config.getvalue("maxfail"), reason])
+
+    def check(self, session):
+        """Stop the session if the abort key is set."""
+        reason = get_redis_connection(self._config).get(self._abort_key)
+        if reason is None:
+            return
+        if not isinstance(reason, str):
+            reason = reason.decode('utf-8', 'replace')
+        raise session.Interrupted("run aborted: " + reason)
+
+
+class FleetStats(object):
+    """Keep counters of this worker's progress in a redis hash.
+
+    The tests the worker claimed, passed, failed and skipped and the
+    seconds it spent collecting and running batches are buffered and
+    added to the hash in a single pipelined round trip at most every
+    `STATS_FLUSH_INTERVAL` seconds, and when the session finishes.
+    """
+
+    def __init__(self, config, list_key):
+        self._config = config
+        self._list_key = list_key
+        self._counts = Counter()
+        self._busy = 0.0
+        self._flushed_at = time.time()
+        self._started = None
+
+    def claim(self, count):
+        """Count `count` claimed test paths."""
+        if self._started is None:
+            self._started = time.time()
+        self._counts['claimed'] += count
+        self._maybe_flush()
+
+    def add_busy(self, seconds):
+        """Count `seconds` spent collecting and running tests."""
+        self._busy += seconds
+
+    def pytest_runtest_logreport(self, report):
+        # Count a single result per test, like the report stream
+        if report.when != 'call' and report.passed:
+            return
+        self._counts['failed' if report.failed else report.outcome] += 1
+        self._maybe_flush()
+
+    def pytest_sessionfinish(self, session):
+        self.finish()
+
+    def finish(self):
+        """Flush the counters and mark the worker as finished."""
+        # Workers that never claimed a batch, such as the parent of
+        # forked consumers, aren't listed.
+        if self._started is not None:
+            self.flush(finished=True)
+            self._started = None
+
+    def _maybe_flush(self):
+        if time.time() - self._flushed_at >= STATS_FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self, finished=False):
+        """Add the buffered counters to the worker's stats hash."""
+        now = time.time()
+        # The worker id is looked up here so that forked consumers use
+        # their own.
+        worker_id = get_worker_id(self._config)
+        stats_key = get_stats_key(self._list_key, worker_id)
+        worker_set_key = get_stats_worker_set_key(self._list_key)
+        pipe = get_redis_connection(self._config).pipeline(
+            transaction=False)
+        for field, count in self._counts.items():
+            pipe.hincrby(stats_key, field, count)
+        if self._busy:
+            pipe.hincrbyfloat(stats_key, 'busy', self._busy)
+        if self._started is not None:
+            pipe.hsetnx(stats_key, 'started', repr(self._started))
+        pipe.hset(stats_key, 'last_seen', repr(now))
+        if finished:
+            pipe.hset(stats_key, 'finished', repr(now))
+        pipe.sadd(worker_set_key, worker_id)
+        pipe.expire(stats_key, STATS_KEY_TTL)
+        pipe.expire(worker_set_key, STATS_KEY_TTL)
+        pipe.execute()
+        self._counts.clear()
+        self._busy = 0.0
+        self._flushed_at = now
+
+
+class PhaseTimer(object):
+    """Histograms of the time spent in each phase of the run loop.
+
+    The phases are `TIMED_PHASES`: claiming batches (pop), waiting for a
+    producer (idle), waiting on the prefetch buffer (blocked), collecting
+    nodes, generating their items, the pytest_collection_modifyitems hook
+    and running tests. Claims made by the prefetch thread are recorded
+    too, so every update holds a lock.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = dict((phase, 0) for phase in TIMED_PHASES)
+        self._sums = dict((phase, 0.0) for phase in TIMED_PHASES)
+        self._buckets = dict((phase, [0] * (len(PHASE_TIMING_BUCKETS) + 1))
+                             for phase in TIMED_PHASES)
+
+    def add(self, phase, seconds):
+        """Record that `phase` took `seconds` once."""
+        bucket = bisect.bisect_left(PHASE_TIMING_BUCKETS, seconds)
+        with self._lock:
+            self._counts[phase] += 1
+            self._sums[phase] += seconds
+            self._buckets[phase][bucket] += 1
+
+    def time_iter(self, phase, iterable):
+        """Yield from `iterable`, timing every step as `phase`."""
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                value = next(iterator)
+            except StopIteration:
+                self.add(phase, time.time() - start)
+                return
+            self.add(phase, time.time() - start)
+            yield value
+
+    def get_phases(self):
+        """Return the count, sum and cumulative buckets of every phase."""
+        phases = OrderedDict()
+        with self._lock:
+            for phase in TIMED_PHASES:
+                bounds = [repr(bound) for bound in PHASE_TIMING_BUCKETS]
+                cumulative, total = [], 0
+                for count in self._buckets[phase]:
+                    total += count
+                    cumulative.append(total)
+                phases[phase] = {
+                    'count': self._counts[phase],
+                    'sum': self._sums[phase],
+                    'buckets': OrderedDict(zip(bounds + ['+Inf'],
+                                               cumulative)),
+                }
+        return phases
+
+    def to_json(self, worker_id):
+        """Return the histograms as a JSON document."""
+        return json.dumps({'worker': worker_id, 'phases': self.get_phases()},
+                          indent=2)
+
+    def to_prometheus(self, worker_id):
+        """Return the histograms in the Prometheus text format."""
+        name = 'pytest_redis_phase_seconds'
+        lines = ['# HELP {} Time spent in each phase of the pytest-redis '
+                 'run loop.'.format(name),
+                 '# TYPE {} histogram'.format(name)]
+        worker_id = worker_id.replace('\\', '\\\\').replace('"', '\\"')
+        for phase, histogram in self.get_phases().items():
+            labels = 'worker="{}",phase="{}"'.format(worker_id, phase)
+            for bound, count in histogram['buckets'].items():
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+                    name, labels, bound, count))
+            lines.append('{}_sum{{{}}} {!r}'.format(name, labels,
+                                                      histogram['sum']))
+            lines.append('{}_count{{{}}} {}'.format(name, labels,
+                                                     histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+    def pytest_sessionfinish(self, session):
+        config = session.config
+        worker_id = get_worker_id(config)
+        json_path = config.getoption("redis_timing_json")
+        if json_path is not None:
+            write_file_atomically(json_path, self.to_json(worker_id))
+        prometheus_path = config.getoption("redis_timing_prometheus")
+        if prometheus_path is not None:
+            write_file_atomically(prometheus_path,
+                                  self.to_prometheus(worker_id))
+
+    def pytest_terminal_summary(self, terminalreporter):
+        if not terminalreporter.config.getoption("redis_timing"):
+            return
+        terminalreporter.write_sep("=", "pytest-redis phase timing")
+        for phase, histogram in self.get_phases().items():
+            count = histogram['count']
+            mean = histogram['sum'] / count if count else 0.0
+            terminalreporter.write_line(
+                "{:<12} {:>9} calls {:>11.3f}s total {:>11.1f}us mean".format(
+                    phase, count, histogram['sum'], mean * 1e6))
+
+
+def write_file_atomically(path, contents):
+    """Write a file through a temporary file so readers never see half."""
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, 'w') as tmp_file:
+        tmp_file.write(contents)
+    os.rename(tmp_path, path)
+
+
+def get_slot_path(path, slot):
+    """Return `path` with a worker slot inserted before its extension."""
+    root, ext = os.path.splitext(path)
+    return "{}.{}{}".format(root, slot, ext)
+
+
+class ModuleWatcher(object):
+    """Track the modified times of the source files of imported modules."""
+
+    def __init__(self):
+        self._mtimes = self._get_mtimes()
+        self.startup_modules = set(self._mtimes)
+
+    def _get_mtimes(self):
+        mtimes = {}
+        for name, module in list(sys.modules.items()):
+            path = getattr(module, '__file__', None)
+            if not path:
+                continue
+            if path.endswith(('.pyc', '.pyo')):
+                path = path[:-1]
+            if not path.endswith('.py'):
+                continue
+            try:
+                mtimes[name] = os.path.getmtime(path)
+            except OSError:
+                mtimes[name] = None
+        return mtimes
+
+    def snapshot(self):
+        """Record the modified times of the currently imported modules."""
+        self._mtimes = self._get_mtimes()
+
+    def changed(self):
+        """Return the names of the modules whose source changed."""
+        mtimes = self._get_mtimes()
+        return sorted(name for name, mtime in mtimes.items()
+                      if name in self._mtimes and
+                      mtime != self._mtimes[name])
+
+
+class Daemon(object):
+    """Run the jobs added to a redis stream in a warm process.
+
+    Every entry of the `--redis-daemon-key` stream is a job whose `job`
+    field names it and whose `list_key` field names the queue to consume.
+    The optional `backup_list_key`, `dedupe_key` and `abort_key` fields
+    replace the backup list key given on the command line and set the
+    job's dedupe index and abort key. An entry with a `stop` field stops
+    the daemon. Before each job the session state of
+    the last job is reset, test modules whose source changed are dropped
+    so that they are imported again and other changed modules are
+    reloaded. The daemon stops when a changed conftest can't be reloaded.
+    The exit status and outcome counts of every job are added to the
+    job's result hash under the worker id.
+    """
+
+    def __init__(self, session):
+        for option in ('redis_dedupe_key', 'redis_abort_key'):
+            if session.config.getoption(option) is not None:
+                raise pytest.UsageError(
+                    "--{} can't be used with --redis-daemon-key, set it "
+                    "per job instead".format(option.replace('_', '-')))
+        self._session = session
+        self._config = session.config
+        self._redis_connection = get_redis_connection(session.config)
+        self.daemon_key = session.config.getoption("redis_daemon_key")
+        self._backup_list_key = session.config.getoption(
+            "redis_backup_list_key")
+        # Every job runs the plain collect and run loop
+        session.config.option.redis_daemon_key = None
+        self.worker_id = get_worker_id(session.config)
+        self._watcher = ModuleWatcher()
+
+    def _read_job(self, last_id):
+        """Block until the next job after `last_id` and return it."""
+        while True:
+            reply = self._redis_connection.execute_command(
+                'XREAD', 'COUNT', 1,
+                'BLOCK', BLOCKING_POP_INTERVAL * 1000,
+                'STREAMS', self.daemon_key, last_id)
+            if reply:
+                entry_id, fields = reply[0][1][0]
+                fields = [value if isinstance(value, str)
+                          else value.decode('utf-8') for value in fields]
+                return entry_id, dict(zip(fields[::2], fields[1::2]))
+
+    def _refresh_modules(self):
+        """Drop or reload changed modules, returning False if it can't."""
+        term = TerminalReporter(self._config)
+        for name in self._watcher.changed():
+            module = sys.modules[name]
+            if name in self._watcher.startup_modules:
+                if os.path.basename(module.__file__).startswith('conftest.'):
+                    term.write_line("conftest module '{}' changed, "
+                                    "stopping".format(name), red=True)
+                    return False
+                reload_module(module)
+            else:
+                # Test modules are imported and their fixtures parsed again
+                del sys.modules[name]
+        return True
+
+    def _reset_session(self, job):
+        """Reset the state the last job left in the session."""
+        session = self._session
+        session.testsfailed = 0
+        session.testscollected = 0
+        session.shouldstop = False
+        session.items = []
+        reporter = self._config.pluginmanager.getplugin('terminalreporter')
+        if reporter is not None:
+            reporter.stats = {}
+        result_cache = self._config.pluginmanager.getplugin(
+            'redis-result-cache')
+        if result_cache is not None:
+            result_cache.reset()
+        self._config.option.redis_list_key = job['list_key']
+        self._config.option.redis_backup_list_key = job.get(
+            'backup_list_key', self._backup_list_key)
+        self._config.option.redis_dedupe_key = job.get('dedupe_key')
+        pluginmanager = self._config.pluginmanager
+        if pluginmanager.getplugin('redis-fleet-abort') is not None:
+            pluginmanager.unregister(name='redis-fleet-abort')
+        if pluginmanager.getplugin('redis-fleet-stats') is not None:
+            # The counters of a job are kept under its own list key
+            pluginmanager.unregister(name='redis-fleet-stats')
+            pluginmanager.register(FleetStats(self._config,
+                                              job['list_key']),
+                                   'redis-fleet-stats')
+        if 'abort_key' in job:
+            pluginmanager.register(FleetAbort(self._config,
+                                              job['abort_key']),
+                                   'redis-fleet-abort')
+
+    def _run_job(self):
+        """Run the collect and run loop and return its exit status."""
+        session = self._session
+        try:
+            try:
+                items = perform_collect_and_run(session)
+            finally:
+                # The fixtures of a job aren't shared with the next one
+                session._setupstate.teardown_all()
+        except pytest.UsageError as e:
+            TerminalReporter(self._config).write_line(
+                "ERROR: {}".format(e), red=True)
+            return EXIT_USAGEERROR
+        except session.Interrupted:
+            return EXIT_INTERRUPTED
+        session.testscollected = len(items)
+        if session.testsfailed:
+            return EXIT_TESTSFAILED
+        if items:
+            return EXIT_OK
+        return EXIT_NOTESTSCOLLECTED
+
+    def _report(self, job, exitstatus):
+        """Add the exit status and outcome counts to the result hash."""
+        report_stream = self._config.pluginmanager.getplugin(
+            'redis-report-stream')
+        if report_stream is not None:
+            report_stream.flush()
+        fleet_stats = self._config.pluginmanager.getplugin(
+            'redis-fleet-stats')
+        if fleet_stats is not None:
+            fleet_stats.finish()
+        result = {'exitstatus': exitstatus,
+                  'tests': self._session.testscollected,
+                  'finished': time.time()}
+        reporter = self._config.pluginmanager.getplugin('terminalreporter')
+        if reporter is not None:
+            for key, reports in reporter.stats.items():
+                if key:
+                    result[key] = len(reports)
+        result_key = get_daemon_result_key(self.daemon_key, job['job'])
+        pipe = self._redis_connection.pipeline(transaction=False)
+        pipe.hset(result_key, self.worker_id, json.dumps(result))
+        pipe.expire(result_key, DAEMON_RESULT_TTL)
+        pipe.execute()
+        term = TerminalReporter(self._config)
+        term.write(os.linesep)
+        term.write_line("job '{}' finished with exit status {}".format(
+            job['job'], exitstatus))
+
+    def _get_last_id(self):
+        """Return the id of the last entry of the stream, or 0."""
+        entries = self._redis_connection.execute_command(
+            'XREVRANGE', self.daemon_key, '+', '-', 'COUNT', 1)
+        if not entries:
+            return '0'
+        return entries[0][0]
+
+    def run(self):
+        """Run jobs until a stop entry is read and return EXIT_OK."""
+        # Only jobs added after the daemon started are run
+        last_id = self._get_last_id()
+        while True:
+            last_id, job = self._read_job(last_id)
+            if 'stop' in job:
+                return EXIT_OK
+            if not self._refresh_modules():
+                return EXIT_INTERRUPTED
+            self._reset_session(job)
+            exitstatus = self._run_job()
+            self._report(job, exitstatus)
+            self._watcher.snapshot()
+
+
+class WorkerPool(object):
+    """Fork queue consumers that share the imports of this process.
+
+    Each consumer runs the collect and run loop against the shared queue,
+    reports its own results and sends its outcome counts back through a
+    pipe. Consumers that are killed by a signal are respawned up to
+    `MAX_WORKER_RESPAWNS` times in the same slot.
+    """
+
+    def __init__(self, session, size):
+        self._session = session
+        self._size = size
+        self._children = {}
+        self._respawns = Counter()
+        self._exitstatuses = []
+        self._stats = Counter()
+        self._home_shard = None
+
+    def run(self):
+        """Run the consumers and return their merged exit status."""
+        start = time.time()
+        # Every consumer keeps its own backup list, so that a respawned
+        # consumer only restores the tests its predecessor claimed, run or
+        # not, instead of those of the live consumers.
+        config = self._session.config
+        if config.getoption("redis_backup_list_key") is not None and \
+                not is_stream_queue(config):
+            redis_connection = get_redis_connection(config)
+            lanes = get_lanes(config)
+            claimed_key = None
+            dedupe_key = config.getoption("redis_dedupe_key")
+            if dedupe_key is not None:
+                # The claimers of restored test paths are gone
+                claimed_key = get_dedupe_claimed_key(dedupe_key)
+            restore_backup_lists(redis_connection, lanes,
+                                 get_worker_id(config), get_score_key(config),
+                                 claimed_key)
+            # The consumers claim into their own backup lists only
+            RunMembership(redis_connection,
+                          [backup_key for _, backup_key in lanes],
+                          get_worker_id(config)).leave()
+        if config.getoption("redis_shards") > 0:
+            # Resolved before forking, while the worker id is the pool's
+            self._home_shard = get_home_shard(config)
+        for slot in range(self._size):
+            self._spawn(slot)
+        try:
+            while self._children:
+                pid, status = os.waitpid(-1, 0)
+                self._reap(pid, status)
+        except KeyboardInterrupt:
+            for pid in self._children:
+                try:
+                    os.kill(pid, signal.SIGINT)
+                except OSError:
+                    pass
+            while self._children:
+                pid, status = os.waitpid(-1, 0)
+                self._reap(pid, status, respawn=False)
+            raise
+        finally:
+            self._write_summary(time.time() - start)
+        return self.merge_exitstatuses(self._exitstatuses)
+
+    @staticmethod
+    def merge_exitstatuses(exitstatuses):
+        """Return the exit status that takes precedence."""
+        for exitstatus in WORKER_EXIT_STATUS_PRECEDENCE:
+            if exitstatus in exitstatuses:
+                return exitstatus
+        return EXIT_NOTESTSCOLLECTED
+
+    def _spawn(self, slot):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            self._run_consumer(slot, write_fd)
+        os.close(write_fd)
+        self._children[pid] = (slot, read_fd)
+
+    def _reap(self, pid, status, respawn=True):
+        slot, read_fd = self._children.pop(pid)
+        with os.fdopen(read_fd) as stats_pipe:
+            stats = stats_pipe.read()
+        if stats:
+            self._stats.update(json.loads(stats))
+        if os.WIFSIGNALED(status):
+            term = TerminalReporter(self._session.config)
+            term.write("\n")
+            term.write_line("pytest-redis consumer {} (pid {}) was killed by "
+                            "signal {}".format(slot, pid,
+                                               os.WTERMSIG(status)),
+                            red=True)
+            self._exitstatuses.append(EXIT_INTERNALERROR)
+            if respawn and self._respawns[slot] < MAX_WORKER_RESPAWNS:
+                self._respawns[slot] += 1
+                self._spawn(slot)
+        else:
+            self._exitstatuses.append(os.WEXITSTATUS(status))
+
+    def _run_consumer(self, slot, write_fd):
+        """Run the collect and run loop in a forked consumer and exit."""
+        session = self._session
+        config = session.config
+        config.option.redis_workers = 0
+        if config.option.redis_worker_id is not None:
+            config.option.redis_worker_id += ":{}".format(slot)
+        if self._home_shard is not None:
+            # Spreads the consumers over the shards of a sharded queue
+            config.option.redis_home_shard = \
+                (self._home_shard + slot) % config.option.redis_shards
+        if config.option.redis_backup_list_key is not None:
+            config.option.redis_backup_list_key += ":{}".format(slot)
+        for option in ('redis_timing_json', 'redis_timing_prometheus'):
+            path = getattr(config.option, option)
+            if path is not None:
+                setattr(config.option, option, get_slot_path(path, slot))
+        exitstatus = EXIT_INTERNALERROR
+        try:
+            try:
+                if self._respawns[slot] and \
+                        config.option.redis_backup_list_key is not None and \
+                        not is_stream_queue(config):
+                    # The killed predecessor never left the run of the
+                    # slot's backup lists, which no other consumer uses
+                    get_redis_connection(config).delete(
+                        *[get_run_member_set_key(backup_key)
+                          for _, backup_key in get_lanes(config)])
+                items = perform_collect_and_run(session)
+                session.testscollected = len(items)
+                if session.testsfailed:
+                    exitstatus = EXIT_TESTSFAILED
+                elif items:
+                    exitstatus = EXIT_OK
+                else:
+                    exitstatus = EXIT_NOTESTSCOLLECTED
+            except pytest.UsageError as e:
+                TerminalReporter(config).write_line("ERROR: {}".format(e),
+                                                    red=True)
+                exitstatus = EXIT_USAGEERROR
+            except KeyboardInterrupt:
+                exitstatus = EXIT_INTERRUPTED
+            except Exception:
+                traceback.print_exc()
+                exitstatus = EXIT_INTERNALERROR
+            session.exitstatus = exitstatus
+            config.hook.pytest_sessionfinish(session=session,
+                                             exitstatus=exitstatus)
+            exitstatus = session.exitstatus
+            reporter = config.pluginmanager.getplugin('terminalreporter')
+            stats = {}
+            if reporter is not None:
+                stats = dict((key, len(reports))
+                             for key, reports in reporter.stats.items()
+                             if key)
+            with os.fdopen(write_fd, 'w') as stats_pipe:
+                stats_pipe.write(json.dumps(stats))
+            config._ensure_unconfigure()
+        finally:
+            os._exit(exitstatus)
+
+    def _write_summary(self, duration):
+        """Summarize the consumers instead of this process' own results."""
+        reporter = self._session.config.pluginmanager.getplugin(
+            'terminalreporter')
+        if reporter is None:
+            return
+        parts = ["{} {}".format(count, key)
+                 for key, count in sorted(self._stats.items())]
+        reporter.write_sep("=", "{} consumers: {} in {:.2f} seconds".format(
+            self._size, ", ".join(parts) or "no tests ran", duration),
+            bold=True)
+        # This process ran no tests, its own summary would only say so
+        self._session.config.pluginmanager.unregister(reporter)
 
 
 def pytest_runtest_protocol(item, nextitem):
@@ -166,6 +3566,10 @@ def pytest_runtest_protocol(item, nextitem):
 
 def pytest_sessionfinish(session, exitstatus):
     """Called when the entire test session is completed."""
+    # the exit status of forked consumers replaces our own
+    workers_exitstatus = getattr(session, 'redis_workers_exitstatus', None)
+    if workers_exitstatus is not None:
+        session.exitstatus = workers_exitstatus
     # adjust the return value to return EXIT_OK
     # when no tests are collected.
     if session.exitstatus == EXIT_NOTESTSCOLLECTED:
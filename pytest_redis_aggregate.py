@@ -0,0 +1,173 @@
+"""Command line aggregator for pytest-redis report streams."""
+import argparse
+import json
+import sys
+from xml.etree import ElementTree
+
+import pytest_redis
+
+
+OUTCOMES = ['passed', 'failed', 'error', 'skipped']
+
+
+def to_str(value):
+    """Return a redis reply value as a native string."""
+    if isinstance(value, bytes) and not isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+def parse_stream_entries(reply):
+    """Return the (id, fields) pairs of an XREAD reply for one stream."""
+    if not reply:
+        return []
+    entries = []
+    for entry_id, fields in reply[0][1]:
+        if isinstance(fields, dict):
+            fields = fields.items()
+        else:
+            fields = zip(fields[::2], fields[1::2])
+        entries.append((to_str(entry_id),
+                        dict((to_str(k), to_str(v)) for k, v in fields)))
+    return entries
+
+
+def read_results(redis_connection, stream_key, start_id='0', count=1000,
+                 follow=None):
+    """Yield the test results added to the stream after `start_id`.
+
+    The stream is read `count` entries at a time. With `follow` the stream
+    keeps being read until no result was added for that many seconds.
+    """
+    last_id = start_id
+    while True:
+        args = ['XREAD', 'COUNT', count]
+        if follow is not None:
+            args.extend(['BLOCK', int(follow * 1000)])
+        args.extend(['STREAMS', stream_key, last_id])
+        entries = parse_stream_entries(redis_connection.execute_command(*args))
+        if not entries:
+            return
+        for entry_id, result in entries:
+            last_id = entry_id
+            yield entry_id, result
+
+
+def get_outcome(result):
+    """Return the junit outcome of a result."""
+    if result['outcome'] == 'failed' and result.get('when') != 'call':
+        return 'error'
+    return result['outcome']
+
+
+def summarize(results):
+    """Return the number of results of each outcome and their duration."""
+    summary = dict((outcome, 0) for outcome in OUTCOMES)
+    summary['tests'] = len(results)
+    summary['time'] = 0.0
+    for result in results:
+        summary[get_outcome(result)] += 1
+        summary['time'] += float(result.get('duration', 0))
+    return summary
+
+
+def write_json(results, path):
+    """Write the results and their summary to a JSON file."""
+    with open(path, 'w') as json_file:
+        json.dump({'summary': summarize(results), 'tests': results},
+                  json_file, indent=2, sort_keys=True)
+
+
+def write_junitxml(results, path):
+    """Write the results to a junit XML file."""
+    summary = summarize(results)
+    suite = ElementTree.Element('testsuite',
+                                name='pytest-redis',
+                                tests=str(summary['tests']),
+                                failures=str(summary['failed']),
+                                errors=str(summary['error']),
+                                skips=str(summary['skipped']),
+                                time='%.3f' % summary['time'])
+    for result in results:
+        parts = result['nodeid'].split('::')
+        module = parts[0]
+        if module.endswith('.py'):
+            module = module[:-3]
+        classnames = [module.replace('/', '.')] + \
+            [part for part in parts[1:-1] if part != '()']
+        case = ElementTree.SubElement(suite, 'testcase',
+                                      classname='.'.join(classnames),
+                                      name=parts[-1],
+                                      time=result.get('duration', '0'))
+        case.set('worker', result.get('worker', ''))
+        outcome = get_outcome(result)
+        longrepr = result.get('longrepr', '')
+        if outcome == 'failed':
+            element = ElementTree.SubElement(case, 'failure',
+                                             message='test failure')
+            element.text = longrepr
+        elif outcome == 'error':
+            element = ElementTree.SubElement(
+                case, 'error',
+                message='test %s failure' % result.get('when'))
+            element.text = longrepr
+        elif outcome == 'skipped':
+            ElementTree.SubElement(case, 'skipped', message=longrepr)
+    ElementTree.ElementTree(suite).write(path, encoding='utf-8')
+
+
+def main(argv=None):
+    """Merge the results of a report stream into a single report."""
+    parser = argparse.ArgumentParser(
+        description=('Merge the test results pytest-redis workers added '
+                     'to a report stream into a single report.'))
+    parser.add_argument('--redis-host', default=None,
+                        help='The host of the redis instance.')
+    parser.add_argument('--redis-port', default=None,
+                        help='The port of the redis instance.')
+    parser.add_argument('--redis-url', default=None,
+                        help=('The URL of the redis instance, used instead '
+                              'of redis-host and redis-port.'))
+    parser.add_argument('--redis-report-stream', required=True,
+                        help='The key of the report stream.')
+    parser.add_argument('--junitxml', default=None,
+                        help='Write a junit XML report to this path.')
+    parser.add_argument('--json', default=None,
+                        help='Write a JSON report to this path.')
+    parser.add_argument('--start-id', default='0',
+                        help='Only read results added after this stream id.')
+    parser.add_argument('--count', type=int, default=1000,
+                        help='The number of results read per round trip.')
+    parser.add_argument('--follow', type=float, default=None,
+                        help=('Keep reading until no result was added for '
+                              'this many seconds.'))
+    args = parser.parse_args(argv)
+    if args.redis_url is None and (args.redis_host is None or
+                                   args.redis_port is None):
+        parser.error("--redis-host and --redis-port or --redis-url are "
+                     "required")
+
+    redis_connection = pytest_redis.create_redis_connection(
+        url=args.redis_url, host=args.redis_host, port=args.redis_port)
+    results = []
+    last_id = args.start_id
+    for last_id, result in read_results(redis_connection,
+                                        args.redis_report_stream,
+                                        start_id=args.start_id,
+                                        count=args.count,
+                                        follow=args.follow):
+        results.append(result)
+
+    if args.json is not None:
+        write_json(results, args.json)
+    if args.junitxml is not None:
+        write_junitxml(results, args.junitxml)
+    summary = summarize(results)
+    print("{tests} tests: {passed} passed, {failed} failed, {error} errors, "
+          "{skipped} skipped".format(**summary))
+    print("Last stream id: {}".format(last_id))
+    return 1 if summary['failed'] or summary['error'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
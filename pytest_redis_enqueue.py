@@ -0,0 +1,384 @@
+"""Command line producer that collects tests once and enqueues them."""
+import argparse
+import json
+import sys
+import zlib
+from collections import OrderedDict
+
+import pytest
+
+from _pytest.main import EXIT_OK
+
+import pytest_redis
+
+
+GRANULARITIES = ['item', 'class', 'module']
+
+
+class NodeIdCollector(object):
+    """A pytest plugin that records the collected items."""
+
+    def __init__(self):
+        self.items = []
+        self.affinities = {}
+
+    def pytest_collection_finish(self, session):
+        for item in session.items:
+            entries = get_item_entries(item)
+            self.items.append(entries)
+            self.affinities[entries[0]] = get_item_affinity(item, entries)
+
+
+def get_item_entries(item):
+    """Return the (item, class, module) entries of a collected item.
+
+    The class entry is None for items that aren't in a class.
+    """
+    parts = [part for part in item.nodeid.split("::") if part != "()"]
+    class_entry = None
+    if item.getparent(pytest.Class) is not None and len(parts) > 2:
+        class_entry = "::".join(parts[:2])
+    return "::".join(parts), class_entry, parts[0]
+
+
+def get_item_affinity(item, entries):
+    """Return the affinity of an item, or None if it has none.
+
+    The affinity names the fixtures above function scope the item uses,
+    except pytest's own. Module and class scoped fixtures are qualified
+    with the module or class entry, since they are set up again for each.
+    """
+    fixtureinfo = getattr(item, '_fixtureinfo', None)
+    if fixtureinfo is None:
+        return None
+    item_entry, class_entry, module_entry = entries
+    parts = []
+    for name in sorted(fixtureinfo.names_closure):
+        fixturedefs = fixtureinfo.name2fixturedefs.get(name)
+        if not fixturedefs:
+            continue
+        fixturedef = fixturedefs[-1]
+        if getattr(fixturedef.func, '__module__', '').startswith('_pytest'):
+            continue
+        if fixturedef.scope == 'session':
+            parts.append(name)
+        elif fixturedef.scope == 'module':
+            parts.append(module_entry + "::" + name)
+        elif fixturedef.scope == 'class':
+            parts.append((class_entry or module_entry) + "::" + name)
+    return "|".join(parts) or None
+
+
+def collect_items(pytest_args):
+    """Run pytest collection once.
+
+    Returns its exit code, the entries of every item and the affinity of
+    every item id.
+    """
+    collector = NodeIdCollector()
+    ret = pytest.main(['--collect-only'] + list(pytest_args),
+                      plugins=[collector])
+    return ret, collector.items, collector.affinities
+
+
+def get_entries(items, granularity):
+    """Return the unique queue entries of the items and their item ids.
+
+    Returns a list of entries in collection order and a dict of the item
+    ids that belong to each entry.
+    """
+    entries = []
+    entry_items = {}
+    for item_id, class_entry, module_entry in items:
+        if granularity == 'module':
+            entry = module_entry
+        elif granularity == 'class' and class_entry is not None:
+            entry = class_entry
+        else:
+            entry = item_id
+        if entry not in entry_items:
+            entries.append(entry)
+            entry_items[entry] = []
+        entry_items[entry].append(item_id)
+    return entries, entry_items
+
+
+def get_entry_affinities(entries, entry_items, affinities):
+    """Return the affinity of every entry, that of its first item."""
+    return dict((entry, affinities.get(entry_items[entry][0]))
+                for entry in entries)
+
+
+def get_durations(redis_connection, durations_key, entries, entry_items):
+    """Return the recorded duration of every entry.
+
+    Entries without a recorded duration of their own use the sum of the
+    durations recorded for their items, and entries without any recorded
+    duration use the mean of the known ones.
+    """
+    item_ids = sorted(set(item_id for entry in entries
+                          for item_id in entry_items[entry]))
+    names = entries + item_ids
+    recorded = {}
+    if names:
+        values = redis_connection.hmget(durations_key, names)
+        for name, value in zip(names, values):
+            if value is not None:
+                recorded[name] = float(value)
+
+    durations = {}
+    for entry in entries:
+        if entry in recorded:
+            durations[entry] = recorded[entry]
+            continue
+        known = [recorded[item_id] for item_id in entry_items[entry]
+                 if item_id in recorded]
+        if known:
+            durations[entry] = sum(known)
+    mean = 0.0
+    if durations:
+        mean = sum(durations.values()) / len(durations)
+    for entry in entries:
+        durations.setdefault(entry, mean)
+    return durations
+
+
+def encode_manifest(entries, granularity):
+    """Return the compressed manifest of the enqueued entries."""
+    manifest = {'granularity': granularity, 'entries': entries}
+    return zlib.compress(json.dumps(manifest).encode('utf-8'))
+
+
+def encode_entries(entries, range_size=1, durations=None, affinities=None):
+    """Return the entries encoded as their indexes in the manifest.
+
+    Up to `range_size` consecutive entries are packed into a single
+    `first-last` range. Durations and affinities are returned keyed by the
+    encoded values as well.
+    """
+    values = []
+    value_durations = None if durations is None else {}
+    value_affinities = None if affinities is None else {}
+    for first in range(0, len(entries), range_size):
+        last = min(first + range_size, len(entries)) - 1
+        value = str(first)
+        if last != first:
+            value = "{}-{}".format(first, last)
+        values.append(value)
+        if durations is not None:
+            value_durations[value] = sum(durations[entry]
+                                         for entry in entries[first:last + 1])
+        if affinities is not None:
+            value_affinities[value] = affinities.get(entries[first])
+    return values, value_durations, value_affinities
+
+
+def enqueue(redis_connection, list_key, entries, chunk_size,
+            durations=None, queue_type='list', manifest_key=None,
+            manifest=None, done_key=None, affinities=None,
+            dedupe_key=None, shards=0):
+    """Push the entries to the queue in pipelined chunks.
+
+    List entries are pushed so that the first entry is the first one a
+    worker pops. Sorted set entries are scored with their duration and
+    stream entries are added in order. List entries with an affinity are
+    pushed to the affinity list of their affinity instead. With a
+    `dedupe_key` list entries that were already enqueued in the run are
+    skipped, checked by a server side script per chunk. With `shards`
+    list entries are spread over that many shard lists in turn.
+    """
+    pipe = redis_connection.pipeline(transaction=False)
+    if manifest_key is not None:
+        # Set first so that workers can decode encoded entries right away
+        pipe.set(manifest_key, manifest)
+    for start in range(0, len(entries), chunk_size):
+        chunk = entries[start:start + chunk_size]
+        if queue_type == 'zset':
+            args = []
+            for entry in chunk:
+                args.extend([durations.get(entry, 0), entry])
+            pipe.execute_command('ZADD', list_key, *args)
+        elif queue_type == 'stream':
+            for entry in chunk:
+                pipe.execute_command('XADD', list_key, '*',
+                                     pytest_redis.STREAM_PATH_FIELD, entry)
+        elif affinities is not None:
+            chunk_lists = OrderedDict()
+            for entry in chunk:
+                target = list_key
+                if affinities.get(entry) is not None:
+                    target = pytest_redis.get_affinity_list_key(
+                        list_key, affinities[entry])
+                chunk_lists.setdefault(target, []).append(entry)
+            for target, target_entries in chunk_lists.items():
+                pipe.lpush(target, *target_entries)
+                if target != list_key:
+                    pipe.sadd(pytest_redis.get_affinity_set_key(list_key),
+                              target)
+        elif shards:
+            shard_entries = OrderedDict()
+            for index, entry in enumerate(chunk, start):
+                shard_entries.setdefault(index % shards, []).append(entry)
+            for shard, target_entries in shard_entries.items():
+                pipe.lpush(pytest_redis.get_shard_key(list_key, shard),
+                           *target_entries)
+        elif dedupe_key is not None:
+            pytest_redis.run_script(
+                pipe, pytest_redis.ENQUEUE_DEDUPED_SCRIPT,
+                [list_key, pytest_redis.get_dedupe_queued_key(dedupe_key)],
+                [pytest_redis.DEDUPE_KEY_TTL] + chunk)
+        else:
+            pipe.lpush(list_key, *chunk)
+    if done_key is not None:
+        pipe.set(done_key, 1)
+    pipe.execute()
+
+
+def main(argv=None):
+    """Collect tests once and push them to a pytest-redis queue."""
+    parser = argparse.ArgumentParser(
+        description=('Collect tests once and push their paths to a '
+                     'pytest-redis queue. Arguments that are not listed '
+                     'here are passed to pytest.'))
+    parser.add_argument('--redis-host', default=None,
+                        help='The host of the redis instance.')
+    parser.add_argument('--redis-port', default=None,
+                        help='The port of the redis instance.')
+    parser.add_argument('--redis-url', default=None,
+                        help=('The URL of the redis instance, used instead '
+                              'of redis-host and redis-port.'))
+    parser.add_argument('--redis-list-key', required=True,
+                        help=('The key of the redis list the test paths '
+                              'are pushed to.'))
+    parser.add_argument('--redis-queue-type', default='list',
+                        choices=['list', 'zset', 'stream'],
+                        help='The type of the redis-list-key.')
+    parser.add_argument('--redis-durations-key', default=None,
+                        help=('The hash of recorded durations. When given '
+                              'the longest test paths are pushed to be '
+                              'popped first.'))
+    parser.add_argument('--granularity', default='item',
+                        choices=GRANULARITIES,
+                        help=('Push a path for every test item, every test '
+                              'class or every test module.'))
+    parser.add_argument('--manifest-key', default=None,
+                        help=('A key where a compressed JSON manifest of '
+                              'the pushed test paths is stored.'))
+    parser.add_argument('--encode', action='store_true', default=False,
+                        help=('Push the index of every test path in the '
+                              'manifest instead of the path, see '
+                              '--redis-manifest-key. Requires '
+                              '--manifest-key.'))
+    parser.add_argument('--encode-range-size', type=int, default=1,
+                        help=('Pack up to this many consecutive encoded '
+                              'test paths into a single range.'))
+    parser.add_argument('--done-key', default=None,
+                        help=('A key that is set once every test path has '
+                              'been pushed, see --redis-done-key.'))
+    parser.add_argument('--dedupe-key', default=None,
+                        help=('The prefix of the dedupe index of the run, '
+                              'see --redis-dedupe-key. Test paths that were '
+                              'already enqueued in the run are skipped.'))
+    parser.add_argument('--shards', type=int, default=0,
+                        help=('Spread the test paths over this many shard '
+                              'lists, see --redis-shards.'))
+    parser.add_argument('--affinity', action='store_true', default=False,
+                        help=('Push test paths that share fixtures above '
+                              'function scope to a common affinity list, '
+                              'see --redis-affinity.'))
+    parser.add_argument('--chunk-size', type=int, default=1000,
+                        help='The number of test paths pushed per command.')
+    parser.add_argument('--clear', action='store_true', default=False,
+                        help=('Delete the redis-list-key, its affinity lists '
+                              'and its chunk lists before pushing.'))
+    args, pytest_args = parser.parse_known_args(argv)
+    if args.redis_url is None and (args.redis_host is None or
+                                   args.redis_port is None):
+        parser.error("--redis-host and --redis-port or --redis-url are "
+                     "required")
+    if args.chunk_size < 1:
+        parser.error("--chunk-size must be at least 1")
+    if args.affinity and args.redis_queue_type != 'list':
+        parser.error("--affinity can only be used with a list queue")
+    if args.dedupe_key is not None and (args.affinity or
+                                        args.redis_queue_type != 'list'):
+        parser.error("--dedupe-key can only be used with a list queue "
+                     "without --affinity")
+    if args.shards < 0:
+        parser.error("--shards must not be negative")
+    if args.shards and (args.affinity or args.dedupe_key is not None or
+                        args.redis_queue_type != 'list'):
+        parser.error("--shards can only be used with a list queue without "
+                     "--affinity or --dedupe-key")
+    if args.encode and args.manifest_key is None:
+        parser.error("--encode requires --manifest-key")
+    if args.encode and args.dedupe_key is not None:
+        # The run dedupes test paths, not the manifest indexes they encode to
+        parser.error("--dedupe-key can't be used with --encode")
+    if args.encode_range_size < 1:
+        parser.error("--encode-range-size must be at least 1")
+    if args.encode_range_size > 1 and not args.encode:
+        parser.error("--encode-range-size requires --encode")
+    if args.encode_range_size > 1 and (args.affinity or
+                                       args.redis_queue_type != 'list'):
+        parser.error("--encode-range-size can only be used with a list "
+                     "queue without --affinity")
+    if args.redis_queue_type == 'zset' and args.redis_durations_key is None:
+        parser.error("--redis-queue-type=zset requires "
+                     "--redis-durations-key")
+
+    ret, items, item_affinities = collect_items(pytest_args)
+    if ret != EXIT_OK:
+        return ret
+
+    redis_connection = pytest_redis.create_redis_connection(
+        url=args.redis_url, host=args.redis_host, port=args.redis_port)
+    entries, entry_items = get_entries(items, args.granularity)
+    durations = None
+    if args.redis_durations_key is not None:
+        durations = get_durations(redis_connection,
+                                  args.redis_durations_key,
+                                  entries,
+                                  entry_items)
+        entries.sort(key=lambda entry: durations[entry], reverse=True)
+
+    affinities = None
+    if args.affinity:
+        affinities = get_entry_affinities(entries, entry_items,
+                                          item_affinities)
+
+    manifest = None
+    if args.manifest_key is not None:
+        manifest = encode_manifest(entries, args.granularity)
+    values = entries
+    if args.encode:
+        values, durations, affinities = encode_entries(
+            entries, args.encode_range_size, durations, affinities)
+    if args.clear:
+        affinity_set_key = pytest_redis.get_affinity_set_key(
+            args.redis_list_key)
+        chunk_set_key = pytest_redis.get_chunk_set_key(args.redis_list_key)
+        redis_connection.delete(
+            args.redis_list_key, affinity_set_key, chunk_set_key,
+            *(redis_connection.smembers(affinity_set_key) |
+              redis_connection.smembers(chunk_set_key)))
+        for shard in range(args.shards):
+            redis_connection.delete(
+                pytest_redis.get_shard_key(args.redis_list_key, shard))
+    enqueue(redis_connection, args.redis_list_key, values,
+            args.chunk_size,
+            durations=durations,
+            queue_type=args.redis_queue_type,
+            manifest_key=args.manifest_key,
+            manifest=manifest,
+            done_key=args.done_key,
+            affinities=affinities,
+            dedupe_key=args.dedupe_key,
+            shards=args.shards)
+    print("Pushed {} test paths to '{}'".format(len(entries),
+                                                args.redis_list_key))
+    return EXIT_OK
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,226 @@
+"""Command line monitor of the progress of pytest-redis workers."""
+import argparse
+import sys
+import time
+
+import pytest_redis
+
+
+QUEUE_LENGTH_COMMANDS = {'list': 'LLEN', 'zset': 'ZCARD', 'stream': 'XLEN'}
+
+COUNTERS = ['claimed', 'passed', 'failed', 'skipped']
+
+
+def to_str(value):
+    """Return a redis reply value as a native string."""
+    if isinstance(value, bytes) and not isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+def read_workers(redis_connection, list_key):
+    """Return the counters of every worker keeping stats on the list."""
+    worker_ids = sorted(to_str(worker_id) for worker_id in
+                        redis_connection.smembers(
+                            pytest_redis.get_stats_worker_set_key(list_key)))
+    pipe = redis_connection.pipeline(transaction=False)
+    for worker_id in worker_ids:
+        pipe.hgetall(pytest_redis.get_stats_key(list_key, worker_id))
+    workers = {}
+    for worker_id, fields in zip(worker_ids, pipe.execute()):
+        if not fields:
+            continue
+        fields = dict((to_str(k), to_str(v)) for k, v in fields.items())
+        stats = dict((counter, int(fields.get(counter, 0)))
+                     for counter in COUNTERS)
+        for field in ['busy', 'started', 'last_seen', 'finished']:
+            stats[field] = float(fields[field]) if field in fields else None
+        stats['busy'] = stats['busy'] or 0.0
+        workers[worker_id] = stats
+    return workers
+
+
+def get_queue_depth(redis_connection, list_key, queue_type='list',
+                    priority_list_keys=(), shards=0):
+    """Return the number of test paths waiting to be claimed.
+
+    A list queue is counted over its priority lists, its affinity lists
+    and either its shard lists, if it is sharded, or the list itself, with
+    one pipelined round trip.
+    """
+    if queue_type != 'list':
+        return redis_connection.execute_command(
+            QUEUE_LENGTH_COMMANDS[queue_type], list_key)
+    list_keys = list(priority_list_keys)
+    if shards:
+        list_keys.extend(pytest_redis.get_shard_key(list_key, index)
+                         for index in range(shards))
+    else:
+        list_keys.append(list_key)
+    list_keys.extend(to_str(affinity_list_key) for affinity_list_key in
+                     redis_connection.smembers(
+                         pytest_redis.get_affinity_set_key(list_key)))
+    pipe = redis_connection.pipeline(transaction=False)
+    for key in list_keys:
+        pipe.llen(key)
+    return sum(pipe.execute())
+
+
+def get_mean_duration(redis_connection, durations_key):
+    """Return the mean recorded duration of a test path, if any."""
+    values = [float(value) for value in redis_connection.hvals(durations_key)]
+    if not values:
+        return None
+    return sum(values) / len(values)
+
+
+def get_completed(stats):
+    """Return the number of tests a worker has a result for."""
+    return stats['passed'] + stats['failed'] + stats['skipped']
+
+
+def format_seconds(seconds):
+    """Return a duration as h:mm:ss."""
+    seconds = int(round(seconds))
+    return "{}:{:02d}:{:02d}".format(seconds // 3600, seconds // 60 % 60,
+                                     seconds % 60)
+
+
+def summarize(previous, current, depth, interval, now, mean_duration=None,
+              stale_after=30.0, straggler_ratio=0.5):
+    """Return the lines describing the progress between two polls.
+
+    A worker is stale when it hasn't updated its counters for
+    `stale_after` seconds and a straggler when it completes tests at less
+    than `straggler_ratio` of the median rate of the active workers.
+    """
+    rates = {}
+    utilisation = {}
+    for worker_id, stats in current.items():
+        before = previous.get(worker_id)
+        if before is None or stats['finished'] is not None:
+            continue
+        rates[worker_id] = (get_completed(stats) -
+                            get_completed(before)) / interval
+        utilisation[worker_id] = min(1.0, (stats['busy'] - before['busy']) /
+                                     interval)
+    active = sorted(rates.values())
+    median = active[len(active) // 2] if active else 0.0
+    throughput = sum(active)
+
+    if mean_duration is None:
+        busy = sum(stats['busy'] for stats in current.values())
+        completed = sum(get_completed(stats) for stats in current.values())
+        mean_duration = busy / completed if completed else None
+    eta = None
+    if depth == 0:
+        eta = 0.0
+    elif mean_duration is not None and active:
+        eta = depth * mean_duration / len(active)
+    elif throughput:
+        eta = depth / throughput
+
+    totals = dict((counter, sum(stats[counter]
+                                for stats in current.values()))
+                  for counter in COUNTERS)
+    lines = ["queue {} | {:.1f} tests/s | {} passed, {} failed, {} skipped "
+             "| {} workers | ETA {}".format(
+                 depth, throughput, totals['passed'], totals['failed'],
+                 totals['skipped'], len(active),
+                 format_seconds(eta) if eta is not None else "unknown")]
+    for worker_id, stats in sorted(current.items()):
+        if stats['finished'] is not None:
+            state = "finished"
+        elif stats['last_seen'] is not None and \
+                now - stats['last_seen'] >= stale_after:
+            state = "STALE {}s".format(int(now - stats['last_seen']))
+        elif worker_id in rates and median and \
+                rates[worker_id] < median * straggler_ratio:
+            state = "STRAGGLER"
+        else:
+            state = "running"
+        lines.append("  {:<30} {:>7} claimed {:>7} done {:>6} failed "
+                     "{:>8.1f}/s {:>4.0f}% busy  {}".format(
+                         worker_id, stats['claimed'], get_completed(stats),
+                         stats['failed'], rates.get(worker_id, 0.0),
+                         utilisation.get(worker_id, 0.0) * 100, state))
+    return lines
+
+
+def main(argv=None):
+    """Poll the counters of pytest-redis workers and print their progress."""
+    parser = argparse.ArgumentParser(
+        description=('Show the throughput, utilisation and ETA of the '
+                     'pytest-redis workers running with --redis-stats.'))
+    parser.add_argument('--redis-host', default=None,
+                        help='The host of the redis instance.')
+    parser.add_argument('--redis-port', default=None,
+                        help='The port of the redis instance.')
+    parser.add_argument('--redis-url', default=None,
+                        help=('The URL of the redis instance, used instead '
+                              'of redis-host and redis-port.'))
+    parser.add_argument('--redis-list-key', required=True,
+                        help=('The key of the redis list containing '
+                              'the test paths to execute.'))
+    parser.add_argument('--redis-queue-type', default='list',
+                        choices=sorted(QUEUE_LENGTH_COMMANDS),
+                        help='The type of the redis-list-key.')
+    parser.add_argument('--redis-priority-list-key', action='append',
+                        default=[],
+                        help=('A priority list the workers consume before '
+                              'the redis-list-key, counted in the queue '
+                              'depth. Can be given more than once.'))
+    parser.add_argument('--redis-shards', type=int, default=0,
+                        help=('The number of shard lists the '
+                              'redis-list-key is split into.'))
+    parser.add_argument('--redis-durations-key', default=None,
+                        help=('The hash of recorded durations the ETA is '
+                              'based on. Defaults to the busy time of the '
+                              'workers.'))
+    parser.add_argument('--interval', type=float, default=2.0,
+                        help='The number of seconds between polls.')
+    parser.add_argument('--stale-after', type=float, default=30.0,
+                        help=('The number of seconds without an update '
+                              'after which a worker is reported as stale.'))
+    parser.add_argument('--count', type=int, default=None,
+                        help='Stop after this many polls.')
+    args = parser.parse_args(argv)
+    if args.redis_url is None and (args.redis_host is None or
+                                   args.redis_port is None):
+        parser.error("--redis-host and --redis-port or --redis-url are "
+                     "required")
+    if args.interval <= 0:
+        parser.error("--interval must be positive")
+    if args.redis_shards < 0:
+        parser.error("--redis-shards must not be negative")
+
+    redis_connection = pytest_redis.create_redis_connection(
+        url=args.redis_url, host=args.redis_host, port=args.redis_port)
+    mean_duration = None
+    if args.redis_durations_key is not None:
+        mean_duration = get_mean_duration(redis_connection,
+                                          args.redis_durations_key)
+
+    previous = read_workers(redis_connection, args.redis_list_key)
+    polls = 0
+    try:
+        while args.count is None or polls < args.count:
+            time.sleep(args.interval)
+            current = read_workers(redis_connection, args.redis_list_key)
+            depth = get_queue_depth(redis_connection, args.redis_list_key,
+                                    args.redis_queue_type,
+                                    args.redis_priority_list_key,
+                                    args.redis_shards)
+            for line in summarize(previous, current, depth, args.interval,
+                                  time.time(), mean_duration,
+                                  args.stale_after):
+                print(line)
+            previous = current
+            polls += 1
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,53 @@
+"""Command line reaper for expired pytest-redis worker leases."""
+import argparse
+import sys
+
+import pytest_redis
+
+
+def main(argv=None):
+    """Push the in-flight tests of workers with expired leases back."""
+    parser = argparse.ArgumentParser(
+        description=('Push the in-flight tests of pytest-redis workers '
+                     'whose lease expired back to the redis list.'))
+    parser.add_argument('--redis-host', default=None,
+                        help='The host of the redis instance.')
+    parser.add_argument('--redis-port', default=None,
+                        help='The port of the redis instance.')
+    parser.add_argument('--redis-url', default=None,
+                        help=('The URL of the redis instance, used instead '
+                              'of redis-host and redis-port.'))
+    parser.add_argument('--redis-list-key', required=True,
+                        help=('The key of the redis list containing '
+                              'the test paths to execute.'))
+    parser.add_argument('--redis-queue-type', default='list',
+                        choices=['list', 'zset'],
+                        help='The type of the redis-list-key.')
+    parser.add_argument('--redis-durations-key', default=None,
+                        help=('The hash scoring test paths pushed back to '
+                              'a zset queue.'))
+    args = parser.parse_args(argv)
+    if args.redis_url is None and (args.redis_host is None or
+                                   args.redis_port is None):
+        parser.error("--redis-host and --redis-port or --redis-url are "
+                     "required")
+    score_key = None
+    if args.redis_queue_type == 'zset':
+        if args.redis_durations_key is None:
+            parser.error("--redis-queue-type=zset requires "
+                         "--redis-durations-key")
+        score_key = args.redis_durations_key
+
+    redis_connection = pytest_redis.create_redis_connection(
+        url=args.redis_url, host=args.redis_host, port=args.redis_port)
+    reaped = pytest_redis.reap_expired_leases(redis_connection,
+                                              args.redis_list_key,
+                                              score_key)
+    for worker_id, moved in sorted(reaped.items()):
+        print("Pushed back {} tests claimed by expired worker '{}'".format(
+            moved, worker_id))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
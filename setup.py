@@ -7,7 +7,11 @@ setup(
     author='Samy Abidib',
     author_email='abidibs@gmail.com',
     version='0.4.5',
-    py_modules=['pytest_redis'],
+    py_modules=['pytest_redis',
+                'pytest_redis_aggregate',
+                'pytest_redis_enqueue',
+                'pytest_redis_monitor',
+                'pytest_redis_reap'],
     url='https://github.com/sabidib/pytest-redis',
     license='MIT',
     description='A pytest plugin that pops test paths from a redis queue.',
@@ -17,8 +21,19 @@ setup(
         'Programming Language::Python::3',
         'Operating System::OS Independent',
     ],
+    entry_points={
+        'console_scripts': [
+            'pytest-redis-aggregate = pytest_redis_aggregate:main',
+            'pytest-redis-enqueue = pytest_redis_enqueue:main',
+            'pytest-redis-monitor = pytest_redis_monitor:main',
+            'pytest-redis-reap = pytest_redis_reap:main',
+        ],
+    },
     install_requires=[
         'pytest==2.9.1',
         'redis==2.10.5'
-    ]
+    ],
+    extras_require={
+        'hiredis': ['hiredis'],
+    }
 )
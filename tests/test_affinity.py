@@ -0,0 +1,158 @@
+"""Tests the pytest-redis affinity arguments."""
+import pytest
+
+from _pytest.main import EXIT_OK
+
+import utils
+
+import pytest_redis
+import pytest_redis_enqueue
+
+
+def create_test_files(testdir):
+    """Create test modules that use session and module scoped fixtures."""
+    utils.create_test_file(testdir, "conftest.py", """
+        import pytest
+
+        @pytest.fixture(scope='session')
+        def database():
+            return 'database'
+    """)
+    utils.create_test_file(testdir, "test_affinity_db.py", """
+        def test_first(database):
+            assert database
+
+        def test_second(database):
+            assert database
+    """)
+    utils.create_test_file(testdir, "test_affinity_model.py", """
+        import pytest
+
+        @pytest.fixture(scope='module')
+        def model():
+            return 'model'
+
+        def test_loaded(model):
+            assert model
+
+        def test_plain(tmpdir):
+            assert tmpdir
+    """)
+
+
+@pytest.yield_fixture
+def clean_affinity_lists(redis_connection, redis_args):
+    """Delete the affinity lists of the redis list afterwards."""
+    affinity_set_key = pytest_redis.get_affinity_set_key(
+        redis_args['redis-list-key'])
+    yield affinity_set_key
+    affinity_lists = redis_connection.smembers(affinity_set_key)
+    redis_connection.delete(affinity_set_key, *affinity_lists)
+
+
+def test_enqueue_groups_items_by_affinity(testdir, redis_connection,
+                                          redis_args, clean_affinity_lists):
+    """Ensure that items sharing fixtures are pushed to the same list."""
+    create_test_files(testdir)
+    list_key = redis_args['redis-list-key']
+
+    ret = pytest_redis_enqueue.main(
+        ["--redis-host=" + str(redis_args['redis-host']),
+         "--redis-port=" + str(redis_args['redis-port']),
+         "--redis-list-key=" + list_key, "--affinity"])
+
+    assert ret == EXIT_OK
+    assert redis_connection.lrange(list_key, 0, -1) == \
+        ["test_affinity_model.py::test_plain"]
+    database_list = pytest_redis.get_affinity_list_key(list_key, "database")
+    model_list = pytest_redis.get_affinity_list_key(
+        list_key, "test_affinity_model.py::model")
+    assert redis_connection.smembers(clean_affinity_lists) == \
+        set([database_list, model_list])
+    assert redis_connection.lrange(database_list, 0, -1) == \
+        ["test_affinity_db.py::test_second",
+         "test_affinity_db.py::test_first"]
+
+    result = testdir.runpytest(*utils.get_standard_args(redis_args) +
+                               ["--redis-affinity"])
+
+    assert result.ret == EXIT_OK
+    result.stdout.fnmatch_lines(["*4 passed*"])
+    assert redis_connection.smembers(clean_affinity_lists) == set()
+
+
+def test_worker_prefers_its_affinity_lists(testdir, redis_connection,
+                                           redis_args, clean_affinity_lists):
+    """Ensure that a worker drains an affinity list before taking another."""
+    list_key = redis_args['redis-list-key']
+    small = pytest_redis.get_affinity_list_key(list_key, "small")
+    large = pytest_redis.get_affinity_list_key(list_key, "large")
+    redis_connection.lpush(list_key, "plain")
+    redis_connection.lpush(small, "small_0", "small_1")
+    redis_connection.lpush(large, "large_0", "large_1", "large_2")
+    redis_connection.sadd(clean_affinity_lists, small, large)
+    test_queue = pytest_redis.AffinityQueue(redis_connection, list_key)
+
+    claimed = test_queue.claim(2)
+    claimed += test_queue.claim(1)
+    # Another producer pushes to the affinity list that was taken over
+    redis_connection.lpush(large, "large_3")
+    claimed += test_queue.claim(10)
+
+    assert claimed == ["plain", "large_0", "large_1", "large_2", "large_3",
+                       "small_0", "small_1"]
+
+    test_queue.give_back(["large_3", "small_1"])
+    assert redis_connection.lrange(large, 0, -1) == ["large_3"]
+    assert redis_connection.lrange(small, 0, -1) == ["small_1"]
+
+
+def test_worker_reuses_fixtures_across_tests(testdir, redis_connection,
+                                             redis_args,
+                                             clean_affinity_lists):
+    """Ensure that shared fixtures are set up once per worker."""
+    log = testdir.tmpdir.join("fixtures.log")
+    utils.create_test_file(testdir, "conftest.py", """
+        import pytest
+
+        @pytest.yield_fixture(scope='session')
+        def database():
+            with open({log!r}, 'a') as log:
+                log.write('database setup\\n')
+            yield 'database'
+            with open({log!r}, 'a') as log:
+                log.write('database teardown\\n')
+    """.format(log=str(log)))
+    utils.create_test_file(testdir, "test_affinity_reuse.py", """
+        import pytest
+
+        @pytest.fixture(scope='module')
+        def model():
+            with open({log!r}, 'a') as log:
+                log.write('model setup\\n')
+            return 'model'
+
+        def test_first(database, model):
+            assert database and model
+
+        def test_second(database, model):
+            assert database and model
+
+        def test_third(database, model):
+            assert database and model
+    """.format(log=str(log)))
+    list_key = redis_args['redis-list-key']
+    database_list = pytest_redis.get_affinity_list_key(list_key, "database")
+    redis_connection.lpush(database_list,
+                           *["test_affinity_reuse.py::" + name for name in
+                             ("test_first", "test_second", "test_third")])
+    redis_connection.sadd(clean_affinity_lists, database_list)
+
+    result = testdir.runpytest(*utils.get_standard_args(redis_args) +
+                               ["--redis-affinity",
+                                "--redis-collection-cache-size=10"])
+
+    assert result.ret == EXIT_OK
+    result.stdout.fnmatch_lines(["*3 passed*"])
+    assert log.readlines(cr=False) == ["database setup", "model setup",
+                                       "database teardown", ""]
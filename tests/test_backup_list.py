@@ -1,7 +1,12 @@
 """Tests the pytest-redis backup list arguments."""
+import time
+
+from _pytest.main import EXIT_OK
 
 import utils
 
+import pytest_redis
+
 
 def create_test_file(testdir):
     """Create test file and return array of paths to tests."""
@@ -60,3 +65,67 @@ def test_run_tests_multiple_times_with_backup(testdir, redis_connection,
 
     for a_file in file_paths_to_test:
         assert redis_connection.rpop(back_up_list) == a_file
+
+
+def test_backup_list_restored_in_order(testdir, redis_connection,
+                                       redis_args):
+    """Ensure that a restored backup list keeps its order."""
+    file_paths_to_test = create_test_file(testdir)
+    back_up_list = redis_args["redis-backup-list-key"]
+    py_test_args = get_args_for_backup_list(redis_args, back_up_list)
+
+    for i in range(50):
+        for a_file in file_paths_to_test:
+            redis_connection.lpush(back_up_list, a_file)
+
+    result = testdir.runpytest(*py_test_args)
+    result.stdout.fnmatch_lines([i + " PASSED"
+                                 for i in file_paths_to_test] * 50)
+    assert redis_connection.llen(back_up_list) == 100
+    assert redis_connection.llen(redis_args['redis-list-key']) == 0
+
+
+def test_backup_list_restore_is_locked(testdir, redis_connection,
+                                       redis_args):
+    """Ensure that workers restore once a dead worker's lock expires."""
+    file_paths_to_test = create_test_file(testdir)
+    back_up_list = redis_args["redis-backup-list-key"]
+    lock_key = back_up_list + ":restore-lock"
+    py_test_args = get_args_for_backup_list(redis_args, back_up_list)
+
+    for a_file in file_paths_to_test:
+        redis_connection.lpush(back_up_list, a_file)
+    # Another worker died while restoring the backup list
+    redis_connection.set(lock_key, "another-worker", px=500)
+
+    result = testdir.runpytest(*py_test_args)
+
+    assert not redis_connection.exists(lock_key)
+    assert result.ret == EXIT_OK
+    result.stdout.fnmatch_lines(["*2 passed*"])
+    assert redis_connection.llen(back_up_list) == 2
+    assert redis_connection.llen(redis_args['redis-list-key']) == 0
+
+
+def test_backup_list_of_live_run_is_kept(testdir, redis_connection,
+                                         redis_args):
+    """Ensure that a worker joining a live run leaves its claims alone."""
+    file_paths_to_test = create_test_file(testdir)
+    back_up_list = redis_args["redis-backup-list-key"]
+    run_key = pytest_redis.get_run_member_set_key(back_up_list)
+    py_test_args = get_args_for_backup_list(redis_args, back_up_list)
+
+    # The claims of a live worker of the run
+    for a_file in file_paths_to_test:
+        redis_connection.lpush(back_up_list, a_file)
+    redis_connection.zadd(run_key, time.time(), "live-worker")
+
+    try:
+        result = testdir.runpytest(*py_test_args)
+
+        assert result.ret == EXIT_OK
+        result.stdout.fnmatch_lines(["*No items in redis list*"])
+        assert redis_connection.llen(back_up_list) == 2
+        assert redis_connection.zrange(run_key, 0, -1) == ["live-worker"]
+    finally:
+        redis_connection.delete(run_key)
@@ -0,0 +1,65 @@
+"""Tests the pytest-redis batch size argument."""
+
+from _pytest.main import EXIT_OK, EXIT_USAGEERROR
+
+import utils
+
+
+def test_batches_run_every_test(testdir, redis_connection, redis_args):
+    """Ensure that batches which don't divide the list evenly run all."""
+    test_paths = utils.create_numbered_test_file(testdir, "batch", 7)
+    for test_path in test_paths:
+        redis_connection.lpush(redis_args['redis-list-key'], test_path)
+
+    py_test_args = utils.get_standard_args(redis_args) + \
+        ["--redis-batch-size=3"]
+    result = testdir.runpytest(*py_test_args)
+
+    result.stdout.fnmatch_lines(["*" + test_path + " PASSED"
+                                 for test_path in test_paths])
+    assert result.ret == EXIT_OK
+    assert redis_connection.llen(redis_args['redis-list-key']) == 0
+
+
+def test_batches_fill_backup_list(testdir, redis_connection, redis_args):
+    """Ensure batched claims keep the RPOPLPUSH backup list order."""
+    test_paths = utils.create_numbered_test_file(testdir, "batch", 4)
+    back_up_list = redis_args["redis-backup-list-key"]
+    for test_path in test_paths:
+        redis_connection.lpush(redis_args['redis-list-key'], test_path)
+
+    py_test_args = utils.get_standard_args(redis_args) + \
+        ["--redis-batch-size=3"]
+    testdir.runpytest(*py_test_args)
+
+    assert redis_connection.llen(back_up_list) == 4
+    for test_path in test_paths:
+        assert redis_connection.rpop(back_up_list) == test_path
+
+
+def test_batch_modifyitems_called_once(testdir, redis_connection,
+                                       redis_args):
+    """Ensure that each batch goes through a single modifyitems call."""
+    test_paths = utils.create_numbered_test_file(testdir, "batch", 4)
+    utils.create_test_file(testdir, "conftest.py", """
+        def pytest_collection_modifyitems(session, config, items):
+            print
+            print "modifyitems called with {} items".format(len(items))
+    """)
+    for test_path in test_paths:
+        redis_connection.lpush(redis_args['redis-list-key'], test_path)
+
+    py_test_args = utils.get_standard_args(redis_args) + \
+        ["-s", "--redis-batch-size=4"]
+    result = testdir.runpytest(*py_test_args)
+
+    result.stdout.fnmatch_lines(["modifyitems called with 4 items"])
+    assert result.ret == EXIT_OK
+
+
+def test_invalid_batch_size(testdir, redis_args):
+    """Ensure that a batch size below one is rejected."""
+    py_test_args = utils.get_standard_args(redis_args) + \
+        ["--redis-batch-size=0"]
+    result = testdir.runpytest(*py_test_args)
+    assert result.ret == EXIT_USAGEERROR
@@ -0,0 +1,70 @@
+"""Tests the pytest-redis idle timeout and done key arguments."""
+import threading
+import time
+
+from _pytest.main import EXIT_OK, EXIT_USAGEERROR
+
+import utils
+
+
+def create_test_file(testdir):
+    """Create test file and return the path to its test."""
+    test_filename = "test_blocking_file.py"
+    utils.create_test_file(testdir, test_filename, """
+        def test_pushed_late():
+            assert True
+    """)
+    return test_filename + "::test_pushed_late"
+
+
+def push_later(redis_connection, list_key, test_path, done_key, delay):
+    """Return a thread that pushes a test path and sets the done key."""
+    def produce():
+        time.sleep(delay)
+        redis_connection.lpush(list_key, test_path)
+        redis_connection.set(done_key, 1)
+    return threading.Thread(target=produce)
+
+
+def test_idle_timeout_waits_for_producer(testdir, redis_connection,
+                                         redis_args):
+    """Ensure that a worker runs tests pushed after it started."""
+    test_path = create_test_file(testdir)
+    done_key = redis_args['redis-list-key'] + ":done"
+    producer = push_later(redis_connection, redis_args['redis-list-key'],
+                          test_path, done_key, 0.5)
+
+    py_test_args = utils.get_standard_args(redis_args) + \
+        ["--redis-idle-timeout=30", "--redis-done-key=" + done_key]
+    start = time.time()
+    producer.start()
+    try:
+        result = testdir.runpytest(*py_test_args)
+    finally:
+        producer.join()
+        redis_connection.delete(done_key)
+
+    result.stdout.fnmatch_lines(["*" + test_path + " PASSED"])
+    assert result.ret == EXIT_OK
+    # The done key stops the worker well before the idle timeout
+    assert time.time() - start < 10
+
+
+def test_idle_timeout_exits_on_empty_list(testdir, redis_connection,
+                                          redis_args):
+    """Ensure that a worker exits once the list stays empty."""
+    create_test_file(testdir)
+    py_test_args = utils.get_standard_args(redis_args) + \
+        ["--redis-idle-timeout=1"]
+    start = time.time()
+    result = testdir.runpytest(*py_test_args)
+    assert result.ret == EXIT_OK
+    assert time.time() - start >= 1
+
+
+def test_done_key_requires_idle_timeout(testdir, redis_args):
+    """Ensure that the done key isn't accepted on its own."""
+    py_test_args = utils.get_standard_args(redis_args) + \
+        ["--redis-done-key=done"]
+    result = testdir.runpytest(*py_test_args)
+    assert result.ret == EXIT_USAGEERROR
@@ -0,0 +1,34 @@
+"""Tests the pytest-redis bounded memory argument."""
+from _pytest.main import EXIT_TESTSFAILED
+
+import utils
+
+
+def test_bounded_memory_only_counts_items(testdir, redis_connection,
+                                          redis_args):
+    """Ensure that finished items are counted but not kept."""
+    utils.create_test_file(testdir, "conftest.py", """
+        def pytest_sessionfinish(session):
+            print("ITEMS {} {}".format(len(session.items),
+                                       len(list(session.items))))
+    """)
+    utils.create_test_file(testdir, "test_bounded_file.py", """
+        def test_first():
+            assert True
+
+        def test_second():
+            assert True
+
+        def test_failing():
+            assert False
+    """)
+    redis_connection.lpush(redis_args['redis-list-key'],
+                           "test_bounded_file.py")
+
+    result = testdir.runpytest(*utils.get_standard_args(redis_args) +
+                               ["--redis-bounded-memory", "-s"])
+
+    assert result.ret == EXIT_TESTSFAILED
+    result.stdout.fnmatch_lines(["*ITEMS 3 0*",
+                                 "*def test_failing*",
+                                 "*1 failed, 2 passed*"])
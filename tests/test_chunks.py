@@ -0,0 +1,109 @@
+"""Tests the pytest-redis chunk argument."""
+import pytest
+
+from _pytest.main import EXIT_OK
+
+import utils
+
+import pytest_redis
+
+
+@pytest.yield_fixture
+def chunk_set_key(redis_connection, redis_args):
+    """Return the key of the chunk set, deleted with its lists afterwards."""
+    key = pytest_redis.get_chunk_set_key(redis_args['redis-list-key'])
+    yield key
+    redis_connection.delete(key, *redis_connection.smembers(key))
+
+
+def get_run_order(result):
+    """Return the test paths in the order they passed."""
+    return [line[:-len(" PASSED")] for line in result.outlines
+            if line.endswith(" PASSED")]
+
+
+def test_chunk_runs_every_item(testdir, redis_connection, redis_args,
+                               chunk_set_key):
+    """Ensure that every item of a claimed module chunk is run."""
+    test_paths = utils.create_numbered_test_file(testdir, "chunk", 4)
+    redis_connection.lpush(redis_args['redis-list-key'],
+                           test_paths[0].split("::")[0])
+
+    result = testdir.runpytest(*utils.get_standard_args(redis_args) +
+                               ["--redis-chunks"])
+
+    assert result.ret == EXIT_OK
+    assert get_run_order(result) == test_paths
+    assert redis_connection.smembers(chunk_set_key) == set()
+
+
+def test_idle_worker_steals_half(testdir, redis_connection, redis_args,
+                                 chunk_set_key):
+    """Ensure that an idle worker steals the tail half of a chunk."""
+    test_paths = utils.create_numbered_test_file(testdir, "chunk", 4)
+    other_chunk_key = pytest_redis.get_chunk_list_key(
+        redis_args['redis-list-key'], "other")
+    redis_connection.rpush(other_chunk_key, *test_paths)
+    redis_connection.sadd(chunk_set_key, other_chunk_key)
+
+    result = testdir.runpytest(*utils.get_standard_args(redis_args) +
+                               ["--redis-chunks"])
+
+    assert result.ret == EXIT_OK
+    assert get_run_order(result) == [test_paths[2], test_paths[3],
+                                     test_paths[1], test_paths[0]]
+    assert redis_connection.llen(other_chunk_key) == 0
+    assert redis_connection.smembers(chunk_set_key) == set()
+    # Stolen items are claimed to the backup list like popped ones
+    assert sorted(redis_connection.lrange(
+        redis_args['redis-backup-list-key'], 0, -1)) == test_paths
+
+
+def test_stolen_items_are_skipped(testdir, redis_connection, redis_args,
+                                  chunk_set_key):
+    """Ensure that a worker neither runs nor caches stolen items."""
+    chunk_key = pytest_redis.get_chunk_list_key(
+        redis_args['redis-list-key'], "owner")
+    cache_prefix = redis_args['redis-list-key'] + ":cache"
+    num_tests = pytest_redis.CHUNK_TAKE_SIZE + 4
+    test_paths = utils.create_numbered_test_file(
+        testdir, "chunk", num_tests,
+        first_test_body=("redis.StrictRedis(host='{}', port={})"
+                         ".ltrim('{}', 0, 0)").format(
+            redis_args['redis-host'], redis_args['redis-port'], chunk_key),
+        imports=("redis",))
+    redis_connection.lpush(redis_args['redis-list-key'],
+                           test_paths[0].split("::")[0])
+
+    try:
+        result = testdir.runpytest(*utils.get_standard_args(redis_args) +
+                                   ["--redis-chunks",
+                                    "--redis-worker-id=owner",
+                                    "--redis-result-cache=" + cache_prefix])
+
+        assert result.ret == EXIT_OK
+        # The first block is taken before the chunk list is trimmed
+        ran = pytest_redis.CHUNK_TAKE_SIZE + 1
+        assert get_run_order(result) == test_paths[:ran]
+        assert redis_connection.llen(chunk_key) == 0
+        assert len(redis_connection.keys(cache_prefix + ":*")) == ran
+    finally:
+        cache_keys = redis_connection.keys(cache_prefix + ":*")
+        if cache_keys:
+            redis_connection.delete(*cache_keys)
+
+
+def test_exitfirst_gives_back_items_once(testdir, redis_connection,
+                                         redis_args, chunk_set_key):
+    """Ensure that the unrun items of a stopped chunk are given back once."""
+    test_paths = utils.create_numbered_test_file(
+        testdir, "chunk", 4, first_test_body="assert False")
+    redis_connection.lpush(redis_args['redis-list-key'],
+                           test_paths[0].split("::")[0])
+
+    result = testdir.runpytest(*utils.get_standard_args(redis_args) +
+                               ["--redis-chunks", "-x"])
+
+    assert result.ret != EXIT_OK
+    assert sorted(redis_connection.lrange(redis_args['redis-list-key'],
+                                          0, -1)) == test_paths[1:]
@@ -0,0 +1,89 @@
+"""Tests the pytest-redis collection cache argument."""
+
+from _pytest.main import EXIT_OK, EXIT_USAGEERROR
+
+import utils
+
+
+def create_conftest(testdir):
+    """Create a conftest that prints every collected module."""
+    utils.create_test_file(testdir, "conftest.py", """
+        import pytest
+
+        def pytest_collectstart(collector):
+            if isinstance(collector, pytest.Module):
+                print
+                print "collecting module " + collector.name
+
+        @pytest.fixture
+        def fresh_list():
+            return []
+    """)
+
+
+def create_test_file(testdir, test_filename, num_tests):
+    """Create a test file and return the paths to its tests."""
+    test_filename_contents = ""
+    for test_num in range(num_tests):
+        test_filename_contents += """
+        def test_cached_{}(fresh_list):
+            fresh_list.append(1)
+            assert fresh_list == [1]
+        """.format(test_num)
+    utils.create_test_file(testdir, test_filename, test_filename_contents)
+    return [test_filename + "::test_cached_{}".format(test_num)
+            for test_num in range(num_tests)]
+
+
+def count_module_collections(result, test_filename):
+    """Return how many times the given module was collected."""
+    return len([line for line in result.outlines
+                if line == "collecting module " + test_filename])
+
+
+def test_module_collected_once(testdir, redis_connection, redis_args):
+    """Ensure that paths from the same file reuse the collected module."""
+    create_conftest(testdir)
+    test_paths = create_test_file(testdir, "test_cache_file.py", 5)
+    for test_path in test_paths * 2:
+        redis_connection.lpush(redis_args['redis-list-key'], test_path)
+
+    py_test_args = utils.get_standard_args(redis_args) + \
+        ["-s", "--redis-collection-cache-size=4"]
+    result = testdir.runpytest(*py_test_args)
+
+    assert result.ret == EXIT_OK
+    assert count_module_collections(result, "test_cache_file.py") == 1
+    result.stdout.fnmatch_lines(["*" + test_path + " PASSED"
+                                 for test_path in test_paths * 2])
+
+
+def test_least_recently_used_file_evicted(testdir, redis_connection,
+                                          redis_args):
+    """Ensure that files are collected again once evicted."""
+    create_conftest(testdir)
+    first_paths = create_test_file(testdir, "test_cache_first.py", 1)
+    second_paths = create_test_file(testdir, "test_cache_second.py", 1)
+    for test_path in first_paths + second_paths + first_paths:
+        redis_connection.lpush(redis_args['redis-list-key'], test_path)
+
+    py_test_args = utils.get_standard_args(redis_args) + \
+        ["-s", "--redis-collection-cache-size=1"]
+    result = testdir.runpytest(*py_test_args)
+
+    assert result.ret == EXIT_OK
+    assert count_module_collections(result, "test_cache_first.py") == 2
+    assert count_module_collections(result, "test_cache_second.py") == 1
+
+
+def test_cached_unknown_test_name(testdir, redis_connection, redis_args):
+    """Ensure that unknown names are still reported with the cache."""
+    create_conftest(testdir)
+    create_test_file(testdir, "test_cache_file.py", 1)
+    redis_connection.lpush(redis_args['redis-list-key'],
+                           "test_cache_file.py::test_wrong_name")
+
+    py_test_args = utils.get_standard_args(redis_args) + \
+        ["--redis-collection-cache-size=4"]
+    result = testdir.runpytest(*py_test_args)
+    assert result.ret == EXIT_USAGEERROR
@@ -0,0 +1,71 @@
+"""Tests the pytest-redis connection arguments."""
+
+from _pytest.main import EXIT_OK, EXIT_USAGEERROR
+
+import utils
+
+import pytest_redis
+
+
+def create_test_file(testdir):
+    """Create a test file and return the path to its test."""
+    test_filename = "test_connection_file.py"
+    utils.create_test_file(testdir, test_filename, """
+        def test_connected():
+            assert True
+    """)
+    return test_filename + "::test_connected"
+
+
+def get_url_args(redis_args, url):
+    """Return args that connect through the given url."""
+    return utils.default_pytest_redis_args() + \
+        ["--redis-url=" + url,
+         "--redis-list-key=" + redis_args['redis-list-key']]
+
+
+def test_redis_url(testdir, redis_connection, redis_args):
+    """Ensure that a redis url replaces the host and port."""
+    test_path = create_test_file(testdir)
+    redis_connection.lpush(redis_args['redis-list-key'], test_path)
+
+    url = "redis://{}:{}/0".format(redis_args['redis-host'],
+                                   redis_args['redis-port'])
+    result = testdir.runpytest(*(get_url_args(redis_args, url) +
+                                 ["--redis-socket-timeout=5"]))
+
+    result.stdout.fnmatch_lines(["*" + test_path + " PASSED"])
+    assert result.ret == EXIT_OK
+
+
+def test_redis_url_selects_db(testdir, redis_connection, redis_args):
+    """Ensure that the database of a redis url is used."""
+    test_path = create_test_file(testdir)
+    redis_connection.lpush(redis_args['redis-list-key'], test_path)
+
+    url = "redis://{}:{}/1".format(redis_args['redis-host'],
+                                   redis_args['redis-port'])
+    result = testdir.runpytest(*get_url_args(redis_args, url))
+
+    assert result.ret == EXIT_OK
+    assert redis_connection.llen(redis_args['redis-list-key']) == 1
+
+
+def test_missing_connection_args(testdir, redis_args):
+    """Ensure that a host and port or a url is required."""
+    result = testdir.runpytest(*(utils.default_pytest_redis_args() +
+                                 ["--redis-list-key=" +
+                                  redis_args['redis-list-key']]))
+
+    assert result.ret == EXIT_USAGEERROR
+
+
+def test_connection_is_shared(testdir, redis_args):
+    """Ensure that every caller shares one connection pool."""
+    config = testdir.parseconfigure(
+        *utils.get_standard_args(redis_args))
+
+    connection = pytest_redis.get_redis_connection(config)
+
+    assert pytest_redis.get_redis_connection(config) is connection
+    assert connection.connection_pool.connection_kwargs['socket_keepalive']
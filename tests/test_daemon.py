@@ -0,0 +1,110 @@
+"""Tests the pytest-redis daemon argument."""
+import json
+import os
+import threading
+import time
+
+from _pytest.main import EXIT_OK, EXIT_TESTSFAILED, EXIT_USAGEERROR
+
+import utils
+
+import pytest_redis
+
+
+def wait_for(condition, timeout=30):
+    """Wait until the condition holds, returning whether it did."""
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def test_daemon_runs_jobs_with_changed_modules(testdir, redis_connection,
+                                               redis_args):
+    """Ensure that every job runs and that changed test modules reload."""
+    test_file = testdir.makepyfile(test_daemon_file="""
+        def test_daemon():
+            assert True
+    """)
+    daemon_key = redis_args['redis-list-key'] + ":daemon"
+    second_list_key = redis_args['redis-list-key'] + ":second"
+    first_backup_key = redis_args['redis-backup-list-key'] + ":first"
+    result_keys = [pytest_redis.get_daemon_result_key(daemon_key, job)
+                   for job in ("first", "second")]
+    results = []
+
+    def submit_jobs():
+        try:
+            wait_for(lambda: redis_connection.info('clients')[
+                'blocked_clients'] > 0)
+            redis_connection.lpush(redis_args['redis-list-key'],
+                                   "test_daemon_file.py::test_daemon")
+            redis_connection.execute_command(
+                'XADD', daemon_key, '*', 'job', 'first',
+                'list_key', redis_args['redis-list-key'],
+                'backup_list_key', first_backup_key)
+            wait_for(lambda: redis_connection.hget(result_keys[0],
+                                                   "daemon"))
+            test_file.write("def test_daemon():\n    assert False\n")
+            mtime = time.time() + 10
+            os.utime(str(test_file), (mtime, mtime))
+            redis_connection.lpush(second_list_key,
+                                   "test_daemon_file.py::test_daemon")
+            redis_connection.execute_command(
+                'XADD', daemon_key, '*', 'job', 'second',
+                'list_key', second_list_key)
+            wait_for(lambda: redis_connection.hget(result_keys[1],
+                                                   "daemon"))
+            for result_key in result_keys:
+                results.append(json.loads(
+                    redis_connection.hget(result_key, "daemon")))
+        finally:
+            redis_connection.execute_command('XADD', daemon_key, '*',
+                                             'stop', 1)
+
+    submitter = threading.Thread(target=submit_jobs)
+    submitter.start()
+    try:
+        result = testdir.runpytest_subprocess(
+            *utils.get_standard_args(redis_args) +
+            ["--redis-daemon-key=" + daemon_key,
+             "--redis-worker-id=daemon",
+             "--redis-stats"])
+        submitter.join()
+
+        assert result.ret == EXIT_OK
+        assert [job_result['exitstatus'] for job_result in results] == \
+            [EXIT_OK, EXIT_TESTSFAILED]
+        assert results[0]['passed'] == 1
+        # The backup list of the first job isn't restored by the second
+        assert results[1]['tests'] == 1
+        assert results[1]['failed'] == 1
+        result.stdout.fnmatch_lines(["job 'first' finished with exit "
+                                     "status 0",
+                                     "job 'second' finished with exit "
+                                     "status 1"])
+        # Every job counts under its own list key
+        assert redis_connection.hget(pytest_redis.get_stats_key(
+            redis_args['redis-list-key'], "daemon"), "passed") == "1"
+        assert redis_connection.hget(pytest_redis.get_stats_key(
+            second_list_key, "daemon"), "failed") == "1"
+    finally:
+        redis_connection.delete(daemon_key, second_list_key,
+                                first_backup_key, *result_keys)
+        for list_key in (redis_args['redis-list-key'], second_list_key):
+            redis_connection.delete(
+                pytest_redis.get_stats_key(list_key, "daemon"),
+                pytest_redis.get_stats_worker_set_key(list_key))
+
+
+def test_daemon_rejects_run_keys(testdir, redis_args):
+    """Ensure that per run keys must be given per job."""
+    result = testdir.runpytest(*utils.get_standard_args(redis_args) +
+                               ["--redis-daemon-key=daemon",
+                                "--redis-dedupe-key=run"])
+
+    assert result.ret == EXIT_USAGEERROR
+    result.stderr.fnmatch_lines(["*--redis-dedupe-key can't be used with "
+                                 "--redis-daemon-key*"])
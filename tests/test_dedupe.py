@@ -0,0 +1,127 @@
+"""Tests the pytest-redis dedupe arguments."""
+import pytest
+
+from _pytest.main import EXIT_OK
+
+import utils
+
+import pytest_redis
+import pytest_redis_enqueue
+
+
+def create_test_file(testdir):
+    """Create a test file and return the paths to its tests."""
+    utils.create_test_file(testdir, "test_dedupe_file.py", """
+        def test_first():
+            assert True
+
+        def test_second():
+            assert True
+    """)
+    return ["test_dedupe_file.py::test_first",
+            "test_dedupe_file.py::test_second"]
+
+
+@pytest.yield_fixture
+def dedupe_key(redis_connection, redis_args):
+    """Return the prefix of a dedupe index, deleted afterwards."""
+    key = redis_args['redis-list-key'] + ":run"
+    yield key
+    redis_connection.delete(pytest_redis.get_dedupe_queued_key(key),
+                            pytest_redis.get_dedupe_finished_key(key),
+                            pytest_redis.get_dedupe_claimed_key(key))
+
+
+def test_enqueue_skips_enqueued_paths(testdir, redis_connection, redis_args,
+                                      dedupe_key):
+    """Ensure that enqueuing twice in a run pushes every path once."""
+    test_paths = create_test_file(testdir)
+    args = ["--redis-host=" + str(redis_args['redis-host']),
+            "--redis-port=" + str(redis_args['redis-port']),
+            "--redis-list-key=" + redis_args['redis-list-key'],
+            "--dedupe-key=" + dedupe_key,
+            "test_dedupe_file.py"]
+
+    assert pytest_redis_enqueue.main(args) == EXIT_OK
+    assert pytest_redis_enqueue.main(args) == EXIT_OK
+
+    assert redis_connection.lrange(redis_args['redis-list-key'],
+                                   0, -1) == test_paths[::-1]
+
+
+def test_finished_paths_are_dropped(testdir, redis_connection, redis_args,
+                                    dedupe_key):
+    """Ensure that a path that finished in the run isn't run again."""
+    test_paths = create_test_file(testdir)
+    redis_connection.lpush(redis_args['redis-list-key'],
+                           test_paths[0], test_paths[0], test_paths[1])
+    redis_connection.sadd(pytest_redis.get_dedupe_finished_key(dedupe_key),
+                          test_paths[1])
+
+    result = testdir.runpytest(*utils.get_standard_args(redis_args) +
+                               ["--redis-batch-size=2",
+                                "--redis-dedupe-key=" + dedupe_key])
+
+    assert result.ret == EXIT_OK
+    result.stdout.fnmatch_lines(["*1 passed*"])
+    assert redis_connection.smembers(
+        pytest_redis.get_dedupe_finished_key(dedupe_key)) == set(test_paths)
+
+
+def test_paths_held_by_live_workers_are_dropped(testdir, redis_connection,
+                                               redis_args, dedupe_key):
+    """Ensure that a path another worker is running isn't run again."""
+    test_paths = create_test_file(testdir)
+    claimed_key = pytest_redis.get_dedupe_claimed_key(dedupe_key)
+    redis_connection.lpush(redis_args['redis-list-key'], *test_paths)
+    redis_connection.hset(claimed_key, test_paths[1], "other")
+
+    result = testdir.runpytest(*utils.get_standard_args(redis_args) +
+                               ["--redis-dedupe-key=" + dedupe_key])
+
+    assert result.ret == EXIT_OK
+    result.stdout.fnmatch_lines(["*1 passed*"])
+    assert redis_connection.hlen(claimed_key) == 1
+    assert redis_connection.hget(claimed_key, test_paths[1]) == "other"
+    assert redis_connection.smembers(
+        pytest_redis.get_dedupe_finished_key(dedupe_key)) == \
+        set([test_paths[0]])
+
+
+def test_restored_paths_are_released(testdir, redis_connection, redis_args,
+                                     dedupe_key):
+    """Ensure that the paths of a crashed worker are run once restored."""
+    test_paths = create_test_file(testdir)
+    claimed_key = pytest_redis.get_dedupe_claimed_key(dedupe_key)
+    redis_connection.lpush(redis_args['redis-backup-list-key'],
+                           *test_paths)
+    redis_connection.hset(claimed_key, test_paths[1], "crashed")
+
+    result = testdir.runpytest(*utils.get_standard_args(redis_args) +
+                               ["--redis-dedupe-key=" + dedupe_key])
+
+    assert result.ret == EXIT_OK
+    result.stdout.fnmatch_lines(["*2 passed*"])
+    assert redis_connection.hlen(claimed_key) == 0
+
+
+def test_paths_restored_by_worker_pool_are_released(testdir,
+                                                    redis_connection,
+                                                    redis_args, dedupe_key):
+    """Ensure that the pool releases the paths it restores."""
+    test_paths = create_test_file(testdir)
+    claimed_key = pytest_redis.get_dedupe_claimed_key(dedupe_key)
+    redis_connection.lpush(redis_args['redis-backup-list-key'],
+                           *test_paths)
+    redis_connection.hset(claimed_key, test_paths[1], "crashed")
+
+    try:
+        result = testdir.runpytest_subprocess(
+            *utils.get_standard_args(redis_args) +
+            ["--redis-dedupe-key=" + dedupe_key, "--redis-workers=1"])
+    finally:
+        redis_connection.delete(redis_args['redis-backup-list-key'] + ":0")
+
+    assert result.ret == EXIT_OK
+    result.stdout.fnmatch_lines(["*1 consumers: 2 passed*"])
+    assert redis_connection.hlen(claimed_key) == 0
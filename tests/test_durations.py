@@ -0,0 +1,100 @@
+"""Tests the pytest-redis durations and sorted set queue arguments."""
+
+from _pytest.main import EXIT_OK, EXIT_USAGEERROR
+
+import utils
+
+
+def create_test_file(testdir):
+    """Create test file and return array of paths to tests."""
+    test_filename = "test_durations_file.py"
+    utils.create_test_file(testdir, test_filename, """
+        def test_short():
+            assert True
+        def test_medium():
+            assert True
+        def test_long():
+            assert True
+    """)
+    return [test_filename + "::test_short",
+            test_filename + "::test_medium",
+            test_filename + "::test_long"]
+
+
+def get_args_for_durations(redis_args, durations_key, queue_type="list"):
+    """Return args for the durations tests."""
+    return utils.get_standard_args(redis_args) + \
+        ["--redis-durations-key=" + durations_key,
+         "--redis-queue-type=" + queue_type]
+
+
+def test_durations_recorded(testdir, redis_connection, redis_args):
+    """Ensure that the duration of every run test path is recorded."""
+    test_paths = create_test_file(testdir)
+    durations_key = redis_args['redis-list-key'] + ":durations"
+    for test_path in test_paths:
+        redis_connection.lpush(redis_args['redis-list-key'], test_path)
+
+    try:
+        result = testdir.runpytest(*get_args_for_durations(redis_args,
+                                                           durations_key))
+        assert result.ret == EXIT_OK
+        durations = redis_connection.hgetall(durations_key)
+        assert sorted(durations.keys()) == sorted(test_paths)
+        for duration in durations.values():
+            assert float(duration) >= 0
+    finally:
+        redis_connection.delete(durations_key)
+
+
+def test_sorted_set_longest_first(testdir, redis_connection, redis_args):
+    """Ensure that the highest scored test paths run first."""
+    short, medium, long_ = create_test_file(testdir)
+    durations_key = redis_args['redis-list-key'] + ":durations"
+    redis_connection.zadd(redis_args['redis-list-key'], 1, short)
+    redis_connection.zadd(redis_args['redis-list-key'], 20, long_)
+    redis_connection.zadd(redis_args['redis-list-key'], 5, medium)
+
+    try:
+        result = testdir.runpytest(*get_args_for_durations(redis_args,
+                                                           durations_key,
+                                                           "zset"))
+        assert result.ret == EXIT_OK
+        result.stdout.fnmatch_lines(["*" + long_ + " PASSED",
+                                     "*" + medium + " PASSED",
+                                     "*" + short + " PASSED"])
+        assert redis_connection.lrange(
+            redis_args["redis-backup-list-key"], 0, -1) == \
+            [short, medium, long_]
+    finally:
+        redis_connection.delete(durations_key)
+
+
+def test_backup_list_restored_to_sorted_set(testdir, redis_connection,
+                                            redis_args):
+    """Ensure that restored test paths are scored by their duration."""
+    short, medium, long_ = create_test_file(testdir)
+    durations_key = redis_args['redis-list-key'] + ":durations"
+    redis_connection.hmset(durations_key, {short: 0.5, long_: 30})
+    for test_path in [long_, medium, short]:
+        redis_connection.lpush(redis_args["redis-backup-list-key"],
+                               test_path)
+
+    try:
+        result = testdir.runpytest(*get_args_for_durations(redis_args,
+                                                           durations_key,
+                                                           "zset"))
+        assert result.ret == EXIT_OK
+        result.stdout.fnmatch_lines(["*" + long_ + " PASSED",
+                                     "*" + short + " PASSED",
+                                     "*" + medium + " PASSED"])
+    finally:
+        redis_connection.delete(durations_key)
+
+
+def test_sorted_set_requires_durations(testdir, redis_args):
+    """Ensure that a sorted set queue needs a durations hash."""
+    py_test_args = utils.get_standard_args(redis_args) + \
+        ["--redis-queue-type=zset"]
+    result = testdir.runpytest(*py_test_args)
+    assert result.ret == EXIT_USAGEERROR
@@ -0,0 +1,181 @@
+"""Tests the pytest-redis-enqueue producer."""
+import json
+import zlib
+
+import pytest
+
+from _pytest.main import EXIT_OK
+
+import utils
+
+import pytest_redis_enqueue
+
+
+def create_test_file(testdir):
+    """Create a test file with test functions and a test class."""
+    test_filename = "test_enqueue_file.py"
+    utils.create_test_file(testdir, test_filename, """
+        def test_function():
+            assert True
+
+        class TestClass:
+            def test_first_method(self):
+                assert True
+
+            def test_second_method(self):
+                assert True
+    """)
+    return test_filename
+
+
+def get_enqueue_args(redis_args, *args):
+    """Return the producer args for the given redis args."""
+    return ["--redis-host=" + str(redis_args['redis-host']),
+            "--redis-port=" + str(redis_args['redis-port']),
+            "--redis-list-key=" + redis_args['redis-list-key']] + list(args)
+
+
+def test_enqueue_items(testdir, redis_connection, redis_args):
+    """Ensure that every collected item is pushed in collection order."""
+    test_filename = create_test_file(testdir)
+
+    ret = pytest_redis_enqueue.main(get_enqueue_args(redis_args,
+                                                     test_filename))
+
+    assert ret == EXIT_OK
+    assert redis_connection.lrange(redis_args['redis-list-key'], 0, -1) == [
+        test_filename + "::TestClass::test_second_method",
+        test_filename + "::TestClass::test_first_method",
+        test_filename + "::test_function",
+    ]
+    result = testdir.runpytest(*utils.get_standard_args(redis_args))
+    assert result.ret == EXIT_OK
+    result.stdout.fnmatch_lines(["*test_function PASSED",
+                                 "*test_first_method PASSED",
+                                 "*test_second_method PASSED"])
+
+
+def test_enqueue_classes_and_manifest(testdir, redis_connection,
+                                      redis_args):
+    """Ensure that class granularity pushes one path per class."""
+    test_filename = create_test_file(testdir)
+    manifest_key = redis_args['redis-list-key'] + ":manifest"
+
+    try:
+        ret = pytest_redis_enqueue.main(get_enqueue_args(
+            redis_args, "--granularity=class",
+            "--manifest-key=" + manifest_key, test_filename))
+
+        assert ret == EXIT_OK
+        entries = [test_filename + "::test_function",
+                   test_filename + "::TestClass"]
+        assert redis_connection.lrange(redis_args['redis-list-key'],
+                                       0, -1) == entries[::-1]
+        manifest = json.loads(zlib.decompress(
+            redis_connection.get(manifest_key)).decode('utf-8'))
+        assert manifest == {'granularity': 'class', 'entries': entries}
+    finally:
+        redis_connection.delete(manifest_key)
+
+
+def test_enqueue_longest_first(testdir, redis_connection, redis_args):
+    """Ensure that recorded durations order the pushed paths."""
+    test_filename = create_test_file(testdir)
+    durations_key = redis_args['redis-list-key'] + ":durations"
+    redis_connection.hmset(durations_key, {
+        test_filename + "::test_function": 1,
+        test_filename + "::TestClass::test_first_method": 2,
+        test_filename + "::TestClass::test_second_method": 5,
+    })
+
+    try:
+        ret = pytest_redis_enqueue.main(get_enqueue_args(
+            redis_args, "--granularity=class",
+            "--redis-durations-key=" + durations_key, test_filename))
+
+        assert ret == EXIT_OK
+        assert redis_connection.rpop(redis_args['redis-list-key']) == \
+            test_filename + "::TestClass"
+        assert redis_connection.rpop(redis_args['redis-list-key']) == \
+            test_filename + "::test_function"
+    finally:
+        redis_connection.delete(durations_key)
+
+
+def test_enqueue_encoded(testdir, redis_connection, redis_args):
+    """Ensure that encoded indexes and ranges are decoded by the workers."""
+    test_filename = create_test_file(testdir)
+    manifest_key = redis_args['redis-list-key'] + ":manifest"
+    durations_key = redis_args['redis-list-key'] + ":durations"
+
+    try:
+        ret = pytest_redis_enqueue.main(get_enqueue_args(
+            redis_args, "--encode", "--encode-range-size=2",
+            "--manifest-key=" + manifest_key, test_filename))
+
+        assert ret == EXIT_OK
+        assert redis_connection.lrange(redis_args['redis-list-key'],
+                                       0, -1) == ["2", "0-1"]
+        result = testdir.runpytest(*utils.get_standard_args(redis_args) +
+                                   ["--redis-manifest-key=" + manifest_key,
+                                    "--redis-durations-key=" +
+                                    durations_key])
+        assert result.ret == EXIT_OK
+        result.stdout.fnmatch_lines(["*test_function PASSED",
+                                     "*test_first_method PASSED",
+                                     "*test_second_method PASSED"])
+        assert redis_connection.hkeys(durations_key) == [
+            test_filename + "::TestClass::test_second_method"]
+    finally:
+        redis_connection.delete(manifest_key, durations_key)
+
+
+def test_enqueue_encoded_rejects_dedupe(testdir, redis_connection,
+                                        redis_args):
+    """Ensure that encoded indexes aren't added to the dedupe index."""
+    test_filename = create_test_file(testdir)
+    manifest_key = redis_args['redis-list-key'] + ":manifest"
+
+    with pytest.raises(SystemExit):
+        pytest_redis_enqueue.main(get_enqueue_args(
+            redis_args, "--encode", "--manifest-key=" + manifest_key,
+            "--dedupe-key=" + redis_args['redis-list-key'] + ":run",
+            test_filename))
+
+    assert redis_connection.llen(redis_args['redis-list-key']) == 0
+    assert not redis_connection.exists(manifest_key)
+
+
+def test_enqueue_stream(testdir, redis_connection, redis_args):
+    """Ensure that stream entries are added in collection order."""
+    test_filename = create_test_file(testdir)
+    stream_args = dict(redis_args)
+    stream_args['redis-list-key'] = redis_args['redis-list-key'] + ":stream"
+
+    try:
+        ret = pytest_redis_enqueue.main(get_enqueue_args(
+            stream_args, "--redis-queue-type=stream", test_filename))
+
+        assert ret == EXIT_OK
+        result = testdir.runpytest(*utils.get_standard_args(stream_args) +
+                                   ["--redis-queue-type=stream"])
+        assert result.ret == EXIT_OK
+        result.stdout.fnmatch_lines(["*test_function PASSED",
+                                     "*test_first_method PASSED",
+                                     "*test_second_method PASSED"])
+    finally:
+        redis_connection.delete(stream_args['redis-list-key'])
+
+
+def test_enqueue_nothing_on_collection_error(testdir, redis_connection,
+                                             redis_args):
+    """Ensure that nothing is pushed when collection fails."""
+    utils.create_test_file(testdir, "test_broken.py", """
+        import a_module_that_does_not_exist
+    """)
+
+    ret = pytest_redis_enqueue.main(get_enqueue_args(redis_args,
+                                                     "test_broken.py"))
+
+    assert ret != EXIT_OK
+    assert redis_connection.llen(redis_args['redis-list-key']) == 0
@@ -0,0 +1,77 @@
+"""Tests -x, --maxfail and the pytest-redis abort key."""
+import pytest
+
+from _pytest.main import EXIT_INTERRUPTED
+
+import utils
+
+import pytest_redis
+
+
+@pytest.yield_fixture
+def abort_key(redis_connection, redis_args):
+    """Return an abort key, deleted with its counter afterwards."""
+    key = redis_args['redis-list-key'] + ":abort"
+    redis_connection.delete(key, pytest_redis.get_failure_count_key(key))
+    yield key
+    redis_connection.delete(key, pytest_redis.get_failure_count_key(key))
+
+
+def push_tests(redis_connection, list_key, test_paths):
+    """Push the test paths so that the first one is popped first."""
+    for test_path in test_paths:
+        redis_connection.lpush(list_key, test_path)
+
+
+def test_exitfirst_stops_worker(testdir, redis_connection, redis_args):
+    """Ensure that -x stops the worker and gives back unrun tests."""
+    test_paths = utils.create_numbered_test_file(
+        testdir, "fail_fast", 5, first_test_body="assert False")
+    push_tests(redis_connection, redis_args['redis-list-key'], test_paths)
+
+    py_test_args = utils.get_standard_args(redis_args) + \
+        ["-x", "--redis-batch-size=3"]
+    result = testdir.runpytest(*py_test_args)
+
+    assert result.ret == EXIT_INTERRUPTED
+    result.stdout.fnmatch_lines(["*stopping after 1 failures*"])
+    assert "test_fail_fast_1 PASSED" not in result.stdout.str()
+    assert redis_connection.lrange(redis_args['redis-list-key'], 0, -1) == \
+        list(reversed(test_paths[1:]))
+
+
+def test_abort_key_stops_fleet(testdir, redis_connection, redis_args,
+                               abort_key):
+    """Ensure that failures of every worker count towards --maxfail."""
+    test_paths = utils.create_numbered_test_file(
+        testdir, "fail_fast", 4, first_test_body="assert False")
+    push_tests(redis_connection, redis_args['redis-list-key'], test_paths)
+    # Another worker already failed a test
+    redis_connection.set(pytest_redis.get_failure_count_key(abort_key), 1)
+
+    py_test_args = utils.get_standard_args(redis_args) + \
+        ["--maxfail=2", "--redis-abort-key=" + abort_key]
+    result = testdir.runpytest(*py_test_args)
+
+    assert result.ret == EXIT_INTERRUPTED
+    result.stdout.fnmatch_lines(["*run aborted: 2 failed tests*"])
+    assert redis_connection.get(
+        pytest_redis.get_failure_count_key(abort_key)) == b"2"
+    assert redis_connection.llen(redis_args['redis-list-key']) == 3
+
+
+def test_set_abort_key_runs_nothing(testdir, redis_connection, redis_args,
+                                    abort_key):
+    """Ensure that a worker doesn't claim tests once the run aborted."""
+    test_paths = utils.create_numbered_test_file(
+        testdir, "fail_fast", 2, first_test_body="assert False")
+    push_tests(redis_connection, redis_args['redis-list-key'], test_paths)
+    redis_connection.set(abort_key, "stopped by hand")
+
+    py_test_args = utils.get_standard_args(redis_args) + \
+        ["--redis-abort-key=" + abort_key]
+    result = testdir.runpytest(*py_test_args)
+
+    assert result.ret == EXIT_INTERRUPTED
+    result.stdout.fnmatch_lines(["*run aborted: stopped by hand*"])
+    assert redis_connection.llen(redis_args['redis-list-key']) == 2
@@ -0,0 +1,88 @@
+"""Tests the pytest-redis stats argument and the monitor."""
+
+from _pytest.main import EXIT_TESTSFAILED
+
+import utils
+
+import pytest_redis
+import pytest_redis_monitor
+
+
+def clean_stats_keys(redis_connection, list_key, worker_ids):
+    """Delete the stats keys of the given workers."""
+    redis_connection.delete(pytest_redis.get_stats_worker_set_key(list_key))
+    for worker_id in worker_ids:
+        redis_connection.delete(pytest_redis.get_stats_key(list_key,
+                                                           worker_id))
+
+
+def get_stats(**kwargs):
+    """Return the counters of a worker, defaulting to an idle one."""
+    stats = {'claimed': 0, 'passed': 0, 'failed': 0, 'skipped': 0,
+             'busy': 0.0, 'started': 0.0, 'last_seen': 100.0,
+             'finished': None}
+    stats.update(kwargs)
+    return stats
+
+
+def test_worker_records_stats(testdir, redis_connection, redis_args):
+    """Ensure that a worker keeps its counters in redis."""
+    list_key = redis_args['redis-list-key']
+    test_paths = utils.create_numbered_test_file(
+        testdir, "stats", 3, first_test_body="assert False")
+    for test_path in test_paths:
+        redis_connection.lpush(list_key, test_path)
+
+    py_test_args = utils.get_standard_args(redis_args) + \
+        ["--redis-stats", "--redis-worker-id=counted"]
+    try:
+        result = testdir.runpytest(*py_test_args)
+
+        assert result.ret == EXIT_TESTSFAILED
+        workers = pytest_redis_monitor.read_workers(redis_connection,
+                                                    list_key)
+        assert list(workers) == ["counted"]
+        stats = workers["counted"]
+        assert stats['claimed'] == 3
+        assert stats['passed'] == 2
+        assert stats['failed'] == 1
+        assert stats['busy'] > 0
+        assert stats['finished'] is not None
+    finally:
+        clean_stats_keys(redis_connection, list_key, ["counted"])
+
+
+def test_summarize_flags_stragglers_and_stale_workers():
+    """Ensure that slow and silent workers are reported."""
+    previous = {'fast': get_stats(passed=0),
+                'slow': get_stats(passed=0),
+                'stuck': get_stats(passed=0)}
+    current = {'fast': get_stats(passed=20, busy=9.0, last_seen=109.0),
+               'slow': get_stats(passed=2, busy=9.0, last_seen=109.0),
+               'stuck': get_stats(passed=20, busy=10.0, last_seen=100.0)}
+
+    lines = pytest_redis_monitor.summarize(previous, current, depth=84,
+                                           interval=10.0, now=135.0,
+                                           mean_duration=0.5)
+
+    assert lines[0] == ("queue 84 | 4.2 tests/s | 42 passed, 0 failed, "
+                        "0 skipped | 3 workers | ETA 0:00:14")
+    assert lines[1].split()[-1] == "running"
+    assert lines[2].split()[-1] == "STRAGGLER"
+    assert lines[3].endswith("STALE 35s")
+
+
+def test_monitor_prints_progress(redis_connection, redis_args, capsys):
+    """Ensure that the monitor polls the queue and the workers."""
+    list_key = redis_args['redis-list-key']
+    redis_connection.lpush(list_key, "test_a.py", "test_b.py")
+
+    ret = pytest_redis_monitor.main(
+        ["--redis-host=" + str(redis_args['redis-host']),
+         "--redis-port=" + str(redis_args['redis-port']),
+         "--redis-list-key=" + list_key,
+         "--interval=0.01", "--count=1"])
+
+    assert ret == 0
+    out, _ = capsys.readouterr()
+    assert out.startswith("queue 2 | 0.0 tests/s")
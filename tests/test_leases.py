@@ -0,0 +1,112 @@
+"""Tests the pytest-redis lease arguments."""
+
+from _pytest.main import EXIT_OK
+
+import utils
+
+import pytest_redis
+
+
+def get_args_for_leases(redis_args, worker_id):
+    """Return args for the lease tests."""
+    return utils.get_standard_args(redis_args) + \
+        ["--redis-lease-timeout=5", "--redis-worker-id=" + worker_id]
+
+
+def clean_lease_keys(redis_connection, list_key, worker_ids):
+    """Delete the lease keys used by the given workers."""
+    redis_connection.delete(pytest_redis.get_worker_set_key(list_key))
+    for worker_id in worker_ids:
+        redis_connection.delete(
+            pytest_redis.get_lease_key(list_key, worker_id),
+            pytest_redis.get_inflight_list_key(list_key, worker_id))
+
+
+def test_finished_tests_leave_inflight_list(testdir, redis_connection,
+                                            redis_args):
+    """Ensure that run tests end up in the backup list only."""
+    test_paths = utils.create_numbered_test_file(testdir, "lease", 3)
+    list_key = redis_args['redis-list-key']
+    back_up_list = redis_args["redis-backup-list-key"]
+    for test_path in test_paths:
+        redis_connection.lpush(list_key, test_path)
+
+    result = testdir.runpytest(*get_args_for_leases(redis_args, "worker"))
+
+    assert result.ret == EXIT_OK
+    assert not redis_connection.exists(
+        pytest_redis.get_inflight_list_key(list_key, "worker"))
+    assert not redis_connection.smembers(
+        pytest_redis.get_worker_set_key(list_key))
+    for test_path in test_paths:
+        assert redis_connection.rpop(back_up_list) == test_path
+
+
+def test_expired_lease_is_reaped(testdir, redis_connection, redis_args):
+    """Ensure that the tests of a crashed worker are run again."""
+    test_paths = utils.create_numbered_test_file(testdir, "lease", 3)
+    list_key = redis_args['redis-list-key']
+    # A crashed worker that was running the first test
+    redis_connection.sadd(pytest_redis.get_worker_set_key(list_key),
+                          "crashed")
+    redis_connection.lpush(
+        pytest_redis.get_inflight_list_key(list_key, "crashed"),
+        test_paths[0])
+    # An alive worker that is running the second test
+    redis_connection.sadd(pytest_redis.get_worker_set_key(list_key),
+                          "alive")
+    redis_connection.set(pytest_redis.get_lease_key(list_key, "alive"),
+                         "alive", px=60000)
+    redis_connection.lpush(
+        pytest_redis.get_inflight_list_key(list_key, "alive"),
+        test_paths[1])
+    redis_connection.lpush(list_key, test_paths[2])
+
+    try:
+        result = testdir.runpytest(*get_args_for_leases(redis_args,
+                                                        "worker"))
+        result.stdout.fnmatch_lines(["*" + test_paths[0] + " PASSED",
+                                     "*" + test_paths[2] + " PASSED"])
+        assert result.ret == EXIT_OK
+        assert not redis_connection.exists(
+            pytest_redis.get_inflight_list_key(list_key, "crashed"))
+        assert redis_connection.lrange(
+            pytest_redis.get_inflight_list_key(list_key, "alive"),
+            0, -1) == [test_paths[1]]
+    finally:
+        clean_lease_keys(redis_connection, list_key, ["alive", "crashed"])
+
+
+def test_interrupted_tests_are_pushed_back(testdir, redis_connection,
+                                           redis_args):
+    """Ensure that a stopped worker hands back its unfinished tests."""
+    test_paths = utils.create_numbered_test_file(
+        testdir, "lease", 3, first_test_body='pytest.exit("stop")')
+    list_key = redis_args['redis-list-key']
+    for test_path in test_paths:
+        redis_connection.lpush(list_key, test_path)
+
+    testdir.runpytest(*get_args_for_leases(redis_args, "worker"))
+
+    assert redis_connection.llen(redis_args["redis-backup-list-key"]) == 0
+    assert redis_connection.llen(list_key) == 3
+    for test_path in test_paths:
+        assert redis_connection.rpop(list_key) == test_path
+
+
+def test_acknowledged_tests_are_flushed_at_once(redis_connection,
+                                                redis_args):
+    """Ensure that finished tests stay in flight until they are flushed."""
+    list_key = redis_args['redis-list-key']
+    back_up_list = redis_args["redis-backup-list-key"]
+    lease_keeper = pytest_redis.LeaseKeeper(redis_connection, list_key,
+                                            back_up_list, "worker", 10)
+    redis_connection.lpush(lease_keeper.inflight_key, "a", "a", "b")
+
+    lease_keeper.acknowledge([("a", 2)])
+    lease_keeper.acknowledge([("b", 1)])
+    assert redis_connection.llen(lease_keeper.inflight_key) == 3
+    lease_keeper.flush()
+
+    assert not redis_connection.exists(lease_keeper.inflight_key)
+    assert redis_connection.lrange(back_up_list, 0, -1) == ["b", "a", "a"]
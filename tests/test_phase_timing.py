@@ -0,0 +1,73 @@
+"""Tests the pytest-redis phase timing arguments."""
+import json
+
+from _pytest.main import EXIT_OK
+
+import utils
+
+import pytest_redis
+
+
+def test_timing_summary(testdir, redis_connection, redis_args):
+    """Ensure that a summary of every phase is printed."""
+    test_paths = utils.create_numbered_test_file(testdir, "timing", 4)
+    for test_path in test_paths:
+        redis_connection.lpush(redis_args['redis-list-key'], test_path)
+
+    py_test_args = utils.get_standard_args(redis_args) + \
+        ["--redis-timing", "--redis-batch-size=2"]
+    result = testdir.runpytest(*py_test_args)
+
+    assert result.ret == EXIT_OK
+    result.stdout.fnmatch_lines(["*pytest-redis phase timing*",
+                                 "pop * 3 calls*",
+                                 "idle * 0 calls*",
+                                 "blocked * 0 calls*",
+                                 "collect * calls*",
+                                 "genitems * 4 calls*",
+                                 "modifyitems * 2 calls*",
+                                 "run * 4 calls*"])
+
+
+def test_timing_exports(testdir, redis_connection, redis_args):
+    """Ensure that the histograms are written as JSON and Prometheus."""
+    test_paths = utils.create_numbered_test_file(testdir, "timing", 3)
+    for test_path in test_paths:
+        redis_connection.lpush(redis_args['redis-list-key'], test_path)
+    json_path = testdir.tmpdir.join("timing.json")
+    prometheus_path = testdir.tmpdir.join("timing.prom")
+
+    py_test_args = utils.get_standard_args(redis_args) + \
+        ["--redis-worker-id=timed",
+         "--redis-timing-json=" + str(json_path),
+         "--redis-timing-prometheus=" + str(prometheus_path)]
+    result = testdir.runpytest(*py_test_args)
+
+    assert result.ret == EXIT_OK
+    assert "phase timing" not in result.stdout.str()
+    timing = json.loads(json_path.read())
+    assert timing['worker'] == "timed"
+    assert timing['phases']['run']['count'] == 3
+    assert timing['phases']['run']['buckets']['+Inf'] == 3
+    prometheus = prometheus_path.read()
+    assert ('pytest_redis_phase_seconds_count{worker="timed",phase="run"} 3'
+            in prometheus)
+    assert ('pytest_redis_phase_seconds_bucket{worker="timed",phase="pop",'
+            'le="+Inf"} 4' in prometheus)
+
+
+def test_phase_timer_buckets():
+    """Ensure that durations fall in cumulative buckets."""
+    phase_timer = pytest_redis.PhaseTimer()
+    phase_timer.add('run', 0.0001)
+    phase_timer.add('run', 0.002)
+    phase_timer.add('run', 60)
+
+    histogram = phase_timer.get_phases()['run']
+
+    assert histogram['count'] == 3
+    assert histogram['buckets']['0.0001'] == 1
+    assert histogram['buckets']['0.001'] == 1
+    assert histogram['buckets']['0.005'] == 2
+    assert histogram['buckets']['10.0'] == 2
+    assert histogram['buckets']['+Inf'] == 3
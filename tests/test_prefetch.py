@@ -0,0 +1,57 @@
+"""Tests the pytest-redis prefetch argument."""
+
+import time
+
+from _pytest.main import EXIT_OK
+
+import utils
+
+
+def test_prefetch_runs_every_test(testdir, redis_connection, redis_args):
+    """Ensure that prefetched batches are all run."""
+    test_paths = utils.create_numbered_test_file(testdir, "prefetch", 10)
+    for test_path in test_paths:
+        redis_connection.lpush(redis_args['redis-list-key'], test_path)
+
+    py_test_args = utils.get_standard_args(redis_args) + \
+        ["--redis-batch-size=2", "--redis-prefetch=2"]
+    result = testdir.runpytest(*py_test_args)
+
+    result.stdout.fnmatch_lines(["*" + test_path + " PASSED"
+                                 for test_path in test_paths])
+    assert result.ret == EXIT_OK
+    assert redis_connection.llen(redis_args['redis-list-key']) == 0
+
+
+def test_prefetch_returns_unrun_tests(testdir, redis_connection,
+                                      redis_args):
+    """Ensure that prefetched tests are returned when a run is stopped."""
+    test_paths = utils.create_numbered_test_file(
+        testdir, "prefetch", 10, first_test_body='pytest.exit("stop")')
+    back_up_list = redis_args["redis-backup-list-key"]
+    for test_path in test_paths:
+        redis_connection.lpush(redis_args['redis-list-key'], test_path)
+
+    py_test_args = utils.get_standard_args(redis_args) + \
+        ["--redis-prefetch=3"]
+    testdir.runpytest(*py_test_args)
+
+    assert redis_connection.lrange(back_up_list, 0, -1) == [test_paths[0]]
+    assert redis_connection.llen(redis_args['redis-list-key']) == 9
+    for test_path in test_paths[1:]:
+        assert redis_connection.rpop(redis_args['redis-list-key']) == \
+            test_path
+
+
+def test_prefetch_close_stops_waiting(testdir, redis_connection, redis_args):
+    """Ensure that closing doesn't wait for the idle timeout to run out."""
+    test_paths = utils.create_numbered_test_file(
+        testdir, "prefetch", 1, first_test_body="assert False")
+    redis_connection.lpush(redis_args['redis-list-key'], test_paths[0])
+
+    py_test_args = utils.get_standard_args(redis_args) + \
+        ["-x", "--redis-prefetch=2", "--redis-idle-timeout=20"]
+    start = time.time()
+    testdir.runpytest(*py_test_args)
+
+    assert time.time() - start < 10
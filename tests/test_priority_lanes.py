@@ -0,0 +1,105 @@
+"""Tests the pytest-redis priority list argument."""
+import pytest
+
+from _pytest.main import EXIT_OK
+
+import utils
+
+
+@pytest.yield_fixture
+def priority_key(redis_connection, redis_args):
+    """Return the key of a priority list, deleted afterwards."""
+    key = redis_args['redis-list-key'] + ":priority"
+    lane_backup_key = "{}:{}".format(redis_args['redis-backup-list-key'],
+                                     key)
+    redis_connection.delete(key, lane_backup_key)
+    yield key
+    redis_connection.delete(key, lane_backup_key)
+
+
+def get_run_order(result, test_paths):
+    """Return the test paths in the order they passed."""
+    lines = [line for line in result.outlines if line.endswith(" PASSED")]
+    return [line[:-len(" PASSED")] for line in lines
+            if line[:-len(" PASSED")] in test_paths]
+
+
+def test_priority_list_runs_first(testdir, redis_connection, redis_args,
+                                  priority_key):
+    """Ensure that the priority list is drained before the redis list."""
+    test_paths = utils.create_numbered_test_file(testdir, "lane", 5)
+    for test_path in test_paths[:3]:
+        redis_connection.lpush(redis_args['redis-list-key'], test_path)
+    for test_path in test_paths[3:]:
+        redis_connection.lpush(priority_key, test_path)
+
+    py_test_args = utils.get_standard_args(redis_args) + \
+        ["--redis-priority-list-key=" + priority_key,
+         "--redis-batch-size=3"]
+    result = testdir.runpytest(*py_test_args)
+
+    assert result.ret == EXIT_OK
+    assert get_run_order(result, test_paths) == \
+        test_paths[3:] + test_paths[:3]
+    backup_list_key = redis_args['redis-backup-list-key']
+    assert redis_connection.llen(backup_list_key) == 3
+    assert redis_connection.lrange(
+        "{}:{}".format(backup_list_key, priority_key), 0, -1) == \
+        list(reversed(test_paths[3:]))
+
+
+def test_priority_backup_list_is_restored(testdir, redis_connection,
+                                          redis_args, priority_key):
+    """Ensure that a lane's backup list is restored to its own list."""
+    test_paths = utils.create_numbered_test_file(testdir, "lane", 3)
+    lane_backup_key = "{}:{}".format(redis_args['redis-backup-list-key'],
+                                     priority_key)
+    for test_path in test_paths[:2]:
+        redis_connection.lpush(redis_args['redis-list-key'], test_path)
+    redis_connection.lpush(lane_backup_key, test_paths[2])
+
+    py_test_args = utils.get_standard_args(redis_args) + \
+        ["--redis-priority-list-key=" + priority_key]
+    result = testdir.runpytest(*py_test_args)
+
+    assert result.ret == EXIT_OK
+    assert get_run_order(result, test_paths) == \
+        [test_paths[2]] + test_paths[:2]
+
+
+def test_priority_unrun_tests_return_to_their_list(testdir,
+                                                   redis_connection,
+                                                   redis_args, priority_key):
+    """Ensure that prefetched tests are given back to their own list."""
+    test_paths = utils.create_numbered_test_file(
+        testdir, "lane", 4, first_test_body='pytest.exit("stop")')
+    redis_connection.lpush(priority_key, test_paths[0], test_paths[1])
+    redis_connection.lpush(redis_args['redis-list-key'], test_paths[2],
+                           test_paths[3])
+
+    py_test_args = utils.get_standard_args(redis_args) + \
+        ["--redis-priority-list-key=" + priority_key, "--redis-prefetch=3"]
+    testdir.runpytest(*py_test_args)
+
+    assert redis_connection.lrange(priority_key, 0, -1) == [test_paths[1]]
+    assert redis_connection.lrange(redis_args['redis-list-key'], 0, -1) == \
+        [test_paths[3], test_paths[2]]
+
+
+def test_priority_blocking_pop(testdir, redis_connection, redis_args,
+                               priority_key):
+    """Ensure that waiting workers pop from every list."""
+    test_paths = utils.create_numbered_test_file(testdir, "lane", 2)
+    redis_connection.lpush(priority_key, test_paths[0])
+    redis_connection.lpush(redis_args['redis-list-key'], test_paths[1])
+
+    py_test_args = utils.default_pytest_redis_args() + \
+        ["--redis-host=" + str(redis_args['redis-host']),
+         "--redis-port=" + str(redis_args['redis-port']),
+         "--redis-list-key=" + redis_args['redis-list-key'],
+         "--redis-priority-list-key=" + priority_key,
+         "--redis-idle-timeout=0.5"]
+    result = testdir.runpytest(*py_test_args)
+
+    assert result.ret == EXIT_OK
+    assert get_run_order(result, test_paths) == test_paths
@@ -0,0 +1,124 @@
+"""Tests the pytest-redis report stream and its aggregator."""
+import json
+import os.path
+
+from _pytest.main import EXIT_TESTSFAILED
+
+import utils
+
+import pytest_redis_aggregate
+
+
+def create_test_file(testdir):
+    """Create test file and return array of paths to tests."""
+    test_filename = "test_report_file.py"
+    utils.create_test_file(testdir, test_filename, """
+        import pytest
+
+        def test_passes():
+            assert True
+
+        def test_fails():
+            assert False, "this test fails"
+
+        def test_skips():
+            pytest.skip("skipped on purpose")
+    """)
+    return [test_filename + "::test_passes",
+            test_filename + "::test_fails",
+            test_filename + "::test_skips"]
+
+
+def run_with_report_stream(testdir, redis_connection, redis_args,
+                           stream_key):
+    """Run the tests of the test file while reporting to a stream."""
+    for test_path in create_test_file(testdir):
+        redis_connection.lpush(redis_args['redis-list-key'], test_path)
+    py_test_args = utils.get_standard_args(redis_args) + \
+        ["--redis-report-stream=" + stream_key,
+         "--redis-report-batch-size=2",
+         "--redis-worker-id=reporting-worker"]
+    return testdir.runpytest(*py_test_args)
+
+
+def test_results_added_to_stream(testdir, redis_connection, redis_args):
+    """Ensure that a single result of every test is added."""
+    stream_key = redis_args['redis-list-key'] + ":reports"
+
+    try:
+        result = run_with_report_stream(testdir, redis_connection,
+                                        redis_args, stream_key)
+        assert result.ret == EXIT_TESTSFAILED
+
+        entries = pytest_redis_aggregate.parse_stream_entries(
+            redis_connection.execute_command('XREAD', 'STREAMS',
+                                             stream_key, '0'))
+        results = dict((fields['nodeid'].split("::")[-1], fields)
+                       for _, fields in entries)
+        assert len(entries) == 3
+        assert results['test_passes']['outcome'] == 'passed'
+        assert results['test_fails']['outcome'] == 'failed'
+        assert "this test fails" in results['test_fails']['longrepr']
+        assert results['test_skips']['outcome'] == 'skipped'
+        assert results['test_skips']['longrepr'] == \
+            "Skipped: skipped on purpose"
+        assert results['test_passes']['worker'] == 'reporting-worker'
+    finally:
+        redis_connection.delete(stream_key)
+
+
+def test_forked_consumers_report_their_worker_id(testdir, redis_connection,
+                                                 redis_args):
+    """Ensure that results of forked consumers carry the consumer's id."""
+    stream_key = redis_args['redis-list-key'] + ":reports"
+    for test_path in utils.create_numbered_test_file(testdir, "report", 4):
+        redis_connection.lpush(redis_args['redis-list-key'], test_path)
+    py_test_args = utils.get_standard_args(redis_args) + \
+        ["--redis-report-stream=" + stream_key,
+         "--redis-worker-id=reporting-worker",
+         "--redis-workers=2"]
+
+    try:
+        result = testdir.runpytest_subprocess(*py_test_args)
+        result.stdout.fnmatch_lines(["*2 consumers: 4 passed*"])
+
+        entries = pytest_redis_aggregate.parse_stream_entries(
+            redis_connection.execute_command('XREAD', 'STREAMS',
+                                             stream_key, '0'))
+        assert len(entries) == 4
+        assert set(fields['worker'] for _, fields in entries) <= \
+            set(["reporting-worker:0", "reporting-worker:1"])
+    finally:
+        redis_connection.delete(stream_key)
+        for slot in range(2):
+            redis_connection.delete("{}:{}".format(
+                redis_args['redis-backup-list-key'], slot))
+
+
+def test_aggregate_reports(testdir, redis_connection, redis_args):
+    """Ensure that the aggregator merges the stream into reports."""
+    stream_key = redis_args['redis-list-key'] + ":reports"
+    json_path = str(testdir.tmpdir.join("report.json"))
+    junitxml_path = str(testdir.tmpdir.join("report.xml"))
+
+    try:
+        run_with_report_stream(testdir, redis_connection, redis_args,
+                               stream_key)
+        ret = pytest_redis_aggregate.main([
+            "--redis-host=" + str(redis_args['redis-host']),
+            "--redis-port=" + str(redis_args['redis-port']),
+            "--redis-report-stream=" + stream_key,
+            "--count=1",
+            "--json=" + json_path,
+            "--junitxml=" + junitxml_path])
+    finally:
+        redis_connection.delete(stream_key)
+
+    assert ret == 1
+    with open(json_path) as json_file:
+        report = json.load(json_file)
+    assert report['summary']['tests'] == 3
+    assert report['summary']['passed'] == 1
+    assert report['summary']['failed'] == 1
+    assert report['summary']['skipped'] == 1
+    assert os.path.exists(junitxml_path)
@@ -0,0 +1,105 @@
+"""Tests the pytest-redis result cache arguments."""
+import pytest
+
+from _pytest.main import EXIT_OK, EXIT_TESTSFAILED
+
+import utils
+
+
+TEST_FILE_CONTENTS = """
+    def test_passing():
+        assert True
+
+    def test_failing():
+        assert {}
+"""
+
+
+def create_test_file(testdir, failing_assertion="False"):
+    """Create a test file and return the paths to its tests."""
+    test_filename = "test_result_cache_file.py"
+    utils.create_test_file(testdir, test_filename,
+                           TEST_FILE_CONTENTS.format(failing_assertion))
+    return [test_filename + "::test_passing",
+            test_filename + "::test_failing"]
+
+
+@pytest.yield_fixture
+def result_cache(redis_connection, redis_args):
+    """Return a result cache key prefix, deleted afterwards."""
+    prefix = redis_args['redis-list-key'] + ":results"
+
+    def clean():
+        for key in redis_connection.keys(prefix + ":*"):
+            redis_connection.delete(key)
+    clean()
+    yield prefix
+    clean()
+
+
+def run_cached(testdir, redis_connection, redis_args, result_cache,
+               test_paths, *args):
+    """Push the test paths and run them with the result cache."""
+    # Start from an empty backup list so that every test runs once
+    redis_connection.delete(redis_args['redis-backup-list-key'])
+    for test_path in test_paths:
+        redis_connection.lpush(redis_args['redis-list-key'], test_path)
+    py_test_args = utils.get_standard_args(redis_args) + \
+        ["--redis-result-cache=" + result_cache] + list(args)
+    return testdir.runpytest(*py_test_args)
+
+
+def test_passing_tests_are_cached(testdir, redis_connection, redis_args,
+                                  result_cache):
+    """Ensure that only passing tests are reported from the cache."""
+    test_paths = create_test_file(testdir)
+    result = run_cached(testdir, redis_connection, redis_args, result_cache,
+                        test_paths)
+    assert result.ret == EXIT_TESTSFAILED
+    assert len(redis_connection.keys(result_cache + ":*")) == 1
+
+    result = run_cached(testdir, redis_connection, redis_args, result_cache,
+                        test_paths)
+
+    assert result.ret == EXIT_TESTSFAILED
+    result.stdout.fnmatch_lines(["*test_passing CACHED",
+                                 "*test_failing FAILED",
+                                 "*1 failed, 1 passed*"])
+
+
+def test_changed_module_is_run(testdir, redis_connection, redis_args,
+                               result_cache):
+    """Ensure that changing a test module invalidates its results."""
+    test_paths = create_test_file(testdir, failing_assertion="True")
+    run_cached(testdir, redis_connection, redis_args, result_cache,
+               test_paths)
+    create_test_file(testdir, failing_assertion="1")
+
+    result = run_cached(testdir, redis_connection, redis_args, result_cache,
+                        test_paths)
+
+    assert result.ret == EXIT_OK
+    assert "CACHED" not in result.stdout.str()
+
+
+def test_changed_dependency_is_run(testdir, redis_connection, redis_args,
+                                   result_cache):
+    """Ensure that changing a dependency file invalidates every result."""
+    test_paths = create_test_file(testdir, failing_assertion="True")
+    dependency = testdir.tmpdir.join("code_under_test.py")
+    dependency.write("VALUE = 1\n")
+    dependency_arg = "--redis-result-cache-dependency=" + \
+        str(testdir.tmpdir.join("*.py"))
+    run_cached(testdir, redis_connection, redis_args, result_cache,
+               test_paths, dependency_arg)
+    result = run_cached(testdir, redis_connection, redis_args, result_cache,
+                        test_paths, dependency_arg)
+    result.stdout.fnmatch_lines(["*test_passing CACHED",
+                                 "*test_failing CACHED"])
+    dependency.write("VALUE = 2\n")
+
+    result = run_cached(testdir, redis_connection, redis_args, result_cache,
+                        test_paths, dependency_arg)
+
+    assert result.ret == EXIT_OK
+    assert "CACHED" not in result.stdout.str()
@@ -0,0 +1,77 @@
+"""Tests the pytest-redis shard arguments."""
+import pytest
+
+from _pytest.main import EXIT_OK
+
+import utils
+
+import pytest_redis
+import pytest_redis_enqueue
+
+
+@pytest.yield_fixture
+def shard_keys(redis_connection, redis_args):
+    """Return the keys of two shards, deleted with their backup lists."""
+    keys = [pytest_redis.get_shard_key(redis_args['redis-list-key'], index)
+            for index in range(2)]
+    yield keys
+    for key in keys:
+        redis_connection.delete(
+            key, "{}:{}".format(redis_args['redis-backup-list-key'], key))
+
+
+def get_run_order(result):
+    """Return the test paths in the order they passed."""
+    return [line[:-len(" PASSED")] for line in result.outlines
+            if line.endswith(" PASSED")]
+
+
+def test_enqueue_spreads_paths_over_shards(testdir, redis_connection,
+                                           redis_args, shard_keys):
+    """Ensure that the producer pushes paths to the shards in turn."""
+    test_paths = utils.create_numbered_test_file(testdir, "shard", 3)
+
+    ret = pytest_redis_enqueue.main(
+        ["--redis-host=" + str(redis_args['redis-host']),
+         "--redis-port=" + str(redis_args['redis-port']),
+         "--redis-list-key=" + redis_args['redis-list-key'],
+         "--shards=2", "test_shard_file.py"])
+
+    assert ret == EXIT_OK
+    assert redis_connection.lrange(shard_keys[0], 0, -1) == \
+        [test_paths[2], test_paths[0]]
+    assert redis_connection.lrange(shard_keys[1], 0, -1) == [test_paths[1]]
+    assert redis_connection.llen(redis_args['redis-list-key']) == 0
+
+
+def test_worker_steals_from_other_shards(testdir, redis_connection,
+                                         redis_args, shard_keys):
+    """Ensure that the home shard is consumed before the other shards."""
+    test_paths = utils.create_numbered_test_file(testdir, "shard", 3)
+    redis_connection.lpush(shard_keys[0], test_paths[0], test_paths[1])
+    redis_connection.lpush(shard_keys[1], test_paths[2])
+
+    result = testdir.runpytest(*utils.get_standard_args(redis_args) +
+                               ["--redis-shards=2", "--redis-home-shard=1"])
+
+    assert result.ret == EXIT_OK
+    assert get_run_order(result) == [test_paths[2], test_paths[0],
+                                     test_paths[1]]
+    for key in shard_keys:
+        assert redis_connection.llen(key) == 0
+
+
+def test_shards_restore_their_backup_lists(testdir, redis_connection,
+                                           redis_args, shard_keys):
+    """Ensure that a shard's backup list is restored to the shard."""
+    test_paths = utils.create_numbered_test_file(testdir, "shard", 1)
+    shard_backup_key = "{}:{}".format(redis_args['redis-backup-list-key'],
+                                      shard_keys[1])
+    redis_connection.lpush(shard_backup_key, test_paths[0])
+
+    result = testdir.runpytest(*utils.get_standard_args(redis_args) +
+                               ["--redis-shards=2", "--redis-home-shard=0"])
+
+    assert result.ret == EXIT_OK
+    assert get_run_order(result) == test_paths
+    assert redis_connection.lrange(shard_backup_key, 0, -1) == test_paths
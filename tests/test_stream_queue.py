@@ -0,0 +1,120 @@
+"""Tests the pytest-redis stream queue type."""
+import time
+
+import pytest
+
+from _pytest.main import EXIT_OK, EXIT_USAGEERROR
+
+import utils
+
+import pytest_redis
+
+
+@pytest.yield_fixture
+def stream_args(redis_connection, redis_args):
+    """Return redis args whose queue is a stream, deleted afterwards."""
+    stream_key = redis_args['redis-list-key'] + ":stream"
+    redis_connection.delete(stream_key)
+    args = dict(redis_args)
+    args['redis-list-key'] = stream_key
+    args['redis-queue-type'] = 'stream'
+    yield args
+    redis_connection.delete(stream_key)
+
+
+def add_tests(redis_connection, stream_key, test_paths):
+    """Add the test paths to the stream queue."""
+    for test_path in test_paths:
+        redis_connection.execute_command('XADD', stream_key, '*',
+                                         pytest_redis.STREAM_PATH_FIELD,
+                                         test_path)
+
+
+def get_pending_count(redis_connection, stream_key):
+    """Return the number of read but unacknowledged entries."""
+    return redis_connection.execute_command('XPENDING', stream_key,
+                                            'pytest-redis')[0]
+
+
+def test_stream_runs_every_test(testdir, redis_connection, stream_args):
+    """Ensure that every entry is run, acknowledged and deleted."""
+    test_paths = utils.create_numbered_test_file(testdir, "stream", 10)
+    add_tests(redis_connection, stream_args['redis-list-key'], test_paths)
+
+    py_test_args = utils.get_standard_args(stream_args) + \
+        ["--redis-batch-size=3"]
+    result = testdir.runpytest(*py_test_args)
+
+    result.stdout.fnmatch_lines(["*" + test_path + " PASSED"
+                                 for test_path in test_paths])
+    assert result.ret == EXIT_OK
+    assert redis_connection.execute_command(
+        'XLEN', stream_args['redis-list-key']) == 0
+    assert get_pending_count(redis_connection,
+                             stream_args['redis-list-key']) == 0
+
+
+def test_stream_claims_stalled_entries(testdir, redis_connection,
+                                       stream_args):
+    """Ensure that entries read by a stalled consumer are claimed."""
+    stream_key = stream_args['redis-list-key']
+    test_paths = utils.create_numbered_test_file(testdir, "stream", 4)
+    add_tests(redis_connection, stream_key, test_paths)
+    redis_connection.execute_command('XGROUP', 'CREATE', stream_key,
+                                     'pytest-redis', '0')
+    redis_connection.execute_command('XREADGROUP', 'GROUP', 'pytest-redis',
+                                     'stalled', 'COUNT', 2,
+                                     'STREAMS', stream_key, '>')
+    time.sleep(0.05)
+
+    py_test_args = utils.get_standard_args(stream_args) + \
+        ["--redis-stream-claim-idle=0.01"]
+    result = testdir.runpytest(*py_test_args)
+
+    result.stdout.fnmatch_lines(["*" + test_path + " PASSED"
+                                 for test_path in test_paths])
+    assert get_pending_count(redis_connection, stream_key) == 0
+
+
+def test_stream_reads_own_pending_entries_once(redis_connection,
+                                               stream_args):
+    """Ensure that entries read before a restart are claimed once."""
+    stream_key = stream_args['redis-list-key']
+    test_paths = ["test_stream_file.py::test_stream_{}".format(i)
+                  for i in range(5)]
+    add_tests(redis_connection, stream_key, test_paths)
+    test_queue = pytest_redis.StreamQueue(redis_connection, stream_key,
+                                          'pytest-redis', 'restarted', 60)
+    test_queue.create_group()
+    redis_connection.execute_command('XREADGROUP', 'GROUP', 'pytest-redis',
+                                     'restarted', 'COUNT', 4,
+                                     'STREAMS', stream_key, '>')
+
+    claimed = test_queue.claim(2) + test_queue.claim(2) + \
+        test_queue.claim(2)
+
+    assert claimed == test_paths
+
+
+def test_stream_returns_unrun_tests(testdir, redis_connection, stream_args):
+    """Ensure that prefetched entries are added back when a run stops."""
+    stream_key = stream_args['redis-list-key']
+    test_paths = utils.create_numbered_test_file(
+        testdir, "stream", 10, first_test_body='pytest.exit("stop")')
+    add_tests(redis_connection, stream_key, test_paths)
+
+    py_test_args = utils.get_standard_args(stream_args) + \
+        ["--redis-prefetch=3"]
+    testdir.runpytest(*py_test_args)
+
+    assert redis_connection.execute_command('XLEN', stream_key) == 10
+    assert get_pending_count(redis_connection, stream_key) == 1
+
+
+def test_stream_rejects_leases(testdir, stream_args):
+    """Ensure that leases can't be combined with a stream queue."""
+    py_test_args = utils.get_standard_args(stream_args) + \
+        ["--redis-lease-timeout=5"]
+    result = testdir.runpytest(*py_test_args)
+
+    assert result.ret == EXIT_USAGEERROR
@@ -0,0 +1,83 @@
+"""Tests the pytest-redis workers argument."""
+
+from _pytest.main import (EXIT_OK, EXIT_TESTSFAILED, EXIT_INTERRUPTED,
+                          EXIT_INTERNALERROR, EXIT_NOTESTSCOLLECTED)
+
+import utils
+
+import pytest_redis
+
+
+def clean_slot_backup_lists(redis_connection, backup_list_key, num_workers):
+    """Delete the backup lists of the forked consumers."""
+    for slot in range(num_workers):
+        redis_connection.delete("{}:{}".format(backup_list_key, slot))
+
+
+def test_workers_run_every_test(testdir, redis_connection, redis_args):
+    """Ensure that forked consumers run every test once."""
+    test_paths = utils.create_numbered_test_file(testdir, "worker_pool", 12)
+    for test_path in test_paths:
+        redis_connection.lpush(redis_args['redis-list-key'], test_path)
+
+    py_test_args = utils.get_standard_args(redis_args) + \
+        ["--redis-workers=3"]
+    result = testdir.runpytest_subprocess(*py_test_args)
+    clean_slot_backup_lists(redis_connection,
+                            redis_args['redis-backup-list-key'], 3)
+
+    result.stdout.fnmatch_lines(["*3 consumers: 12 passed*"])
+    assert result.ret == EXIT_OK
+    assert redis_connection.llen(redis_args['redis-list-key']) == 0
+
+
+def test_workers_merge_failures(testdir, redis_connection, redis_args):
+    """Ensure that a failure in any consumer fails the run."""
+    test_paths = utils.create_numbered_test_file(
+        testdir, "worker_pool", 6, first_test_body="assert False")
+    for test_path in test_paths:
+        redis_connection.lpush(redis_args['redis-list-key'], test_path)
+
+    py_test_args = utils.get_standard_args(redis_args) + \
+        ["--redis-workers=2"]
+    result = testdir.runpytest_subprocess(*py_test_args)
+    clean_slot_backup_lists(redis_connection,
+                            redis_args['redis-backup-list-key'], 2)
+
+    result.stdout.fnmatch_lines(["*2 consumers: 1 failed, 5 passed*"])
+    assert result.ret == EXIT_TESTSFAILED
+
+
+def test_workers_respawn_killed_consumer(testdir, redis_connection,
+                                         redis_args):
+    """Ensure that a killed consumer is respawned and its test requeued."""
+    marker = testdir.tmpdir.join("killed")
+    test_paths = utils.create_numbered_test_file(
+        testdir, "worker_pool", 4,
+        first_test_body=("if not os.path.exists({!r}):\n"
+                         "                open({!r}, 'w').close()\n"
+                         "                os.kill(os.getpid(), "
+                         "signal.SIGKILL)").format(str(marker), str(marker)),
+        imports=("os", "signal"))
+    for test_path in test_paths:
+        redis_connection.lpush(redis_args['redis-list-key'], test_path)
+
+    py_test_args = utils.get_standard_args(redis_args) + \
+        ["--redis-workers=1"]
+    result = testdir.runpytest_subprocess(*py_test_args)
+    clean_slot_backup_lists(redis_connection,
+                            redis_args['redis-backup-list-key'], 1)
+
+    result.stdout.fnmatch_lines(["*consumer 0 * was killed by signal 9*",
+                                 "*1 consumers: 4 passed*"])
+    assert redis_connection.llen(redis_args['redis-list-key']) == 0
+
+
+def test_merge_exitstatuses():
+    """Ensure that the most severe exit status is kept."""
+    merge = pytest_redis.WorkerPool.merge_exitstatuses
+    assert merge([]) == EXIT_NOTESTSCOLLECTED
+    assert merge([EXIT_OK, EXIT_NOTESTSCOLLECTED]) == EXIT_OK
+    assert merge([EXIT_OK, EXIT_TESTSFAILED]) == EXIT_TESTSFAILED
+    assert merge([EXIT_TESTSFAILED, EXIT_INTERNALERROR,
+                  EXIT_INTERRUPTED]) == EXIT_INTERRUPTED
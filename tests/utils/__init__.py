@@ -33,3 +33,26 @@ def get_standard_args(option_dict):
 def create_test_dir(testdir, dirname):
     """Create test file with the given name and text contents."""
     testdir.mkdir(dirname)
+
+
+def create_numbered_test_file(testdir, name, num_tests,
+                              first_test_body="assert True",
+                              imports=("pytest",)):
+    """Create test_<name>_file.py with `num_tests` numbered tests.
+
+    Every test passes except the first, which runs `first_test_body`.
+    Returns the paths to the tests in order.
+    """
+    test_filename = "test_{}_file.py".format(name)
+    test_filename_contents = "".join("""
+        import {}
+    """.format(module) for module in imports)
+    for test_num in range(num_tests):
+        test_filename_contents += """
+        def test_{}_{}():
+            {}
+        """.format(name, test_num, first_test_body if test_num == 0 else
+                   "assert True")
+    create_test_file(testdir, test_filename, test_filename_contents)
+    return [test_filename + "::test_{}_{}".format(name, test_num)
+            for test_num in range(num_tests)]